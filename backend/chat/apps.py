@@ -1,5 +1,20 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ChatConfig(AppConfig):
     name = 'chat'
+
+    def ready(self):
+        # Registers the signal that releases blob references when messages are deleted
+        from . import media  # noqa: F401
+
+        post_migrate.connect(install_search_index, sender=self)
+
+
+def install_search_index(using, **kwargs):
+    # Table rebuilds in later migrations drop the search index triggers; put them back
+    from django.db import connections
+    from .search import install
+
+    install(connections[using])
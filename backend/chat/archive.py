@@ -0,0 +1,337 @@
+import asyncio
+import bisect
+import contextvars
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import uuid
+import zlib
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .dbwriter import db_writer
+from .models import ArchiveSegment, Message, Room
+from .serializers import serialize_message
+
+# A segment file is MAGIC, then zlib-compressed blocks of chat_message
+# payloads (a JSON list each, oldest first), then one index entry per block,
+# then the footer. The index is sparse: one entry per block, not per message.
+MAGIC = b'CHATSEG1'
+# first id, last id, first and last timestamp (microseconds since the epoch), offset, length
+BLOCK_ENTRY = struct.Struct('<qqqqQI')
+# offset of the index, number of blocks, MAGIC
+FOOTER = struct.Struct('<QI8s')
+
+logger = logging.getLogger(__name__)
+
+
+def microseconds(timestamp):
+    return int(datetime.fromisoformat(timestamp).timestamp() * 1000000)
+
+
+def write_segment(path, payloads, block_messages):
+    """Write ``payloads`` (oldest first) to a new segment file at ``path``; returns its size.
+
+    The file is written under a temporary name and fsynced before it is
+    moved into place, so a segment file is always complete. It is never
+    changed afterwards.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + '.tmp'
+    entries = []
+    with open(partial, 'wb') as target:
+        target.write(MAGIC)
+        offset = len(MAGIC)
+        for start in range(0, len(payloads), block_messages):
+            block = payloads[start:start + block_messages]
+            data = zlib.compress(json.dumps(block, separators=(',', ':')).encode())
+            entries.append(BLOCK_ENTRY.pack(
+                block[0]['id'], block[-1]['id'],
+                microseconds(block[0]['timestamp']), microseconds(block[-1]['timestamp']),
+                offset, len(data),
+            ))
+            target.write(data)
+            offset += len(data)
+        target.write(b''.join(entries))
+        target.write(FOOTER.pack(offset, len(entries), MAGIC))
+        target.flush()
+        os.fsync(target.fileno())
+        size = target.tell()
+    os.replace(partial, path)
+    return size
+
+
+class Segment:
+    """A segment file mapped into memory, with its block index"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as source:
+            self.map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, count, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError('%s is not a segment file' % path)
+        self.blocks = [BLOCK_ENTRY.unpack_from(self.map, index_offset + number * BLOCK_ENTRY.size)
+                       for number in range(count)]
+        self.last_ids = [entry[1] for entry in self.blocks]
+
+    def block(self, number):
+        _, _, _, _, offset, length = self.blocks[number]
+        return json.loads(zlib.decompress(self.map[offset:offset + length]))
+
+
+class SegmentStore:
+    """Reads archived messages; process-wide LRU caches of mapped segment files and decoded blocks.
+
+    Only the blocks a page needs are read from the map and decompressed,
+    and nothing is loaded back into the database.
+    """
+
+    def __init__(self, root, max_segments=64, max_blocks=256):
+        self.root = root
+        self.max_segments = max_segments
+        self.max_blocks = max_blocks
+        self.segments = OrderedDict()  # path -> Segment
+        self.blocks = OrderedDict()  # (path, block number) -> payloads
+        self.lock = threading.Lock()
+        self.block_hits = 0
+        self.block_misses = 0
+
+    def stats(self):
+        return {
+            'open_segments': len(self.segments),
+            'cached_blocks': len(self.blocks),
+            'block_hits': self.block_hits,
+            'block_misses': self.block_misses,
+        }
+
+    def segment(self, path):
+        with self.lock:
+            segment = self.segments.get(path)
+            if segment is not None:
+                self.segments.move_to_end(path)
+                return segment
+        # Maps of evicted segments are closed when the last reader drops them
+        segment = Segment(os.path.join(self.root, path))
+        with self.lock:
+            self.segments[path] = segment
+            while len(self.segments) > self.max_segments:
+                self.segments.popitem(last=False)
+        return segment
+
+    def block(self, path, segment, number):
+        key = (path, number)
+        with self.lock:
+            payloads = self.blocks.get(key)
+            if payloads is not None:
+                self.blocks.move_to_end(key)
+                self.block_hits += 1
+                return payloads
+            self.block_misses += 1
+        payloads = segment.block(number)
+        with self.lock:
+            self.blocks[key] = payloads
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        return payloads
+
+    def read(self, segments, before, count):
+        """Return the newest ``count`` archived payloads with an id below ``before``, newest first.
+
+        ``segments`` are ``(path, first_id, last_id)`` rows ordered by
+        ``last_id``, newest first. Segments may overlap: a message kept
+        back by one run can be archived by a later one.
+        """
+        found = []
+        for path, first_id, last_id in segments:
+            if len(found) >= count and last_id < found[-1]['id']:
+                break
+            segment = self.segment(path)
+            # The first block that may hold an id below ``before``, then older ones
+            number = len(segment.blocks) - 1 if before is None else bisect.bisect_left(segment.last_ids, before)
+            taken = 0
+            for number in range(min(number, len(segment.blocks) - 1), -1, -1):
+                payloads = self.block(path, segment, number)
+                older = [payload for payload in reversed(payloads) if before is None or payload['id'] < before]
+                found.extend(older)
+                taken += len(older)
+                if taken >= count:
+                    break
+            found.sort(key=lambda payload: payload['id'], reverse=True)
+            del found[count:]
+        # Cached payloads are shared; callers may add fields to theirs
+        return [dict(payload) for payload in found]
+
+
+def archived_segments(room_id, before=None):
+    queryset = ArchiveSegment.objects.filter(room_id=room_id)
+    if before is not None:
+        queryset = queryset.filter(first_id__lt=before)
+    return list(queryset.order_by('-last_id').values_list('path', 'first_id', 'last_id'))
+
+
+def is_archived(room_id, message_id):
+    """Whether ``message_id`` is one of the room's archived messages"""
+    segments = list(
+        ArchiveSegment.objects.filter(room_id=room_id, first_id__lte=message_id, last_id__gte=message_id)
+        .order_by('-last_id').values_list('path', 'first_id', 'last_id')
+    )
+    # Segments cover id ranges with gaps (messages kept back or deleted before archiving)
+    return any(payload['id'] == message_id for payload in segment_store.read(segments, message_id + 1, 1))
+
+
+def rooms_to_archive(cutoff):
+    # One index lookup per room, rather than a scan of every message for the distinct rooms
+    old = Message.objects.filter(room=OuterRef('pk'), timestamp__lt=cutoff)
+    return list(Room.objects.filter(Exists(old), deleted_at__isnull=True).values_list('id', flat=True))
+
+
+def archive_chunk(room_id, cutoff, size, after=0):
+    """Move up to ``size`` of a room's messages sent before ``cutoff`` into a new segment file.
+
+    Returns ``(archived, last id looked at)``, or ``(0, None)`` when the
+    room has nothing more to archive; pass the id back as ``after``.
+
+    Some old messages stay in the table: messages with a file, so blob
+    reference counts and ``gc_media`` keep working, and every message of
+    a thread that has a message staying, so no reply loses its parent
+    (``parent_id`` is set to NULL when the parent row goes) and reply
+    counts stay exact. A thread cut by the chunk boundary is archived
+    whole by a later run. Runs on the writer thread in one transaction,
+    which holds SQLite's write lock from the first statement, so no
+    message changes while it is copied. Archived messages are read-only
+    from then on: edits, deletes and reactions get an ``archived`` error,
+    and search and the thread endpoint no longer see them.
+    """
+    with transaction.atomic():
+        candidates = list(
+            Message.objects.filter(room_id=room_id, timestamp__lt=cutoff, id__gt=after)
+            .filter(Q(file__isnull=True) | Q(file=''), blob__isnull=True)
+            .order_by('id').values_list('id', 'parent_id')[:size]
+        )
+        if not candidates:
+            return 0, None
+        candidate_ids = {message_id for message_id, _ in candidates}
+        linked = defaultdict(list)
+        # Replies to a message that stays, and parents of a reply that stays
+        kept = [message_id for message_id, parent_id in candidates
+                if parent_id is not None and parent_id not in candidate_ids]
+        kept.extend(Message.objects.filter(parent_id__in=candidate_ids).exclude(id__in=candidate_ids)
+                    .values_list('parent_id', flat=True).distinct())
+        for message_id, parent_id in candidates:
+            if parent_id in candidate_ids:
+                linked[message_id].append(parent_id)
+                linked[parent_id].append(message_id)
+        staying = set()
+        while kept:
+            message_id = kept.pop()
+            if message_id not in staying:
+                staying.add(message_id)
+                kept.extend(linked[message_id])
+        ids = [message_id for message_id, _ in candidates if message_id not in staying]
+        if not ids:
+            return 0, candidates[-1][0]
+
+        messages = list(
+            Message.objects.filter(id__in=ids).order_by('id')
+            .select_related('parent').prefetch_related('reaction_counts')
+        )
+        payloads = [serialize_message(message) for message in messages]
+        path = '%d/%012d-%012d-%s.seg' % (room_id, ids[0], ids[-1], uuid.uuid4().hex[:8])
+        full_path = os.path.join(settings.CHAT_ARCHIVE_DIR, path)
+        size_on_disk = write_segment(full_path, payloads, settings.CHAT_ARCHIVE_BLOCK_MESSAGES)
+        try:
+            ArchiveSegment.objects.create(
+                room_id=room_id, path=path, first_id=ids[0], last_id=ids[-1],
+                first_timestamp=messages[0].timestamp, last_timestamp=messages[-1].timestamp,
+                message_count=len(ids), size=size_on_disk,
+            )
+            # Room.message_count keeps counting them: they are still in the room
+            Message.objects.filter(id__in=ids).delete()
+        except Exception:
+            os.remove(full_path)
+            raise
+        transaction.on_commit(lambda: logger.info('Archived %d messages of room %s to %s', len(ids), room_id, path))
+    return len(ids), candidates[-1][0]
+
+
+def delete_segment_files(paths):
+    for path in paths:
+        try:
+            os.remove(os.path.join(settings.CHAT_ARCHIVE_DIR, path))
+        except FileNotFoundError:
+            pass
+
+
+class Archiver:
+    """Background task that archives messages older than ``after_days`` every ``interval`` seconds.
+
+    Each chunk of ``chunk_size`` messages is one transaction on the writer
+    thread, followed by a ``pause``, like room purges. Off when
+    ``interval`` is 0; ``manage.py archive_messages`` does the same from cron.
+    """
+
+    def __init__(self, interval=0, after_days=90, chunk_size=5000, pause=0.05):
+        self.interval = interval
+        self.after_days = after_days
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.task = None
+        self.archived = 0
+        self.segments = 0
+        self.runs = 0
+        self.failures = 0
+
+    def stats(self):
+        return {
+            'archived_messages': self.archived,
+            'segments_written': self.segments,
+            'runs': self.runs,
+            'failures': self.failures,
+        }
+
+    def start(self):
+        if self.interval <= 0 or (self.task is not None and not self.task.done()):
+            return
+        # Fresh context, as for room purges: the task outlives the connection that started it
+        self.task = asyncio.create_task(self.run(), context=contextvars.Context())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.archive()
+            except Exception:
+                self.failures += 1
+                logger.exception('Archiving old messages failed')
+
+    async def archive(self):
+        cutoff = timezone.now() - timedelta(days=self.after_days)
+        for room_id in await db_writer.run(rooms_to_archive, cutoff):
+            after = 0
+            while after is not None:
+                archived, after = await db_writer.run(archive_chunk, room_id, cutoff, self.chunk_size, after)
+                if archived:
+                    self.archived += archived
+                    self.segments += 1
+                await asyncio.sleep(self.pause)
+        self.runs += 1
+
+
+segment_store = SegmentStore(
+    settings.CHAT_ARCHIVE_DIR,
+    max_segments=settings.CHAT_ARCHIVE_OPEN_SEGMENTS,
+    max_blocks=settings.CHAT_ARCHIVE_CACHE_BLOCKS,
+)
+archiver = Archiver(
+    interval=settings.CHAT_ARCHIVE_INTERVAL,
+    after_days=settings.CHAT_ARCHIVE_AFTER_DAYS,
+    chunk_size=settings.CHAT_ARCHIVE_SEGMENT_MESSAGES,
+)
@@ -0,0 +1,43 @@
+import itertools
+import json
+import os
+import uuid
+
+from .metrics import group_send_seconds
+from .replay import replay_buffers
+
+# Identifies events broadcast by this process, so consumers can tell which
+# events other worker processes sent (see ReplayBuffers.apply_remote)
+PROCESS_ORIGIN = '%d-%s' % (os.getpid(), uuid.uuid4().hex[:8])
+event_numbers = itertools.count(1)
+
+
+def group_name(room_name):
+    return 'chat_%s' % room_name
+
+
+def encode_frame(event_type, payload):
+    """Encode the client-facing frame for an event once, for every recipient"""
+    return json.dumps({'type': event_type, **payload})
+
+
+def build_event(event_type, frame):
+    return {
+        'type': event_type,
+        'frame': frame,
+        'origin': [PROCESS_ORIGIN, next(event_numbers)],
+    }
+
+
+async def broadcast(channel_layer, room_name, event_type, payload):
+    """Send an event to a room group as a pre-encoded frame.
+
+    Every group event has the same shape, ``{'type': <handler>, 'frame': <text>,
+    'origin': [process, event number]}``, so consumers just write ``frame``
+    to their socket instead of re-encoding it. The room's replay buffer in
+    this process is updated on the way out.
+    """
+    frame = encode_frame(event_type, payload)
+    replay_buffers.apply(room_name, event_type, payload, len(frame))
+    with group_send_seconds.time():
+        await channel_layer.group_send(group_name(room_name), build_event(event_type, frame))
@@ -0,0 +1,92 @@
+import json
+import threading
+from collections import OrderedDict
+
+import cbor2
+import msgpack
+
+
+class Codec:
+    """Binary encoding for a WebSocket subprotocol; JSON text frames need none"""
+
+    def __init__(self, subprotocol, dumps, loads, array_header):
+        self.subprotocol = subprotocol
+        self.dumps = dumps
+        self.loads = loads
+        # Prefix that turns n concatenated encoded items into an array of them
+        self.array_header = array_header
+
+
+def msgpack_array_header(length):
+    if length < 16:
+        return bytes([0x90 | length])
+    if length < 1 << 16:
+        return b'\xdc' + length.to_bytes(2, 'big')
+    return b'\xdd' + length.to_bytes(4, 'big')
+
+
+def cbor_array_header(length):
+    if length < 24:
+        return bytes([0x80 | length])
+    if length < 1 << 8:
+        return b'\x98' + length.to_bytes(1, 'big')
+    if length < 1 << 16:
+        return b'\x99' + length.to_bytes(2, 'big')
+    return b'\x9a' + length.to_bytes(4, 'big')
+
+
+MSGPACK = Codec('chat.msgpack', lambda data: msgpack.packb(data, use_bin_type=True),
+                lambda data: msgpack.unpackb(data, raw=False), msgpack_array_header)
+CBOR = Codec('chat.cbor', cbor2.dumps, cbor2.loads, cbor_array_header)
+
+# In order of preference when a client offers several
+CODECS = OrderedDict((codec.subprotocol, codec) for codec in (MSGPACK, CBOR))
+JSON_SUBPROTOCOL = 'chat.json'
+
+
+def select_codec(offered):
+    """Pick ``(subprotocol to accept, codec)`` from the subprotocols a client offered.
+
+    The codec is None for JSON, which is used when the client offers no
+    binary subprotocol we speak.
+    """
+    for subprotocol, codec in CODECS.items():
+        if subprotocol in offered:
+            return subprotocol, codec
+    return (JSON_SUBPROTOCOL if JSON_SUBPROTOCOL in offered else None), None
+
+
+class FrameCache:
+    """Binary re-encodings of recently sent JSON frames.
+
+    Group events arrive as one JSON frame (see chat.broadcast) that every
+    socket in the room receives, so each frame is converted once per codec
+    and the bytes are shared by all binary sockets in this process.
+    """
+
+    def __init__(self, max_size=512, max_bytes=8 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def encode(self, codec, frame):
+        key = (codec.subprotocol, frame)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                return data
+        data = codec.dumps(json.loads(frame))
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = data
+                self.size += len(frame) + len(data)
+            while len(self.entries) > self.max_size or self.size > self.max_bytes:
+                (_, old_frame), old_data = self.entries.popitem(last=False)
+                self.size -= len(old_frame) + len(old_data)
+        return data
+
+
+frame_cache = FrameCache()
@@ -1,12 +1,59 @@
+import itertools
 import json
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import Message, Room, Reaction
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Message
+from .archive import archiver, is_archived
+from .broadcast import PROCESS_ORIGIN, broadcast, group_name
+from .codecs import frame_cache, select_codec
+from .dbwriter import database_read_to_async, database_write_to_async
+from .directory import record_deleted, record_messages
+from .events import fetch_events, log_events
+from .history import fetch_page
+from .metrics import events_out, frames_in, rate_limit_closes, rate_limited, websocket_connections
+from .outbound import OutboundQueue
+from .presence import presence_registry
+from .ratelimit import rate_limiter
+from .reactions import apply_toggles
+from .replay import replay_buffers
+from .rooms import room_cache, write_to_room
+from .serializers import serialize_message
+from .threads import record_replies, record_reply_deleted
+from .typing_state import typing_tracker, typing_views
+from .writebehind import message_ids, message_writer
+
+# Operation types counted by name in chat_frames_in_total; anything else a
+# client sends is counted as 'other', so clients cannot add label values
+OPERATION_TYPES = {'chat_message', 'reaction', 'typing', 'edit_message', 'delete_message'}
+
+
+def operation_label(message_type):
+    return message_type if isinstance(message_type, str) and message_type in OPERATION_TYPES else 'other'
+
+
+def reaction_toggle(operation):
+    """Return the ``(message_id, sender, emoji)`` of a reaction operation, or None if it is malformed"""
+    sender, emoji = operation.get('sender'), operation.get('emoji')
+    if not isinstance(sender, str) or not sender or not isinstance(emoji, str) or not 0 < len(emoji) <= 10:
+        return None
+    try:
+        return int(operation['message_id']), sender, emoji
+    except (KeyError, TypeError, ValueError):
+        return None
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = 'chat_%s' % self.room_name
+        self.room_group_name = group_name(self.room_name)
+        await room_cache.start(self.channel_layer)
+        # Resolved once per connection; the room is created by the first message if needed
+        room = await database_read_to_async(room_cache.lookup)(self.room_name)
+        self.room_id = room.id if room else None
 
         # Join room group
         await self.channel_layer.group_add(
@@ -14,18 +61,199 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
+        # Binary subprotocols (chat.msgpack, chat.cbor) save bytes on metered
+        # links; clients that offer none get JSON text frames
+        subprotocol, self.codec = select_codec(self.scope.get('subprotocols', []))
+        await self.accept(subprotocol)
+        self.outbound = OutboundQueue(
+            self.send_data,
+            window=settings.CHAT_SEND_COALESCE_WINDOW,
+            max_bytes=settings.CHAT_SEND_MAX_PENDING_BYTES,
+            codec=self.codec,
+        )
+        self.too_slow = False
+        self.limits = rate_limiter.connection()
+        await rate_limiter.start(self.channel_layer)
+        archiver.start()
+        websocket_connections.inc()
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+
+        # Replay recent messages from this process's buffer for the room;
+        # only the first socket in the room seeds it from the database
+        self.replay_joined = True
+        if replay_buffers.join(self.room_name) and self.room_id is not None:
+            await self.seed_replay()
+
+        # A client reconnecting with ?since=<seq> gets just the events it
+        # missed, from the room's event log, instead of the replay
+        try:
+            since = int(query['since'][0])
+        except (KeyError, ValueError):
+            since = None
+        seq, frames = await database_read_to_async(fetch_events)(self.room_id, since)
+        resume = None
+        if frames is not None:
+            resume = '{"type": "resume", "seq": %d, "events": [%s]}' % (seq, ','.join(frames))
+            if len(resume) > self.outbound.max_bytes // 2:
+                resume = None  # cheaper to reload than to queue that much
+        if resume is not None:
+            events_out.inc(('resume',))
+            await self.send_encoded(resume)
+        else:
+            frame = replay_buffers.replay_frame(self.room_name)
+            if frame:
+                events_out.inc(('message_history',))
+                await self.send_encoded(frame)
+            events_out.inc(('sync',))
+            await self.send_encoded(json.dumps({'type': 'sync', 'seq': seq, 'resync': since is not None}))
+
+        # Connections that name their user (?user=<name>) are listed as online;
+        # everyone gets the current list, then presence_delta events
+        self.user = query.get('user', [''])[0][:255]
+        online = await presence_registry.join(self.channel_layer, self.room_name, self.user, self.channel_name)
+        self.presence_joined = True
+        events_out.inc(('presence',))
+        await self.send_encoded(json.dumps({'type': 'presence', 'online': online}))
 
     async def disconnect(self, close_code):
+        if hasattr(self, 'outbound'):
+            self.outbound.cancel()
+            websocket_connections.dec()
+        if getattr(self, 'presence_joined', False):
+            await presence_registry.leave(self.room_name, self.user, self.channel_name)
+        if getattr(self, 'replay_joined', False):
+            replay_buffers.leave(self.room_name)
+            typing_tracker.drop_channel(self.room_name, self.channel_name)
+
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
+    async def send_encoded(self, frame, typing=False):
+        """Queue a JSON frame, re-encoded for this socket's binary subprotocol if it has one"""
+        if self.too_slow:
+            return
+        data = frame if self.codec is None else frame_cache.encode(self.codec, frame)
+        if not await self.outbound.put(data, typing):
+            # The client is not reading fast enough; drop it rather than buffer without limit
+            self.too_slow = True
+            await self.close(code=1013)
+
+    async def send_data(self, data):
+        if isinstance(data, str):
+            await self.send(text_data=data)
+        else:
+            await self.send(bytes_data=data)
+
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            if self.codec is None:
+                return
+            text_data_json = self.codec.loads(bytes_data)
+        else:
+            text_data_json = json.loads(text_data)
+
+        # A frame may carry a list of operations instead of a single one
+        if isinstance(text_data_json, list):
+            await self.receive_batch(text_data_json[:settings.CHAT_MAX_BATCH_OPERATIONS])
+        else:
+            frames_in.inc((operation_label(text_data_json.get('type', 'chat_message')),))
+            if await self.admit([text_data_json]):
+                await self.handle_operation(text_data_json)
+
+    async def admit(self, operations):
+        """Return the operations within this socket's and their senders' rate limits.
+
+        Each refused operation gets an ``error`` event saying when to retry;
+        a socket that keeps going over its own limits is closed. Refusals
+        for an exhausted sender bucket are not held against the socket:
+        anyone can send as any sender, and could get that sender's own
+        sockets closed.
+        """
+        if self.limits is None:
+            return []
+        admitted = []
+        for operation in operations:
+            operation_type = operation_label(operation.get('type', 'chat_message'))
+            sender = operation.get('sender', 'Anonymous')
+            refused = self.limits.check(operation_type, sender if isinstance(sender, str) else '')
+            if refused is None:
+                admitted.append(operation)
+                continue
+            scope, retry_after = refused
+            rate_limiter.refused += 1
+            rate_limited.inc((operation_type, scope))
+            if scope == 'connection' and self.limits.strike():
+                rate_limiter.closed += 1
+                rate_limit_closes.inc()
+                self.limits = None  # admit nothing more
+                await self.close(code=4029)
+                return []
+            await self.send_encoded(json.dumps({
+                'type': 'error',
+                'code': 'rate_limited',
+                'operation': operation_type,
+                'scope': scope,
+                'retry_after': round(retry_after, 3),
+            }))
+        return admitted
+
+    async def receive_batch(self, operations):
+        operations = [operation for operation in operations if isinstance(operation, dict)]
+        # Counted before admission, like single frames, so refused operations show up too
+        for label, run in itertools.groupby(operations, key=lambda operation: operation_label(operation.get('type', 'chat_message'))):
+            frames_in.inc((label,), sum(1 for _ in run))
+        # Runs of messages or reactions are saved with one database call per run
+        operations = await self.admit(operations)
+        for message_type, run in itertools.groupby(operations, key=lambda operation: operation.get('type', 'chat_message')):
+            run = list(run)
+            if message_type == 'chat_message' and len(run) > 1:
+                await self.receive_chat_messages(run)
+            elif message_type == 'reaction' and len(run) > 1:
+                await self.receive_reactions(run)
+            else:
+                for operation in run:
+                    await self.handle_operation(operation)
+
+    async def receive_chat_messages(self, operations):
+        messages = [
+            (operation.get('sender', 'Anonymous'), operation['message'], operation.get('parent_id'))
+            for operation in operations
+        ]
+        if settings.CHAT_WRITE_BEHIND:
+            payloads = [await self.queue_message(sender, message, self.room_name, parent_id)
+                        for sender, message, parent_id in messages]
+            await self.log_queued([('chat_message', payload) for payload in payloads])
+        else:
+            payloads = await self.save_messages(messages)
+        for payload in payloads:
+            await broadcast(self.channel_layer, self.room_name, 'chat_message', payload)
+
+    async def receive_reactions(self, operations):
+        toggles = []
+        for operation in operations:
+            toggle = reaction_toggle(operation)
+            if toggle is None:
+                # Skipped, so one bad reaction does not cost the rest of the batch
+                await self.send_encoded(json.dumps({'type': 'error', 'code': 'invalid', 'operation': 'reaction'}))
+            else:
+                toggles.append(toggle)
+        if not toggles:
+            return
+        for message_id, _, _ in toggles:
+            await message_writer.wait_for(message_id)
+
+        # Toggle reactions in database and send the new counts to the room group
+        deltas = await self.toggle_reactions(toggles)
+        for delta in deltas:
+            await broadcast(self.channel_layer, self.room_name, 'reaction_delta', delta)
+        changed = {delta['message_id'] for delta in deltas}
+        await self.refuse_archived('reaction', {message_id for message_id, _, _ in toggles} - changed)
+
+    async def handle_operation(self, text_data_json):
         message_type = text_data_json.get('type', 'chat_message')
 
         if message_type == 'chat_message':
@@ -33,217 +261,214 @@ class ChatConsumer(AsyncWebsocketConsumer):
             sender = text_data_json.get('sender', 'Anonymous')
             parent_id = text_data_json.get('parent_id', None)
             
-            # Save message to database
-            db_message = await self.save_message(sender, message, self.room_name, parent_id)
-
-            # Get parent message content if this is a reply
-            parent_content = None
-            parent_sender = None
-            if db_message.parent:
-                parent_content = db_message.parent.content
-                parent_sender = db_message.parent.sender
+            # Save message to database, or queue it for a batched insert
+            if settings.CHAT_WRITE_BEHIND:
+                payload = await self.queue_message(sender, message, self.room_name, parent_id)
+                await self.log_queued([('chat_message', payload)])
+            else:
+                payload = await self.save_message(sender, message, self.room_name, parent_id)
 
             # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'id': db_message.id,
-                    'message': message,
-                    'sender': sender,
-                    'timestamp': str(db_message.timestamp),
-                    'reactions': [],
-                    'parent_id': parent_id,
-                    'parent_content': parent_content,
-                    'parent_sender': parent_sender,
-                    'is_edited': False,
-                    'file_url': None,
-                    'file_type': None,
-                    'file_name': None
-                }
-            )
+            await broadcast(self.channel_layer, self.room_name, 'chat_message', payload)
         elif message_type == 'reaction':
-            message_id = text_data_json['message_id']
-            sender = text_data_json['sender']
-            emoji = text_data_json['emoji']
-
-            # Toggle reaction in database
-            action = await self.toggle_reaction(message_id, sender, emoji)
-
-            if action != 'error':
-                # Send reaction update to room group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'reaction_update',
-                        'message_id': message_id,
-                        'sender': sender,
-                        'emoji': emoji,
-                    }
-                )
+            await self.receive_reactions([text_data_json])
         elif message_type == 'typing':
             sender = text_data_json['sender']
             is_typing = text_data_json['is_typing']
 
-            # Send typing status to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_typing',
-                    'sender': sender,
-                    'is_typing': is_typing
-                }
-            )
+            # Typing state is coalesced and sent to the room as a periodic snapshot
+            typing_tracker.set_typing(self.room_name, self.channel_name, sender, is_typing, time.monotonic())
+            typing_tracker.start(self.channel_layer)
         elif message_type == 'edit_message':
             message_id = text_data_json['message_id']
             new_content = text_data_json['content']
             sender = text_data_json['sender']
 
             # Update message in database
-            success = await self.edit_message(message_id, new_content, sender)
+            await message_writer.wait_for(message_id)
+            payload = await self.edit_message(message_id, new_content, sender)
 
-            if success:
+            if payload is not None:
                 # Send update to room group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'message_edit',
-                        'message_id': message_id,
-                        'content': new_content,
-                        'sender': sender
-                    }
-                )
+                await broadcast(self.channel_layer, self.room_name, 'message_edit', payload)
+            else:
+                await self.refuse_archived('edit_message', [message_id])
         elif message_type == 'delete_message':
             message_id = text_data_json['message_id']
             sender = text_data_json['sender']
 
             # Delete message from database
-            success = await self.delete_message(message_id, sender)
+            await message_writer.wait_for(message_id)
+            payload = await self.delete_message(message_id, sender)
 
-            if success:
+            if payload is not None:
                 # Send delete notification to room group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'message_delete',
-                        'message_id': message_id
-                    }
-                )
-
-    # Receive message from room group
-    async def chat_message(self, event):
-        # Send message to WebSocket
-        # If message comes from HTTP upload, it's already in event['message']
-        if 'message' in event and isinstance(event['message'], dict):
-            msg_data = event['message']
-            await self.send(text_data=json.dumps({
-                'type': 'chat_message',
-                'id': msg_data.get('id'),
-                'message': msg_data.get('content', ''),
-                'sender': msg_data.get('sender'),
-                'timestamp': msg_data.get('timestamp'),
-                'reactions': msg_data.get('reactions', []),
-                'parent_id': msg_data.get('parent_id'),
-                'parent_content': msg_data.get('parent_content'),
-                'parent_sender': msg_data.get('parent_sender'),
-                'is_edited': msg_data.get('is_edited', False),
-                'file_url': msg_data.get('file_url'),
-                'file_type': msg_data.get('file_type'),
-                'file_name': msg_data.get('file_name')
-            }))
-        else:
-            await self.send(text_data=json.dumps({
-                'type': 'chat_message',
-                'id': event.get('id'),
-                'message': event['message'],
-                'sender': event['sender'],
-                'timestamp': event.get('timestamp'),
-                'reactions': event.get('reactions', []),
-                'parent_id': event.get('parent_id'),
-                'parent_content': event.get('parent_content'),
-                'parent_sender': event.get('parent_sender'),
-                'is_edited': event.get('is_edited', False),
-                'file_url': event.get('file_url'),
-                'file_type': event.get('file_type'),
-                'file_name': event.get('file_name')
+                await broadcast(self.channel_layer, self.room_name, 'message_delete', payload)
+            else:
+                await self.refuse_archived('delete_message', [message_id])
+
+    async def refuse_archived(self, operation_type, message_ids):
+        # Archived messages are read-only; tell the client instead of dropping the operation silently
+        for message_id in await self.archived(message_ids):
+            await self.send_encoded(json.dumps({
+                'type': 'error',
+                'code': 'archived',
+                'operation': operation_type,
+                'message_id': message_id,
             }))
 
-    async def reaction_update(self, event):
-        # Send reaction update to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'reaction_update',
-            'message_id': event['message_id'],
-            'sender': event['sender'],
-            'emoji': event['emoji'],
-            'action': event['action']
-        }))
-
-    async def user_typing(self, event):
-        # Send typing status to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'user_typing',
-            'sender': event['sender'],
-            'is_typing': event['is_typing']
-        }))
-
-    async def message_edit(self, event):
-        # Send message edit to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'message_edit',
-            'message_id': event['message_id'],
-            'content': event['content']
-        }))
-
-    async def message_delete(self, event):
-        # Send message deletion to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'message_delete',
-            'message_id': event['message_id']
-        }))
-
-    @database_sync_to_async
+    # Receive events from room group. Frames are encoded once by the sender
+    # (see chat.broadcast), so every handler just forwards the bytes.
+    async def send_frame(self, event):
+        # Events from other worker processes also update this process's replay buffer
+        if event['origin'][0] != PROCESS_ORIGIN:
+            replay_buffers.apply_remote(self.room_name, event)
+        events_out.inc((event['type'],))
+        await self.send_encoded(event['frame'])
+
+    async def room_deleted(self, event):
+        # Tell the client, then hang up; every process's sockets in the room get this
+        room_cache.invalidate(self.room_name)
+        await self.send_frame(event)
+        await self.outbound.flush()
+        await self.close(code=4004)
+
+    async def presence_delta(self, event):
+        events_out.inc(('presence_delta',))
+        await self.send_encoded(event['frame'])
+
+    async def typing_snapshot(self, event):
+        events_out.inc(('typing_snapshot',))
+        await self.send_encoded(typing_views.merge(self.room_name, event, time.monotonic()), typing=True)
+
+    chat_message = send_frame
+    reaction_delta = send_frame
+    message_edit = send_frame
+    message_delete = send_frame
+
+    def current_room_id(self):
+        """This socket's room id, looked up again if the room was only created after it connected"""
+        if self.room_id is None:
+            room = room_cache.lookup(self.room_name)
+            self.room_id = room.id if room else None
+        return self.room_id
+
+    @database_read_to_async
+    def seed_replay(self):
+        messages, _ = fetch_page(self.room_id, replay_buffers.max_messages)
+        replay_buffers.seed(self.room_name, messages)
+
+    @database_write_to_async
     def save_message(self, sender, content, room_name, parent_id=None):
-        room, created = Room.objects.get_or_create(name=room_name)
         parent = None
         if parent_id:
             try:
-                parent = Message.objects.get(id=parent_id)
+                parent = Message.objects.get(id=parent_id, room_id=self.current_room_id())
             except Message.DoesNotExist:
                 pass
-        return Message.objects.create(sender=sender, content=content, room=room, parent=parent)
 
-    @database_sync_to_async
-    def toggle_reaction(self, message_id, sender, emoji):
-        try:
-            message = Message.objects.get(id=message_id)
-            reaction, created = Reaction.objects.get_or_create(
-                message=message,
-                sender=sender,
-                emoji=emoji
-            )
-            if not created:
-                reaction.delete()
-                return 'removed'
-            return 'added'
-        except Message.DoesNotExist:
-            return 'error'
+        def create(room_id):
+            with transaction.atomic():
+                message = Message.objects.create(sender=sender, content=content, room_id=room_id, parent=parent)
+                record_messages(room_id, 1, message.timestamp)
+                record_replies([message.parent_id])
+                payload = serialize_message(message, reaction_counts={})
+                log_events(room_id, [('chat_message', payload)])
+            return payload
+
+        payload, self.room_id = write_to_room(room_name, create, room_id=self.room_id)
+        return payload
+
+    @database_write_to_async
+    def save_messages(self, messages):
+        """Save several ``(sender, content, parent_id)`` messages with one bulk insert"""
+        parents = Message.objects.filter(room_id=self.current_room_id()).in_bulk(
+            {parent_id for _, _, parent_id in messages if parent_id})
+
+        def create(room_id):
+            with transaction.atomic():
+                created = Message.objects.bulk_create([
+                    Message(sender=sender, content=content, room_id=room_id, parent=parents.get(parent_id))
+                    for sender, content, parent_id in messages
+                ])
+                record_messages(room_id, len(created), created[-1].timestamp)
+                record_replies([message.parent_id for message in created])
+                payloads = [serialize_message(message, reaction_counts={}) for message in created]
+                log_events(room_id, [('chat_message', payload) for payload in payloads])
+            return payloads
+
+        payloads, self.room_id = write_to_room(self.room_name, create, room_id=self.room_id)
+        return payloads
+
+    async def queue_message(self, sender, content, room_name, parent_id=None):
+        # Id and timestamp are assigned here so the message can be broadcast
+        # before chat.writebehind inserts it
+        parent = None
+        if parent_id:
+            parent = message_writer.get_pending(parent_id, room_name) or await self.get_message(parent_id)
+        message = Message(
+            id=await message_ids.allocate_async(),
+            sender=sender,
+            content=content,
+            parent=parent,
+            timestamp=timezone.now(),
+        )
+        await message_writer.submit(room_name, message)
+        return serialize_message(message, reaction_counts={})
+
+    @database_write_to_async
+    def log_queued(self, events):
+        # Write-behind inserts the messages later, but their events are
+        # numbered and logged now, before they are broadcast
+        _, self.room_id = write_to_room(self.room_name, lambda room_id: log_events(room_id, events), room_id=self.room_id)
+
+    @database_write_to_async
+    def toggle_reactions(self, toggles):
+        with transaction.atomic():
+            # Only messages of this socket's room can be reacted to
+            deltas = apply_toggles(toggles, self.current_room_id())
+            if deltas:
+                log_events(self.room_id, [('reaction_delta', delta) for delta in deltas])
+        return deltas
+
+    @database_read_to_async
+    def archived(self, message_ids):
+        """The ``message_ids`` that were moved to this room's archive"""
+        room_id = self.current_room_id()
+        if room_id is None:
+            return []
+        return [message_id for message_id in message_ids
+                if isinstance(message_id, int) and is_archived(room_id, message_id)]
+
+    @database_read_to_async
+    def get_message(self, message_id):
+        return Message.objects.filter(id=message_id, room_id=self.current_room_id()).first()
 
-    @database_sync_to_async
+    @database_write_to_async
     def edit_message(self, message_id, new_content, sender):
+        """Returns the numbered message_edit payload, or None if there is no such message of ``sender`` in this room"""
         try:
-            message = Message.objects.get(id=message_id, sender=sender)
-            message.content = new_content
-            message.is_edited = True
-            message.save()
-            return True
+            message = Message.objects.get(id=message_id, sender=sender, room_id=self.current_room_id())
+            payload = {'message_id': message_id, 'content': new_content}
+            with transaction.atomic():
+                message.content = new_content
+                message.is_edited = True
+                message.save()
+                log_events(message.room_id, [('message_edit', payload)])
+            return payload
         except Message.DoesNotExist:
-            return False
+            return None
 
-    @database_sync_to_async
+    @database_write_to_async
     def delete_message(self, message_id, sender):
         try:
-            message = Message.objects.get(id=message_id, sender=sender)
-            message.delete()
-            return True
+            message = Message.objects.get(id=message_id, sender=sender, room_id=self.current_room_id())
+            payload = {'message_id': message_id}
+            with transaction.atomic():
+                message.delete()
+                record_deleted(message.room_id)
+                record_reply_deleted(message.parent_id)
+                log_events(message.room_id, [('message_delete', payload)])
+            return payload
         except Message.DoesNotExist:
-            return False
+            return None
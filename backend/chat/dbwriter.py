@@ -0,0 +1,130 @@
+import asyncio
+import functools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from .metrics import db_run_seconds, db_wait_seconds
+
+
+class DatabaseWriter:
+    """One thread that runs every database write of this process, in order.
+
+    SQLite allows a single writer at a time. Funnelling writes through one
+    thread with its own connection means they wait in a queue here instead
+    of on the database lock, while reads keep running on other threads (WAL
+    lets them see the last committed state). Only other processes still
+    contend for the lock, and the busy timeout in settings covers that.
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+        # Counters
+        self.completed = 0
+        self.failures = 0
+        self.max_wait_ms = 0.0
+        self.total_wait_ms = 0.0
+        self.max_run_ms = 0.0
+        self.total_run_ms = 0.0
+
+    def stats(self):
+        return {
+            'enabled': settings.CHAT_DB_WRITER,
+            'queue_depth': self.jobs.qsize(),
+            'completed': self.completed,
+            'failures': self.failures,
+            'avg_wait_ms': round(self.total_wait_ms / self.completed, 3) if self.completed else 0.0,
+            'max_wait_ms': round(self.max_wait_ms, 3),
+            'avg_run_ms': round(self.total_run_ms / self.completed, 3) if self.completed else 0.0,
+            'max_run_ms': round(self.max_run_ms, 3),
+        }
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.work, name='db-writer', daemon=True)
+                self.thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue ``func(*args, **kwargs)`` and return a Future for its result"""
+        self.start()
+        future = Future()
+        self.jobs.put((future, time.perf_counter(), func, args, kwargs))
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """Run ``func`` on the writer thread and wait for it, from synchronous code.
+
+        Calls made on the writer thread itself, or with the writer turned
+        off, run in place.
+        """
+        if not settings.CHAT_DB_WRITER or threading.current_thread() is self.thread:
+            return func(*args, **kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    async def run(self, func, *args, **kwargs):
+        """Run ``func`` on the writer thread without blocking the event loop"""
+        if not settings.CHAT_DB_WRITER:
+            return await database_sync_to_async(func)(*args, **kwargs)
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def work(self):
+        while True:
+            future, queued, func, args, kwargs = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            # Drops the connection if it has expired or broke, as database_sync_to_async does
+            close_old_connections()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as error:
+                self.failures += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+            finished = time.perf_counter()
+            wait_ms = (started - queued) * 1000
+            run_ms = (finished - started) * 1000
+            self.completed += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            self.total_run_ms += run_ms
+            self.max_run_ms = max(self.max_run_ms, run_ms)
+            db_wait_seconds.observe(started - queued, ('writer',))
+            db_run_seconds.observe(finished - started, ('writer',))
+
+
+db_writer = DatabaseWriter()
+
+
+def database_write_to_async(func):
+    """Like ``database_sync_to_async``, but runs ``func`` on the writer thread"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await db_writer.run(func, *args, **kwargs)
+    return wrapper
+
+
+def database_read_to_async(func):
+    """``database_sync_to_async`` on a pooled thread, so reads run side by side"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        queued = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            db_wait_seconds.observe(started - queued, ('read',))
+            try:
+                return func(*args, **kwargs)
+            finally:
+                db_run_seconds.observe(time.perf_counter() - started, ('read',))
+        return await database_sync_to_async(timed, thread_sensitive=False)()
+    return wrapper
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Max, Sum
+
+from .models import ArchiveSegment, Message, Room
+from .presence import presence_registry
+
+# Sorts after every character a room name can contain, so a prefix match is
+# a range scan on the unique index of Room.name
+PREFIX_END = '\U0010ffff'
+
+
+def record_messages(room_id, count, timestamp):
+    """Count ``count`` new messages in a room, the newest sent at ``timestamp``"""
+    Room.objects.filter(id=room_id).update(message_count=F('message_count') + count, last_activity=timestamp)
+    transaction.on_commit(room_directory.changed)
+
+
+def record_deleted(room_id):
+    Room.objects.filter(id=room_id).update(message_count=F('message_count') - 1)
+    transaction.on_commit(room_directory.changed)
+
+
+def fetch_rooms(prefix, after, limit):
+    """Return ``(rooms, next_after)`` for one page of the directory, in name order.
+
+    Pages are keyed on the name of the last room, like message history is
+    keyed on id; ``next_after`` is None on the last page.
+    """
+    queryset = Room.objects.filter(deleted_at__isnull=True)
+    if prefix:
+        queryset = queryset.filter(name__gte=prefix, name__lt=prefix + PREFIX_END)
+    if after is not None:
+        queryset = queryset.filter(name__gt=after)
+    page = list(
+        queryset.order_by('name')
+        .values('id', 'name', 'created_by', 'message_count', 'last_activity')[:limit + 1]
+    )
+    has_more = len(page) > limit
+    page = page[:limit]
+    for room in page:
+        if room['last_activity'] is not None:
+            room['last_activity'] = room['last_activity'].isoformat()
+    return page, page[-1]['name'] if has_more else None
+
+
+class RoomDirectory:
+    """Recently served directory pages.
+
+    Room changes made by this process bump ``version`` once they commit,
+    which invalidates every cached page at once. Changes made by other
+    processes are picked up when a page is older than ``max_age`` seconds.
+    The ETag is a hash of the page as served, so it stays correct either way.
+    """
+
+    def __init__(self, max_pages=1000, max_age=5.0):
+        self.max_pages = max_pages
+        self.max_age = max_age
+        self.version = 0
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def changed(self):
+        with self.lock:
+            self.version += 1
+
+    def page(self, prefix, after, limit):
+        """Return ``(etag, body)`` for a page, reading the database only if the cached rooms are stale.
+
+        Online counts come from the presence registry on every call, so
+        they are always current without invalidating the cache.
+        """
+        key = (prefix, after, limit)
+        with self.lock:
+            cached = self.pages.get(key)
+            if cached is not None and cached[0] == self.version and time.monotonic() - cached[1] < self.max_age:
+                self.pages.move_to_end(key)
+                self.hits += 1
+                rooms, next_after = cached[2], cached[3]
+            else:
+                cached = None
+                self.misses += 1
+                version = self.version
+        if cached is None:
+            rooms, next_after = fetch_rooms(prefix, after, limit)
+            with self.lock:
+                self.pages[key] = (version, time.monotonic(), rooms, next_after)
+                self.pages.move_to_end(key)
+                while len(self.pages) > self.max_pages:
+                    self.pages.popitem(last=False)
+        body = json.dumps({
+            'rooms': [{**room, 'online': presence_registry.count(room['name'])} for room in rooms],
+            'next_after': next_after,
+        })
+        return '"%s"' % hashlib.sha1(body.encode()).hexdigest(), body
+
+    def stats(self):
+        with self.lock:
+            return {'version': self.version, 'pages': len(self.pages), 'hits': self.hits, 'misses': self.misses}
+
+
+room_directory = RoomDirectory(
+    max_pages=settings.CHAT_DIRECTORY_CACHE_PAGES,
+    max_age=settings.CHAT_DIRECTORY_CACHE_MAX_AGE,
+)
+
+
+def rebuild_room_stats(dry_run=False):
+    """Recount every room's messages; returns how many rooms were wrong.
+
+    ``last_activity`` is only moved forward: deleting the newest message
+    does not make a room less recently active.
+    """
+    actual = {
+        row['room_id']: (row['n'], row['last'])
+        for row in Message.objects.filter(room__isnull=False).values('room_id').annotate(n=Count('id'), last=Max('timestamp'))
+    }
+    # Archived messages (chat.archive) still count
+    for row in ArchiveSegment.objects.values('room_id').annotate(n=Sum('message_count'), last=Max('last_timestamp')):
+        count, last = actual.get(row['room_id'], (0, None))
+        actual[row['room_id']] = (count + row['n'], max(filter(None, (last, row['last']))))
+    wrong = 0
+    with transaction.atomic():
+        for room_id, message_count, last_activity in Room.objects.values_list('id', 'message_count', 'last_activity'):
+            count, last = actual.get(room_id, (0, None))
+            if last_activity is not None and (last is None or last_activity > last):
+                last = last_activity
+            if (message_count, last_activity) != (count, last):
+                wrong += 1
+                if not dry_run:
+                    Room.objects.filter(id=room_id).update(message_count=count, last_activity=last)
+        if wrong and not dry_run:
+            transaction.on_commit(room_directory.changed)
+    return wrong
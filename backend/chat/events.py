@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .broadcast import encode_frame
+from .models import Room, RoomEvent
+
+
+def log_events(room_id, events):
+    """Number ``[(event_type, payload)]`` and add them to the room's event log.
+
+    Logged are the events that change what a room shows: chat_message,
+    message_edit, message_delete and reaction_delta, not typing or presence.
+
+    Each payload gets its ``seq``, one higher than the room's previous
+    event, so the caller broadcasts the numbered payload. Call it in the
+    transaction that makes the change, on the writer thread: the room row
+    is locked from the first UPDATE on, so numbers are handed out in commit
+    order across processes. Raises IntegrityError if the room is gone, like
+    any other write to a deleted room (see chat.rooms.write_to_room).
+    Messages without a room are not logged.
+    """
+    if not events or room_id is None:
+        return
+    with transaction.atomic():
+        if not Room.objects.filter(id=room_id).update(last_seq=F('last_seq') + len(events)):
+            raise IntegrityError('Room %s does not exist' % room_id)
+        last = Room.objects.filter(id=room_id).values_list('last_seq', flat=True).get()
+        first = last - len(events) + 1
+        rows = []
+        for seq, (event_type, payload) in enumerate(events, first):
+            payload['seq'] = seq
+            rows.append(RoomEvent(room_id=room_id, seq=seq, frame=encode_frame(event_type, payload)))
+        RoomEvent.objects.bulk_create(rows)
+        # Trim in steps of a tenth of the log, so most writes skip the DELETE
+        size = settings.CHAT_EVENT_LOG_SIZE
+        step = max(1, size // 10)
+        if last // step != (first - 1) // step:
+            RoomEvent.objects.filter(room_id=room_id, seq__lte=last - size).delete()
+
+
+def fetch_events(room_id, since):
+    """Return ``(last_seq, frames)`` for the events of a room after ``since``.
+
+    ``frames`` is None when there is nothing to resume from (``since`` is
+    None) or the log cannot fill the gap: events after ``since`` were
+    already trimmed, or ``since`` is ahead of the room (the client saw a
+    room of the same name that has since been deleted).
+    """
+    last = Room.objects.filter(id=room_id).values_list('last_seq', flat=True).first() if room_id else None
+    if last is None:
+        return 0, [] if since == 0 else None
+    if since is None or since > last:
+        return last, None
+    if since == last:
+        return last, []
+    events = list(RoomEvent.objects.filter(room_id=room_id, seq__gt=since).order_by('seq').values_list('seq', 'frame'))
+    if not events or events[0][0] != since + 1:
+        return last, None
+    return events[-1][0], [frame for _, frame in events]
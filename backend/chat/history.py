@@ -0,0 +1,31 @@
+from .archive import archived_segments, segment_store
+from .models import Message
+from .serializers import serialize_message
+
+
+def fetch_page(room_id, limit, before=None):
+    """Return ``(messages, next_before)`` for one page of a room's history.
+
+    Pages walk backwards with keyset pagination on (room_id, id); messages
+    within a page are oldest first, the order clients render them in.
+    ``next_before`` is None once there is no older history. Archived
+    messages (chat.archive) are merged in by id, so a page can hold both.
+    """
+    queryset = Message.objects.filter(room_id=room_id)
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    # Fetch one extra row to know whether another page exists
+    page = list(
+        queryset.order_by('-id')
+        .select_related('parent')
+        .prefetch_related('reaction_counts')[:limit + 1]
+    )
+    newest = [serialize_message(message) for message in page]
+    segments = archived_segments(room_id, before)
+    # Segment files are only opened when the page reaches back into them
+    if segments and (len(page) <= limit or page[-1].id < segments[0][2]):
+        newest.extend(segment_store.read(segments, before, limit + 1))
+        newest.sort(key=lambda message: message['id'], reverse=True)
+    has_more = len(newest) > limit
+    newest = newest[:limit]
+    return newest[::-1], newest[-1]['id'] if has_more else None
@@ -0,0 +1,346 @@
+import asyncio
+import os
+import random
+import string
+import struct
+import time
+import weakref
+
+import msgpack
+from channels.layers import InMemoryChannelLayer
+
+DEFAULT_SOCKET_PATH = '/tmp/chat-channel-broker.sock'
+
+# Frames on the broker socket are a 4-byte big-endian length followed by a msgpack array
+HEADER = struct.Struct('!I')
+
+# How often a worker scans its queues for expired messages (seconds). The
+# in-memory layer scans on every receive, which is O(channels) per message.
+CLEAN_INTERVAL = 1.0
+RECONNECT_DELAY = 0.5
+
+
+def pack_frame(*fields):
+    body = msgpack.packb(fields, use_bin_type=True)
+    return HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return msgpack.unpackb(await reader.readexactly(length), raw=False)
+
+
+def channel_worker(channel):
+    """Return the worker id a process-specific channel belongs to, or None"""
+    local, separator, _ = channel.partition('!')
+    if not separator:
+        return None
+    return local.rsplit('.', 1)[-1]
+
+
+def random_suffix(length):
+    return ''.join(random.choice(string.ascii_letters) for _ in range(length))
+
+
+class ChannelBroker:
+    """Routes channel layer traffic between worker processes on one host.
+
+    Group membership lives here, grouped by the worker that owns each
+    channel, so a group_send from any worker costs one delivery frame per
+    worker process rather than one per channel. Message payloads are
+    forwarded as opaque bytes and never decoded by the broker.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, group_expiry=86400, max_buffer=8 * 1024 * 1024):
+        self.path = path
+        self.group_expiry = group_expiry
+        self.max_buffer = max_buffer
+        self.workers = {}  # worker id -> StreamWriter
+        self.groups = {}  # group -> {worker id -> {channel: joined at}}
+        self.dropped = 0
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle_worker, path=self.path)
+        sweeper = asyncio.create_task(self.expire_groups())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sweeper.cancel()
+
+    async def handle_worker(self, reader, writer):
+        worker_id = None
+        try:
+            while True:
+                op, *args = await read_frame(reader)
+                if op == 'hello':
+                    worker_id = args[0]
+                    self.workers[worker_id] = writer
+                elif op == 'add':
+                    self.group_add(*args)
+                elif op == 'discard':
+                    self.group_discard(*args)
+                elif op == 'discard_all':
+                    self.discard_channel(*args)
+                elif op == 'group_send':
+                    self.group_send(*args)
+                elif op == 'send':
+                    channel, payload = args
+                    self.forward(channel_worker(channel), [channel], payload)
+                elif op == 'flush':
+                    self.groups = {}
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # A worker that went away takes its channels with it. If it has
+            # already reconnected, the new connection owns the memberships.
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+                self.forget_worker(worker_id)
+            writer.close()
+
+    def group_add(self, group, channel):
+        members = self.groups.setdefault(group, {}).setdefault(channel_worker(channel), {})
+        members[channel] = time.time()
+
+    def group_discard(self, group, channel):
+        by_worker = self.groups.get(group)
+        if not by_worker:
+            return
+        worker_id = channel_worker(channel)
+        members = by_worker.get(worker_id)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del by_worker[worker_id]
+        if not by_worker:
+            del self.groups[group]
+
+    def discard_channel(self, channel):
+        for group in list(self.groups):
+            self.group_discard(group, channel)
+
+    def forget_worker(self, worker_id):
+        for group, by_worker in list(self.groups.items()):
+            by_worker.pop(worker_id, None)
+            if not by_worker:
+                del self.groups[group]
+
+    def group_send(self, group, payload):
+        for worker_id, members in self.groups.get(group, {}).items():
+            self.forward(worker_id, list(members), payload)
+
+    def forward(self, worker_id, channels, payload):
+        writer = self.workers.get(worker_id)
+        if writer is None:
+            return
+        # A worker that stops reading is treated like a full channel: the
+        # message is dropped instead of buffering without bound.
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            self.dropped += 1
+            return
+        writer.write(pack_frame('deliver', channels, payload))
+
+    async def expire_groups(self):
+        while True:
+            await asyncio.sleep(min(self.group_expiry, 60))
+            cutoff = time.time() - self.group_expiry
+            for group, by_worker in list(self.groups.items()):
+                for worker_id, members in list(by_worker.items()):
+                    for channel, joined_at in list(members.items()):
+                        if joined_at < cutoff:
+                            del members[channel]
+                    if not members:
+                        del by_worker[worker_id]
+                if not by_worker:
+                    del self.groups[group]
+
+
+class _BrokerLink:
+    """One event loop's connection to the broker.
+
+    Each link registers as its own worker, so every channel it creates is
+    delivered straight into queues owned by that loop.
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.worker_id = '%d%s' % (os.getpid(), random_suffix(8))
+        self.memberships = set()
+        self.writer = None
+        self.ready = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    @property
+    def connected(self):
+        return self.ready.is_set()
+
+    async def ensure_connected(self):
+        if self.task is None:
+            async with self.lock:
+                if self.task is None:
+                    # The first connection raises if the broker is not running
+                    reader = await self.connect()
+                    self.task = asyncio.create_task(self.run(reader))
+        await self.ready.wait()
+
+    async def connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.layer.path)
+        writer.write(pack_frame('hello', self.worker_id))
+        # Replay memberships so a restarted broker keeps routing to us
+        for group, channel in self.memberships:
+            writer.write(pack_frame('add', group, channel))
+        await writer.drain()
+        self.writer = writer
+        self.ready.set()
+        return reader
+
+    async def run(self, reader):
+        while True:
+            try:
+                while True:
+                    _, channels, payload = await read_frame(reader)
+                    message = msgpack.unpackb(payload, raw=False)
+                    for channel in channels:
+                        self.layer.deliver(channel, message)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            # Writers wait on ``ready`` until the broker is back
+            self.ready.clear()
+            self.writer.close()
+            while True:
+                await asyncio.sleep(RECONNECT_DELAY)
+                try:
+                    reader = await self.connect()
+                    break
+                except OSError:
+                    continue
+
+    async def write(self, *fields):
+        await self.ensure_connected()
+        self.writer.write(pack_frame(*fields))
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            # Lost with the connection; run() reconnects
+            pass
+
+    def close(self):
+        self.ready.clear()
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class BrokerChannelLayer(InMemoryChannelLayer):
+    """Channel layer that spans several worker processes on one host, no Redis needed.
+
+    Each process keeps its own channel queues (with the in-memory layer's
+    expiry and capacity rules) while group membership is tracked centrally
+    by a ChannelBroker listening on a Unix-domain socket. Start the broker
+    with ``manage.py run_channel_broker`` before the workers.
+
+    Channels without a process-specific ``!`` part stay local to the process.
+    Sends to channels in other processes are fire-and-forget, so a full
+    remote channel drops the message instead of raising ChannelFull.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, group_expiry=group_expiry, capacity=capacity,
+                         channel_capacity=channel_capacity, **kwargs)
+        self.path = path
+        self.links = weakref.WeakKeyDictionary()  # event loop -> _BrokerLink
+        self.cleaned_at = 0.0
+
+    async def link(self):
+        loop = asyncio.get_running_loop()
+        link = self.links.get(loop)
+        if link is None:
+            link = self.links[loop] = _BrokerLink(self)
+        await link.ensure_connected()
+        return link
+
+    def local_link(self, channel):
+        """Return the current loop's link if it owns ``channel``"""
+        link = self.links.get(asyncio.get_running_loop())
+        if link is not None and channel_worker(channel) == link.worker_id:
+            return link
+        return None
+
+    def deliver(self, channel, message):
+        # Every channel in a delivery shares the decoded message, which
+        # consumers only read, so the per-channel deepcopy is skipped.
+        queue = self.channels.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+        try:
+            queue.put_nowait((time.time() + self.expiry, message))
+        except asyncio.QueueFull:
+            pass
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        if channel_worker(channel) is None or self.local_link(channel) is not None:
+            await super().send(channel, message)
+            return
+        link = await self.link()
+        await link.write('send', channel, msgpack.packb(message, use_bin_type=True))
+
+    async def new_channel(self, prefix='specific.'):
+        link = await self.link()
+        return '%s%s!%s' % (prefix, link.worker_id, random_suffix(12))
+
+    def _clean_expired(self):
+        now = time.monotonic()
+        if now - self.cleaned_at < CLEAN_INTERVAL:
+            return
+        self.cleaned_at = now
+        super()._clean_expired()
+
+    def _remove_from_groups(self, channel):
+        # Called when a message on ``channel`` expires unread
+        link = self.local_link(channel)
+        if link is None:
+            return
+        link.memberships = {(group, member) for group, member in link.memberships if member != channel}
+        if link.connected:
+            link.writer.write(pack_frame('discard_all', channel))
+
+    async def flush(self):
+        await super().flush()
+        link = await self.link()
+        link.memberships.clear()
+        await link.write('flush')
+
+    async def close(self):
+        link = self.links.pop(asyncio.get_running_loop(), None)
+        if link is not None:
+            link.close()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        link = await self.link()
+        link.memberships.add((group, channel))
+        await link.write('add', group, channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        link = await self.link()
+        link.memberships.discard((group, channel))
+        await link.write('discard', group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+        link = await self.link()
+        await link.write('group_send', group, msgpack.packb(message, use_bin_type=True))
@@ -0,0 +1,64 @@
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from chat.archive import archive_chunk, rooms_to_archive
+from chat.models import ArchiveSegment, Message
+
+
+class Command(BaseCommand):
+    help = 'Move old messages out of the Message table into per-room segment files under CHAT_ARCHIVE_DIR'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CHAT_ARCHIVE_AFTER_DAYS,
+                            help='Archive messages older than this many days')
+        parser.add_argument('--chunk-size', type=int, default=settings.CHAT_ARCHIVE_SEGMENT_MESSAGES,
+                            help='Messages per transaction and segment file')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many messages are old enough')
+        parser.add_argument('--vacuum', action='store_true',
+                            help='VACUUM the database afterwards so the file shrinks (locks it while running)')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        if options['dry_run']:
+            rooms = rooms_to_archive(cutoff)
+            old = Message.objects.filter(timestamp__lt=cutoff, blob__isnull=True).filter(Q(file__isnull=True) | Q(file=''))
+            # Counted room by room, so each count is a range of the (room, timestamp) index
+            count = sum(old.filter(room_id=room_id).count() for room_id in rooms)
+            self.stdout.write('Up to %d messages in %d rooms are old enough' % (count, len(rooms)))
+            return
+
+        archived = segments = 0
+        for room_id in rooms_to_archive(cutoff):
+            after = 0
+            while after is not None:
+                moved, after = archive_chunk(room_id, cutoff, options['chunk_size'], after)
+                if moved:
+                    archived += moved
+                    segments += 1
+                    self.stdout.write('%d messages archived' % archived, ending='\r')
+
+        # Files with no segment row: left by a run that stopped before its transaction committed
+        orphans = 0
+        known = set(ArchiveSegment.objects.values_list('path', flat=True))
+        for directory, _, files in os.walk(settings.CHAT_ARCHIVE_DIR):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                name = os.path.relpath(path, settings.CHAT_ARCHIVE_DIR).replace(os.sep, '/')
+                if name in known or os.path.getmtime(path) > time.time() - 3600:
+                    continue
+                orphans += 1
+                os.remove(path)
+
+        self.stdout.write('Archived %d messages into %d segment files; deleted %d orphaned files' % (
+            archived, segments, orphans))
+        if options['vacuum']:
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+            self.stdout.write('Vacuumed the database')
@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.models import Message
+from chat.thumbnails import attach, generate, supported_types
+
+
+class Command(BaseCommand):
+    help = 'Make thumbnails and poster frames for media messages that do not have one yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.CHAT_THUMBNAIL_WORKERS,
+                            help='Files converted in parallel')
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many files')
+
+    def handle(self, *args, **options):
+        # One job per stored file; messages sharing a file get the same thumbnail
+        files = (
+            Message.objects.filter(thumbnail__isnull=True, file_type__in=supported_types())
+            .exclude(file='')
+            .exclude(file__isnull=True)
+            .values_list('file', 'file_type')
+            .distinct()
+        )
+        if options['limit']:
+            files = files[:options['limit']]
+
+        def convert(job):
+            file_name, file_type = job
+            try:
+                return file_name, generate(file_name, file_type, settings.CHAT_THUMBNAIL_SIZE), None
+            except Exception as error:
+                return file_name, None, error
+
+        done = failed = 0
+        # Clients pick the thumbnails up from history; nothing is broadcast from here
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            for file_name, thumbnail, error in pool.map(convert, list(files)):
+                if error is not None:
+                    failed += 1
+                    self.stderr.write('%s: %s' % (file_name, error))
+                    continue
+                attach(file_name, thumbnail)
+                done += 1
+        self.stdout.write('Made %d thumbnails, %d failed' % (done, failed))
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.broadcast import build_event, encode_frame, group_name
+from chat.consumers import ChatConsumer
+from chat.outbound import OutboundQueue, flusher
+
+PAYLOAD = {
+    'id': 123456,
+    'message': 'The quick brown fox jumps over the lazy dog. ' * 4,
+    'sender': 'benchmark-user',
+    'timestamp': '2026-01-01T12:00:00.000000+00:00',
+    'reactions': [],
+    'parent_id': 123450,
+    'parent_content': 'Earlier message being replied to',
+    'parent_sender': 'someone-else',
+    'is_edited': False,
+    'file_url': None,
+    'file_type': None,
+    'file_name': None,
+}
+
+
+async def legacy_chat_message(consumer, event):
+    # The pre-fan-out handler: every recipient re-encodes the same event
+    await consumer.send(text_data=json.dumps({
+        'type': 'chat_message',
+        'id': event.get('id'),
+        'message': event['message'],
+        'sender': event['sender'],
+        'timestamp': event.get('timestamp'),
+        'reactions': event.get('reactions', []),
+        'parent_id': event.get('parent_id'),
+        'parent_content': event.get('parent_content'),
+        'parent_sender': event.get('parent_sender'),
+        'is_edited': event.get('is_edited', False),
+        'file_url': event.get('file_url'),
+        'file_type': event.get('file_type'),
+        'file_name': event.get('file_name')
+    }))
+
+
+async def drained(window=0):
+    task = flusher(window).task
+    if task is not None and not task.done():
+        await task
+
+class Command(BaseCommand):
+    help = 'Measure CPU time per chat_message broadcast against room size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,500,1000,2000',
+                            help='Comma separated room sizes to measure')
+        parser.add_argument('--rounds', type=int, default=20,
+                            help='Broadcasts per room size')
+        parser.add_argument('--window', type=float, default=0,
+                            help='Coalescing window of the fan-out sockets (CHAT_SEND_COALESCE_WINDOW)')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        self.stdout.write('CPU ms per broadcast; "encode" is serialization plus per-socket handlers, '
+                          '"total" adds channel layer delivery')
+        self.stdout.write('%8s %14s %14s %8s %14s %14s' % (
+            'members', 'legacy encode', 'fan-out encode', 'speedup', 'legacy total', 'fan-out total'))
+        slower = []
+        for size in sizes:
+            legacy_encode, legacy_total = asyncio.run(self.measure(size, options['rounds'], legacy=True))
+            fanout_encode, fanout_total = asyncio.run(self.measure(size, options['rounds'], legacy=False, window=options['window']))
+            self.stdout.write('%8d %14.3f %14.3f %7.1fx %14.3f %14.3f' % (
+                size, legacy_encode * 1000, fanout_encode * 1000, legacy_encode / fanout_encode,
+                legacy_total * 1000, fanout_total * 1000))
+            if fanout_encode >= legacy_encode and not options['window']:
+                slower.append(size)
+        # The send path sits under every broadcast; a change that makes it cost more than
+        # encoding per socket is a regression. A window adds a timer per broadcast, so small
+        # rooms may legitimately be slower with one.
+        if slower:
+            raise CommandError('Fan-out was no faster than per-socket encoding for %s members' % ', '.join(map(str, slower)))
+
+    async def measure(self, size, rounds, legacy, window=0):
+        """Return (encode, total) CPU seconds per broadcast"""
+        layer = InMemoryChannelLayer(capacity=rounds + 1)
+        room_name = 'bench'
+        consumers = []
+        for _ in range(size):
+            channel = await layer.new_channel()
+            await layer.group_add(group_name(room_name), channel)
+            consumer = ChatConsumer()
+            consumer.base_send = self.discard
+            consumer.codec = None
+            consumer.too_slow = False
+            consumer.room_name = room_name
+            consumer.outbound = OutboundQueue(consumer.send_data, window=window)
+            consumers.append((channel, consumer))
+
+        encode = total = 0.0
+        for _ in range(rounds):
+            started = time.process_time()
+            if legacy:
+                event = {'type': 'chat_message', **PAYLOAD}
+            else:
+                # Same event chat.broadcast.broadcast() sends, built inline to time the encoding alone
+                event = build_event('chat_message', encode_frame('chat_message', PAYLOAD))
+                encode += time.process_time() - started
+            await layer.group_send(group_name(room_name), event)
+            events = [(consumer, await layer.receive(channel)) for channel, consumer in consumers]
+            handled = time.process_time()
+            for consumer, event in events:
+                if legacy:
+                    await legacy_chat_message(consumer, event)
+                else:
+                    await consumer.chat_message(event)
+            if not legacy:
+                # Idle queues with no window send inline; the others wait for their flusher
+                await drained(window)
+            finished = time.process_time()
+            encode += finished - handled
+            total += finished - started
+        return encode / rounds, total / rounds
+
+    @staticmethod
+    async def discard(message):
+        pass
+
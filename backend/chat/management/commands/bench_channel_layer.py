@@ -0,0 +1,95 @@
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.broadcast import build_event, encode_frame
+from chat.layers import BrokerChannelLayer, ChannelBroker
+
+GROUP = 'chat_bench'
+
+
+def run_broker(path):
+    asyncio.run(ChannelBroker(path=path).serve())
+
+
+def run_worker(path, members, sends, broadcasts, barrier, results):
+    results.put(asyncio.run(worker(path, members, sends, broadcasts, barrier)))
+
+
+async def worker(path, members, sends, broadcasts, barrier):
+    """Join ``members`` channels to the group, send ``sends`` messages and drain every channel"""
+    layer = BrokerChannelLayer(path=path, capacity=broadcasts + 1)
+    channels = [await layer.new_channel() for _ in range(members)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+
+    async def drain(channel, count):
+        for _ in range(count):
+            event = await layer.receive(channel)
+            # Stand-in for the consumer writing the frame to its socket
+            event['frame'].encode()
+
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    started = time.time()
+    receivers = [asyncio.create_task(drain(channel, broadcasts)) for channel in channels]
+    frame = encode_frame('chat_message', {'message': 'x' * 200, 'sender': 'bench'})
+    for _ in range(sends):
+        await layer.group_send(GROUP, build_event('chat_message', frame))
+    await asyncio.gather(*receivers)
+    finished = time.time()
+    await layer.close()
+    return started, finished, members * broadcasts
+
+
+class Command(BaseCommand):
+    help = 'Load test BrokerChannelLayer group fan-out across worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default='1,2,4',
+                            help='Comma separated worker process counts to measure')
+        parser.add_argument('--members', type=int, default=2000,
+                            help='Room members, split evenly across workers')
+        parser.add_argument('--broadcasts', type=int, default=200,
+                            help='Group messages per run, split evenly across workers')
+
+    def handle(self, *args, **options):
+        path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        context = multiprocessing.get_context('fork')
+        broker = context.Process(target=run_broker, args=(path,), daemon=True)
+        broker.start()
+        while not os.path.exists(path):
+            time.sleep(0.01)
+
+        self.stdout.write('%d CPUs, %d members, %d broadcasts' % (
+            os.cpu_count(), options['members'], options['broadcasts']))
+        self.stdout.write('%8s %12s %18s' % ('workers', 'seconds', 'deliveries/sec'))
+        try:
+            for workers in [int(count) for count in options['workers'].split(',')]:
+                seconds, delivered = self.measure(context, path, workers, options['members'],
+                                                  options['broadcasts'])
+                self.stdout.write('%8d %12.3f %18.0f' % (workers, seconds, delivered / seconds))
+        finally:
+            broker.terminate()
+
+    def measure(self, context, path, workers, members, broadcasts):
+        barrier = context.Barrier(workers)
+        results = context.Queue()
+        sends = [broadcasts // workers + (1 if index < broadcasts % workers else 0)
+                 for index in range(workers)]
+        processes = [
+            context.Process(target=run_worker, args=(
+                path, members // workers, sends[index], broadcasts, barrier, results))
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        reports = [results.get(timeout=600) for _ in processes]
+        for process in processes:
+            process.join()
+        started = min(report[0] for report in reports)
+        finished = max(report[1] for report in reports)
+        return finished - started, sum(report[2] for report in reports)
@@ -0,0 +1,59 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from chat.codecs import CODECS
+
+MESSAGE = {
+    'id': 123456,
+    'message': 'Are we still on for dinner tonight? I can book the place near the station.',
+    'sender': 'benchmark-user',
+    'timestamp': '2026-01-01T12:00:00.000000+00:00',
+    'reaction_counts': {'👍': 3, '😂': 1},
+    'parent_id': 123450,
+    'parent_content': 'Earlier message being replied to',
+    'parent_sender': 'someone-else',
+    'is_edited': False,
+    'file_url': None,
+    'file_type': None,
+    'file_name': None,
+    'thumbnail_url': None,
+}
+
+EVENTS = {
+    'chat_message': {'type': 'chat_message', **MESSAGE},
+    'reaction_delta': {'type': 'reaction_delta', 'message_id': 123456, 'sender': 'alice',
+                       'added': ['👍'], 'removed': [], 'counts': {'👍': 3}},
+    'typing_snapshot': {'type': 'typing_snapshot', 'typing': ['alice', 'bob']},
+    'message_edit': {'type': 'message_edit', 'message_id': 123456, 'content': 'Dinner at 8 instead?'},
+    'message_delete': {'type': 'message_delete', 'message_id': 123456},
+    'message_history': {'type': 'message_history',
+                        'messages': [dict(MESSAGE, id=123400 + index) for index in range(50)]},
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare frame size and encode/decode time of JSON, msgpack and CBOR for each event type'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        formats = [('json', lambda data: json.dumps(data).encode(), json.loads)]
+        formats += [(name, codec.dumps, codec.loads) for name, codec in CODECS.items()]
+
+        self.stdout.write('%-16s %-13s %8s %7s %10s %10s' % ('event', 'format', 'bytes', 'vs json', 'encode us', 'decode us'))
+        for event_type, event in EVENTS.items():
+            # The large history frame gets fewer rounds
+            rounds = iterations if event_type != 'message_history' else max(1, iterations // 50)
+            json_size = None
+            for name, dumps, loads in formats:
+                encoded = dumps(event)
+                assert loads(encoded) == event
+                json_size = json_size or len(encoded)
+                encode = timeit.timeit(lambda: dumps(event), number=rounds) / rounds * 1e6
+                decode = timeit.timeit(lambda: loads(encoded), number=rounds) / rounds * 1e6
+                self.stdout.write('%-16s %-13s %8d %6.0f%% %10.2f %10.2f' % (
+                    event_type, name, len(encoded), 100.0 * len(encoded) / json_size, encode, decode))
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections, transaction
+
+from chat.dbwriter import db_writer
+from chat.history import fetch_page
+from chat.models import Message, Room
+
+ROOM_NAME = 'bench-db-writes'
+# Django's own SQLite defaults: deferred transactions and a 5 second busy timeout
+STOCK_OPTIONS = {'timeout': 5}
+
+
+def write_message(room_id, number):
+    # Read then write in one transaction, like a reply being saved
+    with transaction.atomic():
+        parent_id = Message.objects.filter(room_id=room_id).order_by('-id').values_list('id', flat=True).first()
+        Message.objects.create(room_id=room_id, sender='bench', content='message %d' % number, parent_id=parent_id)
+
+
+def read_page(room_id):
+    fetch_page(room_id, 50)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class Command(BaseCommand):
+    help = 'Hammer the database with concurrent writes and reads and report lock errors and latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=64, help='Concurrent writing clients')
+        parser.add_argument('--writes', type=int, default=50, help='Writes per client')
+        parser.add_argument('--readers', type=int, default=4, help='Concurrent clients loading history meanwhile')
+        parser.add_argument('--read-interval', type=float, default=0.01, help='Seconds each reader waits between pages')
+        parser.add_argument('--threads', type=int, default=32, help='Database threads for the stock and direct modes')
+        parser.add_argument('--mode', choices=['stock', 'direct', 'writer'], action='append',
+                            help='stock: Django defaults, one thread per write; direct: tuned settings, one thread '
+                                 'per write; writer: tuned settings, writes through chat.dbwriter (default: all)')
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            journal_mode = cursor.fetchone()[0]
+        self.stdout.write('journal_mode=%s, %d writers x %d writes, %d readers' % (
+            journal_mode, options['writers'], options['writes'], options['readers']))
+        self.stdout.write('%-8s %8s %8s %10s %10s %10s %10s %12s' % (
+            'mode', 'writes', 'locked', 'p50 ms', 'p99 ms', 'max ms', 'writes/s', 'read p99 ms'))
+        room, _ = Room.objects.get_or_create(name=ROOM_NAME)
+        try:
+            for mode in options['mode'] or ['stock', 'direct', 'writer']:
+                row = asyncio.run(self.run_mode(mode, room.id, options))
+                self.stdout.write('%-8s %8d %8d %10.2f %10.2f %10.2f %10.0f %12.2f' % ((mode,) + row))
+        finally:
+            room.delete()
+
+    async def run_mode(self, mode, room_id, options):
+        executor = ThreadPoolExecutor(options['threads'])
+        loop = asyncio.get_running_loop()
+        database = connections.settings['default']
+        tuned_options = database['OPTIONS']
+        if mode == 'stock':
+            # Only connections opened from here on pick this up: the pool's threads are new
+            database['OPTIONS'] = STOCK_OPTIONS
+
+        async def write(number):
+            if mode == 'writer':
+                await db_writer.run(write_message, room_id, number)
+            else:
+                await loop.run_in_executor(executor, write_message, room_id, number)
+
+        latencies, reads, locked = [], [], 0
+        done = False
+
+        async def writer(client):
+            nonlocal locked
+            for number in range(options['writes']):
+                started = time.perf_counter()
+                try:
+                    await write(client * options['writes'] + number)
+                except OperationalError:
+                    locked += 1
+                    continue
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        async def reader():
+            while not done:
+                started = time.perf_counter()
+                await loop.run_in_executor(executor, read_page, room_id)
+                reads.append((time.perf_counter() - started) * 1000)
+                await asyncio.sleep(options['read_interval'])
+
+        readers = [asyncio.create_task(reader()) for _ in range(options['readers'])]
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(writer(client) for client in range(options['writers'])))
+        finally:
+            elapsed = time.perf_counter() - started
+            done = True
+            await asyncio.gather(*readers)
+            executor.shutdown()
+            database['OPTIONS'] = tuned_options
+        return (len(latencies), locked, percentile(latencies, 0.5), percentile(latencies, 0.99),
+                max(latencies, default=0.0), len(latencies) / elapsed, percentile(reads, 0.99))
@@ -0,0 +1,108 @@
+import hashlib
+import http.client
+import os
+import random
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.media import blob_name
+
+
+class Command(BaseCommand):
+    help = ('Measure media serving throughput with concurrent byte-range requests against a running server '
+            '(e.g. daphne chat_project.asgi:application)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Server to measure')
+        parser.add_argument('--prefix', default=settings.MEDIA_URL,
+                            help='URL path the media is served under, to compare with another server')
+        parser.add_argument('--size-mb', type=int, default=50, help='Size of the test video')
+        parser.add_argument('--concurrency', default='1,8,32', help='Comma separated numbers of parallel clients')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per concurrency level')
+        parser.add_argument('--range-size', type=int, default=1024 * 1024,
+                            help='Bytes per range request, like a video player seeking; 0 fetches the whole file')
+
+    def handle(self, *args, **options):
+        # The server must see the file under its own MEDIA_ROOT, so run this
+        # with the same settings (and working directory) as the server
+        data = os.urandom(options['size_mb'] * 1024 * 1024)
+        name = blob_name(hashlib.sha256(data).hexdigest(), 'bench.mp4')
+        path = default_storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as target:
+            target.write(data)
+        try:
+            url = urlsplit(options['url'])
+            target = (url.hostname, url.port or 80, options['prefix'].rstrip('/') + '/' + name)
+            self.check_server(target, data)
+            range_size = options['range_size'] or len(data)
+            self.stdout.write('%s, %d MB file, %s per request' % (
+                options['url'], options['size_mb'],
+                'whole file' if range_size == len(data) else '%d KB ranges' % (range_size // 1024)))
+            self.stdout.write('%11s %10s %10s %10s %10s' % ('concurrency', 'MB/s', 'req/s', 'p50 ms', 'p99 ms'))
+            for concurrency in [int(value) for value in options['concurrency'].split(',')]:
+                seconds, latencies = self.run(target, len(data), range_size, concurrency, options['requests'])
+                latencies.sort()
+                self.stdout.write('%11d %10.1f %10.1f %10.2f %10.2f' % (
+                    concurrency,
+                    len(latencies) * range_size / seconds / 1024 / 1024,
+                    len(latencies) / seconds,
+                    statistics.median(latencies) * 1000,
+                    latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+                ))
+        finally:
+            default_storage.delete(name)
+
+    def check_server(self, target, data):
+        status, body = self.fetch(http.client.HTTPConnection(target[0], target[1], timeout=30), target[2], 100, 199)
+        if status != 206 or body != data[100:200]:
+            raise CommandError('Expected 206 with bytes 100-199 from %s, got %s' % (target[2], status))
+
+    def run(self, target, size, range_size, concurrency, requests):
+        """Return the wall time and every request's latency for ``requests`` spread over ``concurrency`` clients"""
+        latencies = []
+        errors = []
+        remaining = iter(range(requests))
+        lock = threading.Lock()
+
+        def client():
+            connection = http.client.HTTPConnection(target[0], target[1], timeout=60)
+            rng = random.Random()
+            try:
+                while True:
+                    with lock:
+                        if next(remaining, None) is None:
+                            return
+                    start = rng.randrange(0, size - range_size + 1)
+                    started = time.perf_counter()
+                    status, body = self.fetch(connection, target[2], start, start + range_size - 1)
+                    elapsed = time.perf_counter() - started
+                    if status not in (200, 206) or len(body) != range_size:
+                        errors.append(status)
+                        return
+                    with lock:
+                        latencies.append(elapsed)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise CommandError('Requests failed with status %s' % errors[0])
+        return time.perf_counter() - started, latencies
+
+    @staticmethod
+    def fetch(connection, path, start, end):
+        connection.request('GET', path, headers={'Range': 'bytes=%d-%d' % (start, end)})
+        response = connection.getresponse()
+        return response.status, response.read()
@@ -0,0 +1,119 @@
+import asyncio
+import time
+import timeit
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.urls import resolve
+
+from chat.broadcast import broadcast, group_name
+from chat.consumers import ChatConsumer
+from chat.metrics import Counter, Histogram, MetricsMiddleware, Registry, registry
+from chat.outbound import OutboundQueue, flusher
+
+PAYLOAD = {
+    'id': 123456,
+    'message': 'The quick brown fox jumps over the lazy dog. ' * 4,
+    'sender': 'benchmark-user',
+    'timestamp': '2026-01-01T12:00:00.000000+00:00',
+    'reaction_counts': {},
+    'parent_id': None,
+    'is_edited': False,
+}
+
+
+async def drained():
+    task = flusher(0).task
+    if task is not None and not task.done():
+        await task
+
+class Command(BaseCommand):
+    help = 'Measure what recording metrics costs, per call and per broadcast, with metrics on and off'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000, help='Sockets in the broadcast room')
+        parser.add_argument('--rounds', type=int, default=50, help='Broadcasts per measurement')
+        parser.add_argument('--calls', type=int, default=200000, help='Calls per micro-benchmark')
+
+    def handle(self, *args, **options):
+        enabled = registry.enabled
+        try:
+            self.micro(options['calls'])
+            self.stdout.write('')
+            self.stdout.write('CPU ms per chat_message broadcast to %d sockets (group_send and every '
+                              'recipient\'s handler and send)' % options['members'])
+            self.stdout.write('%10s %10s %10s' % ('metrics', 'ms', 'overhead'))
+            timings = {}
+            # Alternate, so drift (CPU frequency, caches) does not favour either
+            for _ in range(3):
+                for on in (False, True):
+                    registry.enabled = on
+                    timings.setdefault(on, []).append(asyncio.run(self.fan_out(options['members'], options['rounds'])))
+            off, on = min(timings[False]), min(timings[True])
+            self.stdout.write('%10s %10.3f %10s' % ('off', off * 1000, '-'))
+            self.stdout.write('%10s %10.3f %9.1f%%' % ('on', on * 1000, (on - off) / off * 100))
+        finally:
+            registry.enabled = enabled
+
+    def micro(self, calls):
+        scratch = Registry()
+        counter = Counter(scratch, 'bench_total', 'Benchmark counter', ['type'])
+        histogram = Histogram(scratch, 'bench_seconds', 'Benchmark histogram', ['pool'])
+        request = RequestFactory().get('/api/rooms/')
+        request.resolver_match = resolve('/api/rooms/')
+        response = type('Response', (), {'status_code': 200})()
+        started = time.perf_counter()
+
+        def timed():
+            with histogram.time(('writer',)):
+                pass
+
+        cases = [
+            ('counter.inc', lambda: counter.inc(('chat_message',))),
+            ('histogram.observe', lambda: histogram.observe(0.0042, ('writer',))),
+            ('with histogram.time()', timed),
+            ('middleware record', lambda: MetricsMiddleware.record(request, response, started)),
+            ('empty call', lambda: None),
+        ]
+        self.stdout.write('ns per call (%d calls; "empty call" is the lambda itself)' % calls)
+        self.stdout.write('%-22s %10s %10s' % ('operation', 'on', 'off'))
+        for name, case in cases:
+            row = []
+            for on in (True, False):
+                scratch.enabled = registry.enabled = on
+                row.append(min(timeit.repeat(case, number=calls, repeat=3)) / calls * 1e9)
+            self.stdout.write('%-22s %10.0f %10.0f' % (name, row[0], row[1]))
+        registry.enabled = True
+
+    async def fan_out(self, members, rounds):
+        """CPU seconds per broadcast through the real send path"""
+        layer = InMemoryChannelLayer(capacity=rounds + 1)
+        room_name = 'bench'
+        consumers = []
+        for _ in range(members):
+            channel = await layer.new_channel()
+            await layer.group_add(group_name(room_name), channel)
+            consumer = ChatConsumer()
+            consumer.base_send = self.discard
+            consumer.codec = None
+            consumer.too_slow = False
+            consumer.room_name = room_name
+            consumer.outbound = OutboundQueue(consumer.send_data, window=0)
+            consumers.append((channel, consumer))
+
+        total = 0.0
+        for _ in range(rounds):
+            started = time.process_time()
+            await broadcast(layer, room_name, 'chat_message', PAYLOAD)
+            for channel, consumer in consumers:
+                await consumer.chat_message(await layer.receive(channel))
+            # Idle queues with no window send inline; wait for any that had to queue
+            await drained()
+            total += time.process_time() - started
+        return total / rounds
+
+    @staticmethod
+    async def discard(message):
+        pass
+
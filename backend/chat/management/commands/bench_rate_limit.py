@@ -0,0 +1,39 @@
+import itertools
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from chat.ratelimit import RateLimiter
+
+
+class Command(BaseCommand):
+    help = 'Measure what one rate limiter decision costs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200000, help='Decisions per measurement')
+        parser.add_argument('--senders', type=int, default=10000, help='Distinct senders with a bucket')
+
+    def handle(self, *args, **options):
+        calls = options['calls']
+        unlimited = RateLimiter({'chat_message': (1e9, 1e9)}, {'chat_message': (1e9, 1e9)})
+        limits = unlimited.connection()
+        exhausted = RateLimiter({'chat_message': (1e-9, 1)}, {'chat_message': (1e-9, 1)})
+        refusing = exhausted.connection()
+        refusing.check('chat_message', 'sender')
+        untyped = RateLimiter({}, {}).connection()
+        for number in range(options['senders']):
+            limits.check('chat_message', 'sender-%d' % number)
+        names = ['sender-%d' % (number % options['senders']) for number in range(1024)]
+        names_cycle = itertools.cycle(names)
+
+        cases = [
+            ('admitted', lambda: limits.check('chat_message', 'sender-1')),
+            ('admitted, %d senders' % options['senders'], lambda: limits.check('chat_message', next(names_cycle))),
+            ('refused', lambda: refusing.check('chat_message', 'sender')),
+            ('type not limited', lambda: untyped.check('typing', 'sender')),
+            ('empty call', lambda: None),
+        ]
+        self.stdout.write('ns per decision (%d calls; "empty call" is the lambda itself)' % calls)
+        for name, case in cases:
+            nanoseconds = min(timeit.repeat(case, number=calls, repeat=3)) / calls * 1e9
+            self.stdout.write('%-28s %8.0f' % (name, nanoseconds))
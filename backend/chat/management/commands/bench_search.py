@@ -0,0 +1,66 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from chat.models import Message, Room
+from chat.search import search_room, supported
+
+WORDS = (
+    'lunch dinner meeting tomorrow tonight weekend project deadline release deploy server database '
+    'photo video call later sorry thanks great awesome coffee train station airport ticket movie '
+    'birthday party gift music concert football match score game update review bug feature'
+).split()
+ROOM_NAME = 'bench-search'
+
+
+class Command(BaseCommand):
+    help = 'Generate a message corpus and compare full-text search against a LIKE scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200000, help='Corpus size')
+        parser.add_argument('--rounds', type=int, default=20, help='Searches per query')
+        parser.add_argument('--keep', action='store_true', help='Keep the generated room afterwards')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        if not supported():
+            raise CommandError('Message search needs the SQLite database')
+        rng = random.Random(options['seed'])
+        room, _ = Room.objects.get_or_create(name=ROOM_NAME)
+
+        existing = Message.objects.filter(room=room).count()
+        started = time.perf_counter()
+        batch = []
+        for _ in range(existing, options['messages']):
+            batch.append(Message(room=room, sender='bench', content=' '.join(rng.choices(WORDS, k=rng.randint(3, 20)))))
+            if len(batch) == 5000:
+                Message.objects.bulk_create(batch)
+                batch = []
+        Message.objects.bulk_create(batch)
+        self.stdout.write('Corpus: %d messages (%d inserted and indexed in %.1fs)' % (
+            options['messages'], max(0, options['messages'] - existing), time.perf_counter() - started))
+
+        # A rare word (planted in a few messages), a common one and a two-word phrase
+        needle = Message.objects.filter(room=room).order_by('?')[:5]
+        Message.objects.filter(id__in=[message.id for message in needle]).update(content='where is the zeppelin ticket')
+        self.stdout.write('%-20s %10s %12s %12s' % ('query', 'hits', 'fts ms', 'like ms'))
+        for query in ('zeppelin', 'coffee', 'train station'):
+            fts = self.time(options['rounds'], lambda: search_room(room.id, query, 20))
+            like = self.time(options['rounds'], lambda: list(
+                Message.objects.filter(room=room, content__icontains=query).order_by('-id')[:20]))
+            hits = len(search_room(room.id, query, 1000)[0])
+            self.stdout.write('%-20s %10s %12.2f %12.2f' % (query, hits if hits < 1000 else '1000+', fts, like))
+
+        if not options['keep']:
+            # Plain SQL delete: the search triggers still run, Django's per-object cascade does not
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute('DELETE FROM chat_message WHERE room_id = %s', [room.id])
+                room.delete()
+
+    def time(self, rounds, search):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            search()
+        return (time.perf_counter() - started) / rounds * 1000
@@ -0,0 +1,67 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from chat.typing_state import TypingTracker
+
+
+class Command(BaseCommand):
+    help = 'Simulate a busy room and compare typing frames sent per second, per keystroke vs coalesced'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=500, help='Sockets in the room')
+        parser.add_argument('--typists', type=int, default=20, help='Members typing on and off')
+        parser.add_argument('--seconds', type=int, default=120, help='Simulated duration')
+        parser.add_argument('--keystroke-interval', type=float, default=0.15,
+                            help='Seconds between keystrokes while typing')
+        parser.add_argument('--tick', type=float, default=0.5, help='Snapshot tick in seconds')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        tracker = TypingTracker(tick=options['tick'])
+        step = 0.01  # simulation resolution in seconds
+        keystroke = options['keystroke_interval']
+
+        # Each typist alternates typing bursts (ending in a sent message) and pauses
+        typists = [{
+            'name': 'user%d' % index,
+            'typing_until': 0.0,
+            'next_burst': rng.uniform(0, 5),
+            'next_key': 0.0,
+        } for index in range(options['typists'])]
+
+        inbound = snapshots = 0
+        next_tick = options['tick']
+        now = 0.0
+        while now < options['seconds']:
+            for typist in typists:
+                if now >= typist['next_burst'] and now >= typist['typing_until']:
+                    typist['typing_until'] = now + rng.uniform(2, 10)
+                    typist['next_burst'] = typist['typing_until'] + rng.uniform(3, 8)
+                    typist['next_key'] = now
+                if now < typist['typing_until'] and now >= typist['next_key']:
+                    # The client sends typing=true on every keystroke
+                    tracker.set_typing('bench', typist['name'], typist['name'], True, now)
+                    typist['next_key'] = now + keystroke
+                    inbound += 1
+                elif typist['typing_until'] and now >= typist['typing_until']:
+                    # Message sent: the client says it stopped
+                    tracker.set_typing('bench', typist['name'], typist['name'], False, now)
+                    typist['typing_until'] = 0.0
+                    inbound += 1
+            if now >= next_tick:
+                snapshots += len(tracker.collect(now))
+                next_tick += options['tick']
+            now += step
+
+        seconds = options['seconds']
+        members = options['members']
+        legacy = inbound * members / seconds
+        coalesced = snapshots * members / seconds
+        self.stdout.write('%d members, %d typists, %d simulated seconds' % (members, options['typists'], seconds))
+        self.stdout.write('typing events in:          %10.1f /s' % (inbound / seconds))
+        self.stdout.write('frames out, per keystroke: %10.1f /s' % legacy)
+        self.stdout.write('frames out, coalesced:     %10.1f /s' % coalesced)
+        self.stdout.write('saved:                     %10.1f /s (%.1f%%)' % (
+            legacy - coalesced, 100 * (legacy - coalesced) / legacy if legacy else 0))
@@ -0,0 +1,61 @@
+import os
+import time
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F
+from django.utils import timezone
+
+from chat.media import BLOB_DIR
+from chat.models import Blob
+from chat.thumbnails import thumbnail_name
+
+
+class Command(BaseCommand):
+    help = 'Repair blob reference counts and delete blobs and blob files no message uses. Run while uploads are quiet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=1,
+                            help='Leave blobs and files younger than this many hours alone')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be deleted')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+
+        # Counts drift if a process dies between taking a reference and saving its message
+        repaired = 0
+        for blob in Blob.objects.annotate(refs=Count('messages')).exclude(ref_count=F('refs')).iterator():
+            repaired += 1
+            if not dry_run:
+                Blob.objects.filter(digest=blob.digest).update(ref_count=blob.refs)
+
+        deleted = 0
+        unused = Blob.objects.filter(ref_count__lte=0, messages__isnull=True, created_at__lt=cutoff)
+        for blob in unused.iterator():
+            if dry_run:
+                deleted += 1
+                continue
+            # Re-check in the delete itself in case a new message took a reference meanwhile
+            if Blob.objects.filter(digest=blob.digest, ref_count__lte=0, messages__isnull=True).delete()[0]:
+                default_storage.delete(blob.path)
+                default_storage.delete(thumbnail_name(blob.path))
+                deleted += 1
+
+        # Files with no blob row: left by uploads interrupted before their row was written
+        orphans = 0
+        root = default_storage.path(BLOB_DIR)
+        known = set(Blob.objects.values_list('path', flat=True))
+        for directory, _, files in os.walk(root):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                name = os.path.relpath(path, default_storage.path('')).replace(os.sep, '/')
+                if name in known or os.path.getmtime(path) > time.time() - options['hours'] * 3600:
+                    continue
+                orphans += 1
+                if not dry_run:
+                    os.remove(path)
+
+        self.stdout.write('%s %d unused blobs and %d orphaned files; repaired %d reference counts' % (
+            'Would delete' if dry_run else 'Deleted', deleted, orphans, repaired))
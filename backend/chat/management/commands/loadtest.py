@@ -0,0 +1,636 @@
+import asyncio
+import base64
+import gc
+import io
+import json
+import os
+import random
+import resource
+import struct
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter, deque
+from urllib.parse import urlsplit
+
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.utils import timezone
+from PIL import Image
+
+from chat.dbwriter import db_writer
+from chat.ratelimit import rate_limiter
+from chat.writebehind import message_writer
+
+OPERATIONS = ['chat', 'reaction', 'typing', 'edit', 'delete', 'upload']
+DEFAULT_MIX = 'chat=60,reaction=15,typing=15,edit=4,delete=3,upload=3'
+# The operation named in the server's error events, for the operations that wait for an answer
+ERROR_OPERATIONS = {'chat_message': 'chat', 'reaction': 'reaction', 'edit_message': 'edit', 'delete_message': 'delete'}
+EMOJIS = ['👍', '❤️', '😂', '🎉', '😮']
+# Metrics where a smaller number is better; for the rest (throughput) bigger is better
+LOWER_IS_BETTER = ('_ms', '_kb', '_queries', '_overall', 'unanswered', 'dropped_connections', 'errors')
+# Counts that follow from the options rather than from how well the server did
+NOT_COMPARED = ('clients', 'operations', 'events_delivered')
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise CommandError('Unknown operation %r in --mix; choose from %s' % (name, ', '.join(OPERATIONS)))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return round(samples[min(len(samples) - 1, int(len(samples) * fraction))], 3)
+
+
+def rss_kb(pid=None):
+    """Resident memory of a process in KB, from /proc where there is one"""
+    try:
+        with open('/proc/%s/statm' % (pid or 'self')) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        if pid:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def upload_body(sender, room_name, content):
+    # A real image, so the thumbnail worker does its usual work
+    image = io.BytesIO()
+    Image.new('RGB', (64, 64), tuple(random.randrange(256) for _ in range(3))).save(image, 'PNG')
+    image.seek(0)
+    image.name = 'loadtest.png'
+    image.content_type = 'image/png'
+    return encode_multipart(BOUNDARY, {'file': image, 'sender': sender, 'room_name': room_name, 'content': content})
+
+
+class QueryCounter:
+    """Counts queries on every database connection opened while installed, from any thread"""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        connection_created.connect(self.wrap)
+        for connection in connections.all(initialized_only=True):
+            self.wrap(connection=connection)
+
+    def wrap(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class InProcessTransport:
+    """Drives ``chat_project.asgi:application`` in this process, without a network"""
+
+    name = 'in-process'
+
+    def __init__(self):
+        from chat_project.asgi import application
+        self.application = application
+
+    async def connect(self, path):
+        communicator = WebsocketCommunicator(self.application, path)
+        connected, _ = await communicator.connect(timeout=30)
+        if not connected:
+            raise ConnectionError('WebSocket connection to %s refused' % path)
+        return InProcessSocket(communicator)
+
+    async def request(self, method, path, body=b'', content_type=None):
+        headers = [(b'host', b'localhost'), (b'content-length', str(len(body)).encode())]
+        if content_type:
+            headers.append((b'content-type', content_type.encode()))
+        communicator = HttpCommunicator(self.application, method, path, body=body, headers=headers)
+        response = await communicator.get_response(timeout=60)
+        await communicator.wait(timeout=60)
+        return response['status'], response['body']
+
+
+class InProcessSocket:
+    def __init__(self, communicator):
+        self.communicator = communicator
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self):
+        """Next text frame, or None once the server closed the connection"""
+        while True:
+            message = await self.communicator.output_queue.get()
+            if message['type'] == 'websocket.close':
+                return None
+            if message.get('text') is not None:
+                return message['text']
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class NetworkTransport:
+    """Talks to a running server (e.g. daphne) over TCP"""
+
+    name = 'network'
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ('ws', 'http'):
+            raise CommandError('--url must be ws://host:port or http://host:port')
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.http_url = 'http://%s:%d' % (self.host, self.port)
+
+    async def connect(self, path):
+        # A minimal RFC 6455 client; daphne's autobahn is tied to Twisted once daphne is installed
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), 30)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write(('GET %s HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                      'Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n'
+                      % (path, self.host, self.port, key)).encode())
+        response = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 30)
+        if not response.startswith(b'HTTP/1.1 101'):
+            writer.close()
+            raise ConnectionError('WebSocket connection to %s refused: %s' % (path, response.split(b'\r\n')[0]))
+        return NetworkSocket(reader, writer)
+
+    async def request(self, method, path, body=b'', content_type=None):
+        def send():
+            request = urllib.request.Request(self.http_url + path, data=body or None, method=method)
+            if content_type:
+                request.add_header('Content-Type', content_type)
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    return response.status, response.read()
+            except urllib.error.HTTPError as error:
+                return error.code, error.read()
+        return await asyncio.get_running_loop().run_in_executor(None, send)
+
+
+class NetworkSocket:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def write_frame(self, opcode, payload):
+        # Client frames are always masked
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        masked = int.from_bytes(payload, 'big') ^ int.from_bytes(mask * (length // 4 + 1), 'big') >> (
+            8 * (4 - length % 4))
+        self.writer.write(header + mask + masked.to_bytes(length, 'big'))
+
+    async def send(self, text):
+        self.write_frame(0x1, text.encode())
+        await self.writer.drain()
+
+    async def receive(self):
+        """Next text frame, or None once the server closed the connection"""
+        message = b''
+        try:
+            while True:
+                first, second = await self.reader.readexactly(2)
+                length = second & 0x7f
+                if length == 126:
+                    length, = struct.unpack('!H', await self.reader.readexactly(2))
+                elif length == 127:
+                    length, = struct.unpack('!Q', await self.reader.readexactly(8))
+                payload = await self.reader.readexactly(length)
+                opcode = first & 0x0f
+                if opcode == 0x8:
+                    return None
+                if opcode == 0x9:
+                    self.write_frame(0xa, payload)
+                elif opcode in (0x0, 0x1, 0x2):
+                    message += payload
+                    if first & 0x80:
+                        return message.decode()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def close(self):
+        try:
+            self.write_frame(0x8, struct.pack('!H', 1000))
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+class Metrics:
+    def __init__(self):
+        self.sent = Counter()
+        self.errors = Counter()
+        self.acks = {operation: [] for operation in OPERATIONS}
+        self.broadcast = []  # ms from a chat message being sent to each room member receiving it
+        self.connect = []
+        self.events = 0
+        self.closed = 0
+
+
+class SimulatedClient:
+    """One WebSocket user: sends a mix of operations and times the server's answers"""
+
+    def __init__(self, harness, number, room_name):
+        self.harness = harness
+        self.name = 'lt%d' % number
+        self.room_name = room_name
+        self.socket = None
+        self.sequence = 0
+        self.own = []  # ids of this client's messages that are still there
+        self.pending = {}  # key -> (operation, sent at) for answers this client waits for
+        self.answered = {}  # key -> Event, for calibration runs that wait for each answer
+        self.receiver = None
+        self.closed = False
+
+    async def connect(self):
+        started = time.perf_counter()
+        self.socket = await self.harness.transport.connect('/ws/chat/%s/?user=%s' % (self.room_name, self.name))
+        self.harness.metrics.connect.append((time.perf_counter() - started) * 1000)
+        self.receiver = asyncio.create_task(self.receive())
+
+    async def close(self):
+        if self.receiver is not None:
+            self.receiver.cancel()
+        if self.socket is not None:
+            await self.socket.close()
+
+    def token(self):
+        self.sequence += 1
+        return '%s:%d' % (self.name, self.sequence)
+
+    def expect(self, key, operation):
+        self.pending[key] = (operation, time.perf_counter())
+        self.answered[key] = asyncio.Event()
+        return self.answered[key]
+
+    def answer(self, key):
+        operation, sent = self.pending.pop(key, (None, None))
+        if operation is not None:
+            self.harness.metrics.acks[operation].append((time.perf_counter() - sent) * 1000)
+            self.answered.pop(key).set()
+
+    def release(self, key):
+        """Stop waiting for ``key`` without timing it; no answer is coming"""
+        if self.pending.pop(key, None) is not None:
+            self.answered.pop(key).set()
+
+    def refuse(self, operation):
+        # The server answers operations in order, so the refused one is the oldest still waiting
+        for key, (pending_operation, _) in self.pending.items():
+            if pending_operation == operation:
+                self.release(key)
+                return
+
+    async def perform(self, operation):
+        """Send one operation; returns an Event set when the server's answer arrives, if there is one"""
+        if operation in ('edit', 'delete') and not self.own:
+            operation = 'chat'
+        if operation == 'reaction' and not self.harness.room_messages[self.room_name]:
+            operation = 'chat'
+        self.harness.metrics.sent[operation] += 1
+        if operation == 'chat':
+            token = self.token()
+            self.harness.chat_sent[token] = time.perf_counter()
+            answered = self.expect(token, 'chat')
+            await self.socket.send(json.dumps({'type': 'chat_message', 'sender': self.name,
+                                               'message': 'loadtest %s' % token}))
+            return answered
+        if operation == 'reaction':
+            message_id = random.choice(self.harness.room_messages[self.room_name])
+            answered = self.expect(('reaction', message_id), 'reaction')
+            await self.socket.send(json.dumps({'type': 'reaction', 'message_id': message_id, 'sender': self.name,
+                                               'emoji': random.choice(EMOJIS)}))
+            return answered
+        if operation == 'typing':
+            await self.socket.send(json.dumps({'type': 'typing', 'sender': self.name,
+                                               'is_typing': random.random() < 0.7}))
+            return None
+        if operation == 'edit':
+            message_id = random.choice(self.own)
+            answered = self.expect(('edit', message_id), 'edit')
+            await self.socket.send(json.dumps({'type': 'edit_message', 'message_id': message_id, 'sender': self.name,
+                                               'content': 'loadtest %s edited' % self.token()}))
+            return answered
+        if operation == 'delete':
+            message_id = self.own.pop(random.randrange(len(self.own)))
+            answered = self.expect(('delete', message_id), 'delete')
+            await self.socket.send(json.dumps({'type': 'delete_message', 'message_id': message_id,
+                                               'sender': self.name}))
+            return answered
+        token = self.token()
+        answered = self.expect(token, 'upload')
+        status, _ = await self.harness.transport.request(
+            'POST', '/api/upload-file/', upload_body(self.name, self.room_name, 'loadtest %s' % token),
+            MULTIPART_CONTENT)
+        if status != 200:
+            self.harness.metrics.errors['upload'] += 1
+            self.release(token)
+        return answered
+
+    async def receive(self):
+        metrics = self.harness.metrics
+        while True:
+            text = await self.socket.receive()
+            if text is None:
+                metrics.closed += 1
+                self.closed = True
+                for key in list(self.pending):
+                    self.release(key)
+                return
+            events = json.loads(text)
+            for event in events if isinstance(events, list) else [events]:
+                metrics.events += 1
+                self.handle(event)
+
+    def handle(self, event):
+        kind = event.get('type')
+        if kind == 'chat_message':
+            content = event.get('message') or ''
+            if not content.startswith('loadtest ') or event.get('thumbnail_url'):
+                return
+            token = content[len('loadtest '):]
+            sent = self.harness.chat_sent.get(token)
+            if sent is not None:
+                self.harness.metrics.broadcast.append((time.perf_counter() - sent) * 1000)
+            if event.get('sender') == self.name and token in self.pending:
+                self.own.append(event['id'])
+                self.harness.room_messages[self.room_name].append(event['id'])
+                self.answer(token)
+        elif kind == 'reaction_delta' and event.get('sender') == self.name:
+            self.answer(('reaction', event['message_id']))
+        elif kind == 'message_edit':
+            self.answer(('edit', event['message_id']))
+        elif kind == 'message_delete':
+            self.answer(('delete', event['message_id']))
+            # Reactions to a deleted message are ignored without an answer
+            room_messages = self.harness.room_messages[self.room_name]
+            if event['message_id'] in room_messages:
+                room_messages.remove(event['message_id'])
+        elif kind == 'error':
+            # Refused, e.g. rate_limited: there will be no confirming event
+            self.harness.metrics.errors[event.get('code') or 'refused'] += 1
+            self.refuse(ERROR_OPERATIONS.get(event.get('operation')))
+
+
+class Command(BaseCommand):
+    help = ('Drive many simulated WebSocket clients against the server and report throughput, broadcast '
+            'latency, memory per connection and database queries per operation')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000, help='Simulated clients')
+        parser.add_argument('--rooms', type=int, default=50, help='Rooms the clients are spread over')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds of traffic')
+        parser.add_argument('--rate', type=float, default=0.5, help='Operations per second per client')
+        parser.add_argument('--mix', default=DEFAULT_MIX,
+                            help='Relative weights of %s (default %s)' % (', '.join(OPERATIONS), DEFAULT_MIX))
+        parser.add_argument('--connect-concurrency', type=int, default=100, help='Connections opened at once')
+        parser.add_argument('--url', help='Load a running server (e.g. ws://127.0.0.1:8000) instead of '
+                                          'chat_project.asgi:application in this process')
+        parser.add_argument('--server-pid', type=int, help='With --url, read memory use from this process')
+        parser.add_argument('--query-samples', type=int, default=20,
+                            help='Operations of each kind timed on their own to count queries (in-process only)')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='Compare with the results in this JSON file')
+        parser.add_argument('--tolerance', type=float, default=10,
+                            help='Percent a metric may get worse before --compare reports a regression')
+        parser.add_argument('--seed', type=int, help='Random seed, for repeatable traffic')
+
+    def handle(self, *args, **options):
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+        self.mix = parse_mix(options['mix'])
+        self.transport = NetworkTransport(options['url']) if options['url'] else InProcessTransport()
+        self.metrics = Metrics()
+        self.chat_sent = {}
+        run = uuid.uuid4().hex[:8]
+        self.room_names = ['loadtest_%s_%d' % (run, number) for number in range(options['rooms'])]
+        self.room_messages = {room_name: deque(maxlen=200) for room_name in self.room_names}
+        self.queries = None
+        if self.transport.name == 'in-process':
+            self.queries = QueryCounter()
+            self.queries.install()
+
+        results = asyncio.run(self.run(options))
+        document = {
+            'commit': git_commit(),
+            'created_at': timezone.now().isoformat(),
+            'options': {key: options[key] for key in ('clients', 'rooms', 'duration', 'rate', 'mix', 'url', 'seed')},
+            'results': results,
+        }
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(document, output, indent=2, sort_keys=True)
+            self.stdout.write('Results written to %s' % options['output'])
+        if options['compare']:
+            with open(options['compare']) as baseline:
+                self.compare(json.load(baseline)['results'], results, options['tolerance'])
+
+    async def run(self, options):
+        metrics = self.metrics
+        memory_pid = options['server_pid'] if options['url'] else None
+        gc.collect()
+        memory_before = rss_kb(memory_pid)
+
+        clients = [SimulatedClient(self, number, self.room_names[number % len(self.room_names)])
+                   for number in range(options['clients'])]
+        limit = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def connect(client):
+            async with limit:
+                try:
+                    await client.connect()
+                except Exception:
+                    metrics.errors['connect'] += 1
+
+        await asyncio.gather(*(connect(client) for client in clients))
+        clients = [client for client in clients if client.socket is not None]
+        if not clients:
+            raise CommandError('No client could connect')
+        # Let the connect frames (replay, presence) settle before measuring memory
+        await asyncio.sleep(1)
+        gc.collect()
+        memory_after = rss_kb(memory_pid)
+        self.stdout.write('%d clients connected in %d rooms' % (len(clients), len(self.room_names)))
+
+        queries_before = self.queries.count if self.queries else None
+        operations, weights = zip(*self.mix.items())
+        deadline = time.perf_counter() + options['duration']
+
+        async def traffic(client):
+            # Poisson arrivals, so clients do not send in lockstep
+            while True:
+                wait = random.expovariate(options['rate'])
+                if time.perf_counter() + wait >= deadline:
+                    return
+                await asyncio.sleep(wait)
+                try:
+                    await client.perform(random.choices(operations, weights)[0])
+                except Exception:
+                    metrics.errors['send'] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(traffic(client) for client in clients))
+        elapsed = max(time.perf_counter() - started, options['duration'])
+        # Give answers still in flight a moment to arrive
+        await asyncio.sleep(2)
+        unanswered = sum(len(client.pending) for client in clients)
+        if metrics.errors['rate_limited']:
+            self.stderr.write('%d operations went over the rate limits (CHAT_RATE_LIMITS_*) and were refused'
+                              % metrics.errors['rate_limited'])
+        if self.queries:
+            await self.settle()
+        queries = self.queries.count - queries_before if self.queries else None
+
+        queries_per_operation = await self.count_queries(clients, options['query_samples']) if self.queries else {}
+        for client in clients:
+            await client.close()
+        await self.cleanup()
+
+        sent = sum(metrics.sent.values())
+        results = {
+            'clients': len(clients),
+            'operations': sent,
+            'operations_per_s': round(sent / elapsed, 1),
+            'events_delivered': metrics.events,
+            'events_per_s': round(metrics.events / elapsed, 1),
+            'broadcast_p50_ms': percentile(metrics.broadcast, 0.5),
+            'broadcast_p99_ms': percentile(metrics.broadcast, 0.99),
+            'connect_p99_ms': percentile(metrics.connect, 0.99),
+            'memory_scope': 'server' if memory_pid else ('client' if options['url'] else 'in-process'),
+            'memory_per_connection_kb': (round((memory_after - memory_before) / len(clients), 2)
+                                         if clients and memory_before is not None and memory_after is not None
+                                         else None),
+            'queries_per_operation_overall': round(queries / sent, 2) if queries is not None and sent else None,
+            'unanswered': unanswered,
+            'dropped_connections': metrics.closed,
+            'errors': sum(metrics.errors.values()),
+        }
+        for operation in OPERATIONS:
+            if operation in self.mix:
+                results['%s_sent' % operation] = metrics.sent[operation]
+                if operation != 'typing':
+                    results['%s_ack_p50_ms' % operation] = percentile(metrics.acks[operation], 0.5)
+                    results['%s_ack_p99_ms' % operation] = percentile(metrics.acks[operation], 0.99)
+                if operation in queries_per_operation:
+                    results['%s_queries' % operation] = queries_per_operation[operation]
+        return results
+
+    async def settle(self):
+        """Wait until queued writes, write-behind batches and thumbnails are done"""
+        while message_writer.pending:
+            if not await message_writer.flush():
+                break
+        await db_writer.run(int)
+        await asyncio.sleep(0.5)
+
+    async def count_queries(self, clients, samples):
+        """Queries per operation of each kind, timed one at a time on an otherwise idle server.
+
+        One client sends all samples back to back, far above the rate
+        limits, so they are lifted meanwhile. Checking them takes no queries.
+        """
+        if not samples:
+            return {}
+        limited, rate_limiter.limited = rate_limiter.limited, set()
+        try:
+            return await self.count_samples(clients[0], samples)
+        finally:
+            rate_limiter.limited = limited
+
+    async def count_samples(self, client, samples):
+        async def perform(operation):
+            answered = await client.perform(operation)
+            if answered is not None:
+                await asyncio.wait_for(answered.wait(), 30)
+            if client.closed:
+                raise CommandError('The server closed the connection used to count queries')
+
+        counts = {}
+        # Reactions, edits and deletes need messages to work on
+        for _ in range(samples * 2):
+            await perform('chat')
+        for operation in OPERATIONS:
+            if operation not in self.mix:
+                continue
+            await self.settle()
+            before = self.queries.count
+            for _ in range(samples):
+                await perform(operation)
+            await self.settle()
+            counts[operation] = round((self.queries.count - before) / samples, 2)
+        return counts
+
+    async def cleanup(self):
+        """Delete the load test's rooms and wait for their messages and files to be purged"""
+        deletions = []
+        for room_name in self.room_names:
+            status, body = await self.transport.request('DELETE', '/api/rooms/%s/delete/' % room_name)
+            if status == 202:
+                deletions.append(json.loads(body)['deletion_id'])
+        deadline = time.perf_counter() + 120
+        while deletions and time.perf_counter() < deadline:
+            status, body = await self.transport.request('GET', '/api/room-deletions/%d/' % deletions[0])
+            if status != 200 or json.loads(body)['done']:
+                deletions.pop(0)
+            else:
+                await asyncio.sleep(0.2)
+        if deletions:
+            self.stderr.write('%d load test rooms were still being purged' % len(deletions))
+
+    def report(self, results):
+        width = max(len(key) for key in results)
+        for key, value in results.items():
+            self.stdout.write('%-*s %s' % (width, key, '-' if value is None else value))
+
+    def compare(self, baseline, results, tolerance):
+        self.stdout.write('%-32s %12s %12s %9s' % ('metric', 'baseline', 'now', 'change'))
+        regressions = 0
+        for key, value in results.items():
+            old = baseline.get(key)
+            if (not isinstance(value, (int, float)) or not isinstance(old, (int, float))
+                    or key in NOT_COMPARED or key.endswith('_sent')):
+                continue
+            # Anything appearing where there was none (e.g. errors) counts as infinitely worse
+            change = (value - old) / old * 100 if old else (float('inf') if value else 0.0)
+            worse = change if key.endswith(LOWER_IS_BETTER) else -change
+            flag = ''
+            if worse > tolerance:
+                regressions += 1
+                flag = '  REGRESSION'
+            self.stdout.write('%-32s %12s %12s %+8.1f%%%s' % (key, old, value, change, flag))
+        if regressions:
+            raise CommandError('%d metrics regressed by more than %s%%' % (regressions, tolerance))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import RoomDeletion
+from chat.purge import purge_chunk
+
+
+class Command(BaseCommand):
+    help = 'Finish purging deleted rooms, e.g. ones whose worker process stopped before it was done'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Messages deleted per transaction')
+
+    def handle(self, *args, **options):
+        for deletion in RoomDeletion.objects.filter(finished_at__isnull=True):
+            purged = 0
+            while True:
+                deleted = purge_chunk(deletion.id, deletion.room_id, options['chunk_size'])
+                if not deleted:
+                    break
+                purged += deleted
+                self.stdout.write('%s: %d messages purged' % (deletion.room_name, purged), ending='\r')
+            self.stdout.write('%s: done, %d messages purged' % (deletion.room_name, purged))
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.models import Upload
+
+
+class Command(BaseCommand):
+    help = 'Delete chunked uploads that were never completed, along with their partial files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24,
+                            help='Delete uploads started more than this many hours ago')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        stale = Upload.objects.filter(created_at__lt=cutoff)
+        count = 0
+        for upload in stale.iterator():
+            default_storage.delete(upload.path)
+            upload.delete()
+            count += 1
+        self.stdout.write('Deleted %d abandoned uploads' % count)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from chat.directory import rebuild_room_stats
+from chat.threads import rebuild_reply_counts
+
+
+class Command(BaseCommand):
+    help = "Recount each room's messages and last activity, and each message's replies, from the Message table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many counts are wrong')
+
+    def handle(self, *args, **options):
+        wrong = rebuild_room_stats(dry_run=options['dry_run'])
+        self.stdout.write('%s %d room counts' % ('Found wrong' if options['dry_run'] else 'Fixed', wrong))
+        wrong = rebuild_reply_counts(dry_run=options['dry_run'])
+        self.stdout.write('%s %d reply counts' % ('Found wrong' if options['dry_run'] else 'Fixed', wrong))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.search import rebuild, supported
+
+
+class Command(BaseCommand):
+    help = 'Recreate the full-text message search index and its triggers from the message table'
+
+    def handle(self, *args, **options):
+        if not supported():
+            raise CommandError('Message search needs the SQLite database')
+        rebuild()
+        self.stdout.write('Rebuilt the message search index')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat.reactions import rebuild_counts
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-message reaction counts from the Reaction table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many counts are wrong')
+
+    def handle(self, *args, **options):
+        wrong = rebuild_counts(dry_run=options['dry_run'])
+        self.stdout.write('%s %d reaction counts' % ('Found wrong' if options['dry_run'] else 'Fixed', wrong))
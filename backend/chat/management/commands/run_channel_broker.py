@@ -0,0 +1,24 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.layers import DEFAULT_SOCKET_PATH, ChannelBroker
+
+
+class Command(BaseCommand):
+    help = 'Run the local channel layer broker shared by BrokerChannelLayer worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.CHANNEL_BROKER_SOCKET or DEFAULT_SOCKET_PATH,
+                            help='Unix socket to listen on')
+        parser.add_argument('--group-expiry', type=int, default=86400,
+                            help='Seconds before a group membership expires')
+
+    def handle(self, *args, **options):
+        broker = ChannelBroker(path=options['path'], group_expiry=options['group_expiry'])
+        self.stdout.write('Channel broker listening on %s' % options['path'])
+        try:
+            asyncio.run(broker.serve())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,203 @@
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .dbwriter import db_writer
+from .models import Blob, Message
+
+BLOB_DIR = 'blobs'
+HASH_BUFFER = 64 * 1024
+BLOB_PATTERN = re.compile(r'^blobs/[0-9a-f]{2}/([0-9a-f]{64})(\.\w+)?$')
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+# Files written once and never changed: blobs are named by their content and
+# thumbnails by their blob's name. Everything else is revalidated.
+IMMUTABLE_PREFIXES = (BLOB_DIR + '/', 'thumbnails/')
+# Files still being uploaded
+PRIVATE_PREFIXES = (BLOB_DIR + '/incoming/', 'uploads/')
+
+
+def blob_name(digest, file_name):
+    # Keep the extension so the media server can guess the content type
+    extension = os.path.splitext(file_name)[1].lower()
+    return f'{BLOB_DIR}/{digest[:2]}/{digest}{extension}'
+
+
+def hash_file(path):
+    """Return the hex SHA-256 of the file at ``path``"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for data in iter(lambda: source.read(HASH_BUFFER), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def acquire(digest, size):
+    """Take a reference to an existing blob; returns its storage name, or None if there is no such blob"""
+    if not Blob.objects.filter(digest=digest, size=size).update(ref_count=F('ref_count') + 1):
+        return None
+    return Blob.objects.filter(digest=digest).values_list('path', flat=True).first()
+
+
+def release(digest):
+    Blob.objects.filter(digest=digest).update(ref_count=F('ref_count') - 1)
+
+
+def store(path, digest, size, file_name):
+    """Move the file at storage name ``path`` into the blob store and take a reference to it.
+
+    If a blob with the same digest already exists the file is deleted
+    instead. Returns the blob's storage name. The file at ``path`` is only
+    removed once the surrounding transaction commits, so a caller whose
+    transaction rolls back can store it again.
+    """
+    name = acquire(digest, size)
+    if name is not None:
+        transaction.on_commit(lambda: default_storage.delete(path))
+        return name
+
+    name = blob_name(digest, file_name)
+    target = default_storage.path(name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # A file here with no blob row was left by a rolled back store; replace it
+    linked = '%s.%s' % (target, uuid.uuid4().hex)
+    os.link(default_storage.path(path), linked)
+    os.replace(linked, target)
+    try:
+        with transaction.atomic():
+            Blob.objects.create(digest=digest, path=name, size=size, ref_count=1)
+    except IntegrityError:
+        # The same bytes were stored concurrently; share that blob
+        existing = acquire(digest, size)
+        if existing != name:
+            default_storage.delete(name)
+        transaction.on_commit(lambda: default_storage.delete(path))
+        return existing
+    transaction.on_commit(lambda: default_storage.delete(path))
+    return name
+
+
+def store_uploaded(file):
+    """Hash an uploaded file while copying it to storage, then store it as a blob.
+
+    Returns ``(digest, storage name)``.
+    """
+    digest = hashlib.sha256()
+    partial = default_storage.save(f'{BLOB_DIR}/incoming/{file.name}', _HashingReader(file, digest))
+    return digest.hexdigest(), db_writer.call(store, partial, digest.hexdigest(), file.size, file.name)
+
+
+class _HashingReader:
+    """File wrapper that feeds every chunk storage reads from it to ``digest``"""
+
+    def __init__(self, file, digest):
+        self.file = file
+        self.digest = digest
+        self.name = file.name
+        self.size = file.size
+
+    def chunks(self, chunk_size=None):
+        for chunk in self.file.chunks(chunk_size):
+            self.digest.update(chunk)
+            yield chunk
+
+
+class MediaFile:
+    """A file under ``MEDIA_ROOT`` as served by ``views.serve_media``"""
+
+    def __init__(self, name, path, size, mtime):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.immutable = name.startswith(IMMUTABLE_PREFIXES)
+        match = BLOB_PATTERN.match(name)
+        # A blob's digest is a strong validator for free; other files change
+        # only by being replaced, which gives them a new mtime
+        self.etag = '"%s"' % (match.group(1) if match else '%x-%x' % (int(mtime * 1e6), size))
+        self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    @classmethod
+    def open(cls, name):
+        """Return the servable file stored as ``name``, or None.
+
+        Stats the file, so async callers run it on a worker thread.
+        """
+        # Normalized first, so neither 'thumbnails/../uploads/x' nor
+        # 'blobs//incoming/x' gets past the private prefix check
+        name = posixpath.normpath(name)
+        if name.startswith(('/', '../')) or name in ('.', '..') or name.startswith(PRIVATE_PREFIXES):
+            return None
+        try:
+            path = default_storage.path(name)
+            stat = os.stat(path)
+        except (SuspiciousFileOperation, OSError):
+            return None
+        if not os.path.isfile(path):
+            return None
+        return cls(name, path, stat.st_size, stat.st_mtime)
+
+
+def parse_range(header, size):
+    """Return ``(start, end)`` (inclusive) for a single ``Range: bytes=`` header.
+
+    Returns None to serve the whole file (no header, a header we ignore
+    such as several ranges, or a malformed one) and ``False`` when the
+    range lies outside the file (416).
+    """
+    match = RANGE_PATTERN.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    return start, end
+
+
+async def stream_file(path, start, end):
+    """Yield bytes ``start`` to ``end`` (inclusive) of the file at ``path``.
+
+    Chunks of ``CHAT_MEDIA_CHUNK_SIZE`` are read with ``pread`` on a worker
+    thread, so a cold disk never blocks the event loop and concurrent
+    requests share no file position.
+    """
+    fd = await sync_to_async(os.open, thread_sensitive=False)(path, os.O_RDONLY)
+    try:
+        read = sync_to_async(os.pread, thread_sensitive=False)
+        offset = start
+        while offset <= end:
+            data = await read(fd, min(settings.CHAT_MEDIA_CHUNK_SIZE, end - offset + 1), offset)
+            if not data:
+                break  # truncated while we were sending it
+            offset += len(data)
+            yield data
+    finally:
+        os.close(fd)
+
+
+@receiver(post_delete, sender=Message)
+def release_message_blob(sender, instance, **kwargs):
+    # Runs for message deletes and for the cascade from a deleted room, inside their transaction
+    if instance.blob_id:
+        release(instance.blob_id)
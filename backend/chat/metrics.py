@@ -0,0 +1,230 @@
+import bisect
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+# Seconds; fine enough below 1ms for group_send and queue waits, up to the
+# 10s a slow upload can take
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, registry, name, documentation, labels=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+
+
+class Counter(Metric):
+    """A count that only goes up, per combination of label values"""
+
+    kind = 'counter'
+
+    def __init__(self, registry, name, documentation, labels=()):
+        super().__init__(registry, name, documentation, labels)
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return self.header() + [
+            '%s%s %s' % (self.name, format_labels(self.labels, key), format_value(value)) for key, value in values
+        ]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. open connections"""
+
+    kind = 'gauge'
+
+    def __init__(self, registry, name, documentation, labels=()):
+        super().__init__(registry, name, documentation, labels)
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return self.header() + [
+            '%s%s %s' % (self.name, format_labels(self.labels, key), format_value(value)) for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    """Observed values counted into fixed buckets, plus their sum and count"""
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, value, labels=()):
+        if not self.registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, labels=()):
+        return Timer(self, labels)
+
+    def render(self):
+        with self.lock:
+            values = sorted((key, list(counts)) for key, counts in self.values.items())
+        lines = self.header()
+        names = self.labels + ('le',)
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(names, key + (bound,)), cumulative))
+            lines.append('%s_sum%s %r' % (self.name, format_labels(self.labels, key), counts[-1]))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, key), cumulative))
+        return lines
+
+
+class Timer:
+    """``with histogram.time(labels):`` observes how long the block took"""
+
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+
+
+class StatsCollector:
+    """Exports the numbers in a ``stats()`` dict, e.g. ``db_writer.stats()``, as gauges"""
+
+    def __init__(self, registry, prefix, function):
+        self.prefix = prefix
+        self.function = function
+        registry.register(self)
+
+    def render(self):
+        lines = []
+        for key, value in self.function().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = '%s_%s' % (self.prefix, key)
+            lines += ['# TYPE %s gauge' % name, '%s %s' % (name, format_value(value))]
+        return lines
+
+
+class Registry:
+    """Every metric of this worker process, rendered in the Prometheus text format.
+
+    Recording is a dict update under a lock, cheap enough to leave on; set
+    ``CHAT_METRICS=False`` to turn it off (``bench_metrics`` shows the cost).
+    Gauges such as open connections are kept either way.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry(enabled=settings.CHAT_METRICS)
+
+websocket_connections = Gauge(registry, 'chat_websocket_connections', 'Open WebSocket connections')
+frames_in = Counter(registry, 'chat_frames_in_total', 'Operations received from clients', ['type'])
+events_out = Counter(registry, 'chat_events_out_total', 'Events queued for clients, per recipient', ['type'])
+group_send_seconds = Histogram(registry, 'chat_group_send_seconds', 'Time to hand a room event to the channel layer')
+db_wait_seconds = Histogram(registry, 'chat_db_queue_wait_seconds',
+                            'Time a database call waited for its thread', ['pool'])
+db_run_seconds = Histogram(registry, 'chat_db_run_seconds', 'Time a database call ran', ['pool'])
+rate_limited = Counter(registry, 'chat_rate_limited_total', 'Operations refused by a rate limit', ['type', 'scope'])
+rate_limit_closes = Counter(registry, 'chat_rate_limit_closes_total',
+                            'Connections closed for going over their rate limits too often')
+upload_bytes = Counter(registry, 'chat_upload_bytes_total', 'Bytes of uploaded files received', ['kind'])
+view_seconds = Histogram(registry, 'chat_http_request_seconds', 'HTTP request latency',
+                         ['view', 'method', 'status'])
+
+
+class MetricsMiddleware:
+    """Times every request into ``chat_http_request_seconds``, by URL name"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.acall(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.record(request, response, started)
+        return response
+
+    async def acall(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, started)
+        return response
+
+    @staticmethod
+    def record(request, response, started):
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        view_seconds.observe(time.perf_counter() - started, (view, request.method, '%dxx' % (response.status_code // 100)))
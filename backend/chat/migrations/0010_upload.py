@@ -0,0 +1,31 @@
+# Generated by Django 6.0.1 on 2026-10-17 11:20
+
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_messageidblock_alter_message_timestamp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Upload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('sender', models.CharField(max_length=255)),
+                ('room_name', models.CharField(max_length=255)),
+                ('content', models.TextField(blank=True, default='')),
+                ('parent_id', models.BigIntegerField(blank=True, null=True)),
+                ('path', models.CharField(max_length=255)),
+                ('file_name', models.CharField(max_length=255)),
+                ('file_type', models.CharField(max_length=20)),
+                ('size', models.BigIntegerField()),
+                ('received', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-17 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_blob_message_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='thumbnail',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
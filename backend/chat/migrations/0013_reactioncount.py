@@ -0,0 +1,37 @@
+# Generated by Django 6.0.1 on 2026-10-17 14:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_reactions(apps, schema_editor):
+    Reaction = apps.get_model('chat', 'Reaction')
+    ReactionCount = apps.get_model('chat', 'ReactionCount')
+    ReactionCount.objects.bulk_create([
+        ReactionCount(message_id=row['message_id'], emoji=row['emoji'], count=row['n'])
+        for row in Reaction.objects.values('message_id', 'emoji').annotate(n=Count('id'))
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_message_thumbnail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReactionCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emoji', models.CharField(max_length=10)),
+                ('count', models.IntegerField(default=0)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reaction_counts', to='chat.message')),
+            ],
+            options={
+                'unique_together': {('message', 'emoji')},
+            },
+        ),
+        migrations.RunPython(count_reactions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    from chat.search import rebuild, supported
+
+    if supported(schema_editor.connection):
+        rebuild(schema_editor.connection)
+
+
+def drop_index(apps, schema_editor):
+    from chat.search import DROP_SQL, supported
+
+    if supported(schema_editor.connection):
+        for statement in DROP_SQL:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_reactioncount'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0.1 on 2026-10-17 16:05
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def count_messages(apps, schema_editor):
+    Room = apps.get_model('chat', 'Room')
+    Message = apps.get_model('chat', 'Message')
+    for row in Message.objects.filter(room__isnull=False).values('room_id').annotate(n=Count('id'), last=Max('timestamp')):
+        Room.objects.filter(id=row['room_id']).update(message_count=row['n'], last_activity=row['last'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='message_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_activity',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(count_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 6.0.1 on 2026-10-17 17:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_room_message_count_room_last_activity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.BigIntegerField()),
+                ('room_name', models.CharField(max_length=255)),
+                ('total_messages', models.IntegerField(default=0)),
+                ('purged_messages', models.IntegerField(default=0)),
+                ('purged_files', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
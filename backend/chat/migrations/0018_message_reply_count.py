@@ -0,0 +1,30 @@
+# Generated by Django 6.0.1 on 2026-10-17 23:58
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_replies(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    for row in Message.objects.filter(parent__isnull=False).values('parent_id').annotate(n=Count('id')):
+        Message.objects.filter(id=row['parent_id']).update(reply_count=row['n'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_room_last_seq_roomevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='reply_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['parent', 'id'], name='chat_message_parent_id_idx'),
+        ),
+        migrations.RunPython(count_replies, migrations.RunPython.noop),
+    ]
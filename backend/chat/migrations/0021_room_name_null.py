@@ -0,0 +1,31 @@
+# Generated by Django 6.0.1 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+def clear_deleted_names(apps, schema_editor):
+    # Rooms deleted before this migration kept a '<name>/deleted/<id>' name, which a live room could take
+    Room = apps.get_model('chat', 'Room')
+    Room.objects.filter(deleted_at__isnull=False).update(name=None)
+
+
+def restore_deleted_names(apps, schema_editor):
+    Room = apps.get_model('chat', 'Room')
+    for room_id in Room.objects.filter(name__isnull=True).values_list('id', flat=True):
+        Room.objects.filter(id=room_id).update(name='deleted/%d' % room_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0020_message_room_time_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='room',
+            name='name',
+            field=models.CharField(max_length=255, null=True, unique=True),
+        ),
+        migrations.RunPython(clear_deleted_names, restore_deleted_names),
+    ]
@@ -1,22 +1,61 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
 
 class Room(models.Model):
-    name = models.CharField(max_length=255, unique=True)
+    # NULL once the room is deleted, so the name is free for a new room (NULLs never clash)
+    name = models.CharField(max_length=255, unique=True, null=True)
     created_by = models.CharField(max_length=255, null=True, blank=True)
+    # Kept by chat.directory as messages are saved and deleted; repaired by rebuild_room_stats
+    message_count = models.IntegerField(default=0)
+    last_activity = models.DateTimeField(null=True, blank=True)
+    # Set when the room is deleted; its messages are then purged in the background (chat.purge)
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Sequence number of the room's latest event (chat.events)
+    last_seq = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return self.name or f"deleted room {self.id}"
+
+class Blob(models.Model):
+    """A stored file, content-addressed by the SHA-256 of its bytes and shared by every message that uses it"""
+    digest = models.CharField(max_length=64, primary_key=True)
+    path = models.CharField(max_length=255)  # storage name under MEDIA_ROOT
+    size = models.BigIntegerField()
+    # Messages referencing this blob; kept by chat.media, repaired by gc_media
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
-        return self.name
+        return f"{self.digest} ({self.ref_count} refs)"
 
 class Message(models.Model):
     room = models.ForeignKey(Room, related_name='messages', on_delete=models.CASCADE, null=True, blank=True)
     sender = models.CharField(max_length=255)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set explicitly (not auto_now_add) so write-behind saves keep the broadcast timestamp
+    timestamp = models.DateTimeField(default=timezone.now)
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='replies')
     is_edited = models.BooleanField(default=False)
     file = models.FileField(upload_to='chat_files/', null=True, blank=True)
     file_type = models.CharField(max_length=20, null=True, blank=True)  # 'image' or 'video'
     file_name = models.CharField(max_length=255, null=True, blank=True)
+    thumbnail = models.CharField(max_length=255, null=True, blank=True)  # storage name, set by chat.thumbnails
+    # Set for files stored content-addressed; ``file`` then names the blob's path
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.PROTECT, related_name='messages')
+    # Kept by chat.threads as replies are saved and deleted; repaired by rebuild_room_stats
+    reply_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of room history: WHERE room_id = ? AND id < ? ORDER BY id DESC
+            models.Index(fields=['room', 'id'], name='chat_message_room_id_idx'),
+            # Pages of a thread: WHERE parent_id = ? AND id > ? ORDER BY id
+            models.Index(fields=['parent', 'id'], name='chat_message_parent_id_idx'),
+            # Rooms with messages to archive: one EXISTS (room_id = ? AND timestamp < ?) per room
+            models.Index(fields=['room', 'timestamp'], name='chat_message_room_time_idx'),
+        ]
 
     def __str__(self):
         return f"{self.sender}: {self.content}"
@@ -31,3 +70,85 @@ class Reaction(models.Model):
 
     def __str__(self):
         return f"{self.sender} reacted {self.emoji} to message {self.message.id}"
+
+class ReactionCount(models.Model):
+    """How many senders reacted to a message with an emoji; kept in step with Reaction by chat.reactions"""
+    message = models.ForeignKey(Message, related_name='reaction_counts', on_delete=models.CASCADE)
+    emoji = models.CharField(max_length=10)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('message', 'emoji')
+
+    def __str__(self):
+        return f"{self.emoji} x{self.count} on message {self.message_id}"
+
+class MessageIdBlock(models.Model):
+    # Single row: next message id not yet handed out to any process (see chat.writebehind)
+    next_id = models.BigIntegerField(default=1)
+
+    def __str__(self):
+        return f"next message id {self.next_id}"
+
+class RoomEvent(models.Model):
+    """One broadcast event of a room as sent to clients, kept for clients resuming with ?since="""
+    room = models.ForeignKey(Room, related_name='events', on_delete=models.CASCADE)
+    seq = models.BigIntegerField()
+    frame = models.TextField()
+
+    class Meta:
+        unique_together = ('room', 'seq')
+
+    def __str__(self):
+        return f"event {self.seq} in room {self.room_id}"
+
+class ArchiveSegment(models.Model):
+    """A file of one room's archived messages, moved out of the Message table by chat.archive"""
+    room = models.ForeignKey(Room, related_name='archive_segments', on_delete=models.CASCADE)
+    path = models.CharField(max_length=255)  # under CHAT_ARCHIVE_DIR
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.IntegerField()
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # The segments a history page may need: WHERE room_id = ? ORDER BY last_id DESC
+            models.Index(fields=['room', 'last_id'], name='chat_archive_room_last_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.path} ({self.message_count} messages)"
+
+class RoomDeletion(models.Model):
+    """Progress of purging a deleted room's messages, reactions and files"""
+    room_id = models.BigIntegerField()  # the Room row itself is removed once the purge finishes
+    room_name = models.CharField(max_length=255)
+    total_messages = models.IntegerField(default=0)
+    purged_messages = models.IntegerField(default=0)
+    purged_files = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.room_name} ({self.purged_messages}/{self.total_messages})"
+
+class Upload(models.Model):
+    """A chunked file upload in progress; the file is written in place at ``path``"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    sender = models.CharField(max_length=255)
+    room_name = models.CharField(max_length=255)
+    content = models.TextField(blank=True, default='')
+    parent_id = models.BigIntegerField(null=True, blank=True)
+    path = models.CharField(max_length=255)  # storage name under MEDIA_ROOT
+    file_name = models.CharField(max_length=255)
+    file_type = models.CharField(max_length=20)  # 'image' or 'video'
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.file_name} ({self.received}/{self.size})"
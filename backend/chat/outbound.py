@@ -0,0 +1,145 @@
+import asyncio
+import logging
+
+# Process-wide counters, reported by /api/stats/
+outbound_stats = {'frames': 0, 'merged_frames': 0, 'dropped_typing': 0, 'slow_consumers': 0}
+
+logger = logging.getLogger(__name__)
+
+
+def merge_json(frames):
+    # Each frame is already a JSON document, so joining them is a valid array
+    return '[' + ','.join(frames) + ']'
+
+
+class Flusher:
+    """Sends the merged frames of every queue with a given ``window``, from one task per process.
+
+    Queues with frames waiting are marked dirty; once per ``window`` the
+    task sends each one's frames as a single frame. A broadcast to a
+    thousand sockets therefore schedules one timer, not a thousand.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.dirty = {}  # queue -> None, in the order they became dirty
+        self.task = None
+
+    def schedule(self, queue):
+        self.dirty[queue] = None
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while self.dirty:
+            await asyncio.sleep(self.window)
+            queues, self.dirty = self.dirty, {}
+            for queue in queues:
+                try:
+                    await queue.drain()
+                except Exception:
+                    logger.exception('Sending a merged frame failed')
+
+
+flushers = {}
+
+
+def flusher(window):
+    if window not in flushers:
+        flushers[window] = Flusher(window)
+    return flushers[window]
+
+
+class OutboundQueue:
+    """Per-connection send queue that merges frames produced close together.
+
+    Frames queued within ``window`` seconds go out as one frame (a single
+    frame as is, several as an array), sent by the process-wide Flusher for
+    that window. With no window and nothing waiting, a frame is sent
+    straight away. Queued typing snapshots are superseded by the next one.
+    At most ``max_bytes`` may wait: past that, typing snapshots are dropped
+    first, and if that is not enough ``put`` returns False so the caller
+    can disconnect the slow client instead of buffering for it.
+    """
+
+    def __init__(self, send, window=0.02, max_bytes=1024 * 1024, codec=None):
+        self.send = send
+        self.window = window
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.frames = []  # [data, is typing snapshot]
+        self.size = 0
+        self.sending = False
+        self.closed = False
+
+    async def put(self, data, typing=False):
+        if not self.window and not self.frames and not self.sending:
+            # Nothing to merge with: send now rather than schedule anything
+            outbound_stats['frames'] += 1
+            self.sending = True
+            try:
+                await self.send(data)
+            finally:
+                self.sending = False
+            return True
+        if typing:
+            # Only the latest snapshot matters
+            self.discard_typing()
+        self.frames.append([data, typing])
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            outbound_stats['dropped_typing'] += self.discard_typing()
+            if self.size > self.max_bytes:
+                self.frames, self.size = [], 0
+                outbound_stats['slow_consumers'] += 1
+                return False
+        flusher(self.window).schedule(self)
+        return True
+
+    def discard_typing(self):
+        kept = [frame for frame in self.frames if not frame[1]]
+        dropped = len(self.frames) - len(kept)
+        if dropped:
+            self.frames = kept
+            self.size = sum(len(data) for data, _ in kept)
+        return dropped
+
+    async def drain(self):
+        if self.closed or not self.frames:
+            return
+        if self.sending:
+            # Frames queued while a send waits on the client go in the next merge
+            flusher(self.window).schedule(self)
+            return
+        frames, self.frames, self.size = [data for data, _ in self.frames], [], 0
+        await self.send_frames(frames)
+
+    async def send_frames(self, frames):
+        outbound_stats['frames'] += 1
+        if len(frames) > 1:
+            outbound_stats['merged_frames'] += len(frames)
+        self.sending = True
+        try:
+            await self.send(self.merge(frames))
+        finally:
+            self.sending = False
+
+    async def flush(self):
+        """Send everything queued now, e.g. before closing; stops merging from then on"""
+        self.window = 0
+        while self.frames and not self.closed:
+            if self.sending:
+                await asyncio.sleep(0)
+            else:
+                await self.drain()
+
+    def cancel(self):
+        self.frames, self.size = [], 0
+        self.closed = True
+
+    def merge(self, frames):
+        if len(frames) == 1:
+            return frames[0]
+        if self.codec is None:
+            return merge_json(frames)
+        return self.codec.array_header(len(frames)) + b''.join(frames)
@@ -0,0 +1,238 @@
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+from channels.exceptions import ChannelFull
+from django.conf import settings
+
+from .broadcast import PROCESS_ORIGIN
+
+# Every worker process listens on one channel in this group for the presence
+# changes of every other process
+PRESENCE_GROUP = 'presence'
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceRegistry:
+    """Who is online in each room, across all worker processes.
+
+    Each process owns the connections it serves and publishes a delta to
+    ``PRESENCE_GROUP`` when a user's first connection to a room opens or
+    their last one closes. Every process applies those deltas to a
+    per-room count of how many processes each user is connected through,
+    so joins and leaves cost O(1) and any room's member list or count can
+    be read locally, e.g. by the room directory.
+
+    Deltas are numbered per process. A process that notices a gap (a delta
+    was dropped) or hears from a process it does not know asks that process
+    for a snapshot. Every process sends a heartbeat each ``heartbeat``
+    seconds; the members of a process not heard from for ``ttl`` seconds
+    (it crashed or was killed) are dropped. Dead client connections are
+    closed by the WebSocket server's own ping timeout, which ends in
+    ``leave`` like any other disconnect.
+    """
+
+    def __init__(self, heartbeat=10.0, ttl=30.0):
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        self.local = {}  # room -> {user: {channel name}} for this process's connections
+        self.sockets = {}  # room -> {channel name} of every local socket, named or not
+        self.origins = {}  # origin -> {'number', 'expires', 'channel', 'rooms': {room: {user}}}
+        self.members = {}  # room -> {user: number of processes they are connected through}
+        self.numbers = itertools.count(1)
+        self.number = 0
+        self.channel_layer = None
+        self.channel = None
+        self.tasks = []
+        self.start_lock = asyncio.Lock()
+
+    def online(self, room_name):
+        return sorted(self.members.get(room_name, ()))
+
+    def count(self, room_name):
+        return len(self.members.get(room_name, ()))
+
+    def stats(self):
+        return {
+            'rooms': len(self.members),
+            'online': sum(len(users) for users in self.members.values()),
+            'local_sockets': sum(len(channels) for channels in self.sockets.values()),
+            'local_rooms': len(self.sockets),
+            'processes': len(self.origins),
+        }
+
+    async def start(self, channel_layer):
+        async with self.start_lock:
+            if self.channel is not None:
+                return
+            self.channel_layer = channel_layer
+            self.channel = await channel_layer.new_channel('presence.')
+            self.origins[PROCESS_ORIGIN] = {'number': 0, 'expires': None, 'channel': self.channel, 'rooms': {}}
+            await channel_layer.group_add(PRESENCE_GROUP, self.channel)
+            self.tasks = [asyncio.create_task(self.listen()), asyncio.create_task(self.beat())]
+            # Everyone already running answers with a snapshot
+            await channel_layer.group_send(PRESENCE_GROUP, {'type': 'presence.hello', 'origin': PROCESS_ORIGIN,
+                                                            'channel': self.channel})
+
+    async def join(self, channel_layer, room_name, user, channel_name):
+        """Register a connection; returns the room's member list including ``user``"""
+        await self.start(channel_layer)
+        if user:
+            channels = self.local.setdefault(room_name, {}).setdefault(user, set())
+            channels.add(channel_name)
+            if len(channels) == 1:
+                await self.publish(room_name, joined=[user])
+        # Deltas from here on reach the socket; the list returned covers everything before
+        self.sockets.setdefault(room_name, set()).add(channel_name)
+        return self.online(room_name)
+
+    async def leave(self, room_name, user, channel_name):
+        sockets = self.sockets.get(room_name)
+        if sockets is not None:
+            sockets.discard(channel_name)
+            if not sockets:
+                del self.sockets[room_name]
+        users = self.local.get(room_name)
+        if not user or not users or channel_name not in users.get(user, ()):
+            return
+        users[user].discard(channel_name)
+        if not users[user]:
+            del users[user]
+            if not users:
+                del self.local[room_name]
+            await self.publish(room_name, left=[user])
+
+    async def publish(self, room_name, joined=(), left=()):
+        self.number = next(self.numbers)
+        await self.apply(PROCESS_ORIGIN, self.number, room_name, joined, left)
+        await self.channel_layer.group_send(PRESENCE_GROUP, {
+            'type': 'presence.delta',
+            'origin': PROCESS_ORIGIN,
+            'channel': self.channel,
+            'number': self.number,
+            'room': room_name,
+            'joined': list(joined),
+            'left': list(left),
+        })
+
+    async def apply(self, origin, number, room_name, joined, left):
+        """Apply one process's delta and tell local sockets in the room what changed overall"""
+        state = self.origins[origin]
+        state['number'] = number
+        users = state['rooms'].setdefault(room_name, set())
+        counts = self.members.setdefault(room_name, {})
+        came, went = [], []
+        for user in joined:
+            if user not in users:
+                users.add(user)
+                counts[user] = counts.get(user, 0) + 1
+                if counts[user] == 1:
+                    came.append(user)
+        for user in left:
+            if user in users:
+                users.discard(user)
+                counts[user] -= 1
+                if not counts[user]:
+                    del counts[user]
+                    went.append(user)
+        if not users:
+            del state['rooms'][room_name]
+        if not counts:
+            del self.members[room_name]
+        if came or went:
+            await self.notify(room_name, came, went)
+
+    async def notify(self, room_name, joined, left):
+        frame = json.dumps({'type': 'presence_delta', 'joined': joined, 'left': left})
+        for channel_name in list(self.sockets.get(room_name, ())):
+            try:
+                await self.channel_layer.send(channel_name, {'type': 'presence_delta', 'frame': frame})
+            except ChannelFull:
+                pass  # that socket is already too far behind to care
+
+    async def replace(self, origin, number, rooms):
+        """Make a process's members match its snapshot ``rooms``"""
+        state = self.origins[origin]
+        for room_name in set(state['rooms']) | set(rooms):
+            old = state['rooms'].get(room_name, set())
+            new = set(rooms.get(room_name, ()))
+            if old != new:
+                await self.apply(origin, number, room_name, new - old, old - new)
+        state['number'] = number
+
+    async def forget(self, origin):
+        await self.replace(origin, self.origins[origin]['number'], {})
+        del self.origins[origin]
+
+    def snapshot(self):
+        return {room_name: sorted(users) for room_name, users in self.local.items()}
+
+    async def request_snapshot(self, channel):
+        await self.channel_layer.send(channel, {'type': 'presence.hello', 'origin': PROCESS_ORIGIN,
+                                                'channel': self.channel})
+
+    def known(self, message):
+        """Track a remote process; returns False if it is new to us"""
+        state = self.origins.get(message['origin'])
+        if state is None:
+            self.origins[message['origin']] = {'number': 0, 'expires': time.monotonic() + self.ttl,
+                                               'channel': message['channel'], 'rooms': {}}
+            return False
+        state['expires'] = time.monotonic() + self.ttl
+        return True
+
+    async def listen(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel)
+            if message.get('origin') == PROCESS_ORIGIN:
+                continue
+            try:
+                await self.handle(message)
+            except Exception:
+                logger.exception('Presence message %s failed', message.get('type'))
+
+    async def handle(self, message):
+        kind = message['type']
+        origin = message['origin']
+        if kind == 'presence.hello':
+            self.known(message)
+            await self.channel_layer.send(message['channel'], {
+                'type': 'presence.snapshot', 'origin': PROCESS_ORIGIN, 'channel': self.channel,
+                'number': self.number, 'rooms': self.snapshot(),
+            })
+        elif kind == 'presence.snapshot':
+            self.known(message)
+            # A delta newer than the snapshot may already be applied; the next heartbeat catches up
+            if message['number'] >= self.origins[origin]['number']:
+                await self.replace(origin, message['number'], message['rooms'])
+        elif kind == 'presence.delta':
+            new = not self.known(message)
+            state = self.origins[origin]
+            if message['number'] <= state['number']:
+                return  # already covered by a snapshot
+            gap = message['number'] != state['number'] + 1
+            await self.apply(origin, message['number'], message['room'], message['joined'], message['left'])
+            if new or gap:
+                await self.request_snapshot(message['channel'])
+        elif kind == 'presence.heartbeat':
+            if not self.known(message) or message['number'] != self.origins[origin]['number']:
+                await self.request_snapshot(message['channel'])
+
+    async def beat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            # Renewing the membership keeps the channel layer's group expiry from dropping it
+            await self.channel_layer.group_add(PRESENCE_GROUP, self.channel)
+            await self.channel_layer.group_send(PRESENCE_GROUP, {
+                'type': 'presence.heartbeat', 'origin': PROCESS_ORIGIN, 'channel': self.channel, 'number': self.number,
+            })
+            now = time.monotonic()
+            for origin, state in list(self.origins.items()):
+                if state['expires'] is not None and state['expires'] <= now:
+                    await self.forget(origin)
+
+
+presence_registry = PresenceRegistry(heartbeat=settings.CHAT_PRESENCE_HEARTBEAT, ttl=settings.CHAT_PRESENCE_TTL)
@@ -0,0 +1,122 @@
+import asyncio
+import contextvars
+import logging
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .archive import delete_segment_files
+from .dbwriter import db_writer
+from .models import ArchiveSegment, Blob, Message, Room, RoomDeletion
+from .thumbnails import thumbnail_name
+
+logger = logging.getLogger(__name__)
+
+def mark_deleted(room):
+    """Hide a room and free its name; returns the RoomDeletion that tracks purging it.
+
+    The name moves to the RoomDeletion and the room's becomes NULL, so a new
+    room can take it straight away whatever names rooms are given.
+    """
+    with transaction.atomic():
+        Room.objects.filter(id=room.id).update(name=None, deleted_at=timezone.now())
+        return RoomDeletion.objects.create(room_id=room.id, room_name=room.name, total_messages=Message.objects.filter(room_id=room.id).count())
+
+
+def purge_chunk(deletion_id, room_id, size):
+    """Delete up to ``size`` of a deleted room's messages; returns how many were deleted.
+
+    Reactions and reaction counts go with them, blob references are
+    released (see chat.media) and blobs nothing uses anymore are deleted
+    with their files. Once the room is empty, the room itself and its
+    archived messages are deleted and the purge marked finished. Runs on
+    the writer thread, so uploads that might take a reference to the same
+    blob are not running meanwhile.
+    """
+    # Newest first, so replies go before the messages they point to
+    ids = list(Message.objects.filter(room_id=room_id).order_by('-id').values_list('id', flat=True)[:size])
+    with transaction.atomic():
+        if not ids:
+            # Archived messages go with the room: its segment rows cascade, the files follow on commit
+            segments = list(ArchiveSegment.objects.filter(room_id=room_id).values_list('path', flat=True))
+            Room.objects.filter(id=room_id).delete()
+            transaction.on_commit(lambda: delete_segment_files(segments))
+            RoomDeletion.objects.filter(id=deletion_id).update(finished_at=timezone.now())
+            return 0
+        digests = set(Message.objects.filter(id__in=ids, blob__isnull=False).values_list('blob_id', flat=True))
+        Message.objects.filter(id__in=ids).delete()
+        files = []
+        for digest, path in Blob.objects.filter(digest__in=digests, ref_count__lte=0).values_list('digest', 'path'):
+            if Blob.objects.filter(digest=digest, ref_count__lte=0, messages__isnull=True).delete()[0]:
+                files.append(path)
+        RoomDeletion.objects.filter(id=deletion_id).update(
+            purged_messages=F('purged_messages') + len(ids),
+            purged_files=F('purged_files') + len(files),
+        )
+        transaction.on_commit(lambda: delete_files(files))
+    return len(ids)
+
+
+def delete_files(paths):
+    for path in paths:
+        default_storage.delete(path)
+        default_storage.delete(thumbnail_name(path))
+
+
+class RoomPurger:
+    """Background task that purges deleted rooms one chunk at a time.
+
+    Each chunk of ``chunk_size`` messages is one short transaction on the
+    writer thread, followed by a ``pause``, so other rooms' writes get the
+    database in between. Unfinished purges (e.g. from before a restart) are
+    picked up when the purger first starts.
+    """
+
+    def __init__(self, chunk_size=500, pause=0.05):
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.queue = None
+        self.task = None
+        self.purged = 0
+        self.failures = 0
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'purged_messages': self.purged,
+            'failures': self.failures,
+        }
+
+    async def submit(self, deletion_id, room_id):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self.task is None or self.task.done():
+            pending = await db_writer.run(lambda: list(
+                RoomDeletion.objects.filter(finished_at__isnull=True).exclude(id=deletion_id).values_list('id', 'room_id')))
+            for job in pending:
+                self.queue.put_nowait(job)
+            # Fresh context, as for thumbnail workers: the task outlives the request
+            self.task = asyncio.create_task(self.run(), context=contextvars.Context())
+        self.queue.put_nowait((deletion_id, room_id))
+
+    async def run(self):
+        while True:
+            deletion_id, room_id = await self.queue.get()
+            try:
+                while True:
+                    deleted = await db_writer.run(purge_chunk, deletion_id, room_id, self.chunk_size)
+                    self.purged += deleted
+                    if not deleted:
+                        break
+                    await asyncio.sleep(self.pause)
+            except Exception:
+                self.failures += 1
+                logger.exception('Purging deleted room %s failed', room_id)
+            finally:
+                self.queue.task_done()
+
+
+room_purger = RoomPurger(chunk_size=settings.CHAT_PURGE_CHUNK_SIZE, pause=settings.CHAT_PURGE_PAUSE)
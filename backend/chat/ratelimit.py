@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+
+from channels.exceptions import ChannelFull
+from django.conf import settings
+
+from .broadcast import PROCESS_ORIGIN
+
+# Every worker process listens on one channel in this group for what senders
+# used on every other process
+RATE_LIMIT_GROUP = 'ratelimit'
+# Full sender buckets carry no state and are dropped this often (seconds)
+SWEEP_INTERVAL = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+def parse_limits(spec):
+    """Parse ``'chat_message=5/20,reaction=10/30'`` into ``{type: (rate per second, burst)}``"""
+    limits = {}
+    for item in filter(None, (item.strip() for item in spec.split(','))):
+        operation_type, _, limit = item.partition('=')
+        rate, _, burst = limit.partition('/')
+        limits[operation_type.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+class TokenBucket:
+    """Holds up to ``burst`` tokens, refilled at ``rate`` per second"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, now):
+        if self.refill(now) < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        """Seconds until the next token"""
+        return (1 - self.tokens) / self.rate if self.rate else float('inf')
+
+
+class ConnectionLimits:
+    """One socket's buckets, checked together with its senders' shared buckets"""
+
+    __slots__ = ('limiter', 'buckets', 'strikes')
+
+    def __init__(self, limiter, now):
+        self.limiter = limiter
+        self.buckets = {}
+        self.strikes = TokenBucket(limiter.strikes / limiter.strike_window, limiter.strikes, now)
+
+    def check(self, operation_type, sender):
+        """Take a token for one operation; returns None, or ``(scope, retry_after)`` if it is refused.
+
+        The token is only taken when both the connection's and the sender's
+        bucket have one, so a refusal costs the client nothing.
+        """
+        limiter = self.limiter
+        if operation_type not in limiter.limited:
+            return None
+        now = time.monotonic()
+        bucket = self.buckets.get(operation_type)
+        if bucket is None:
+            limit = limiter.connection_limits.get(operation_type)
+            if limit is not None:
+                bucket = self.buckets[operation_type] = TokenBucket(limit[0], limit[1], now)
+        if bucket is not None and bucket.refill(now) < 1:
+            return 'connection', bucket.retry_after()
+
+        sender_bucket = limiter.sender_bucket(operation_type, sender, now)
+        if sender_bucket is not None:
+            if sender_bucket.refill(now) < 1:
+                return 'sender', sender_bucket.retry_after()
+            sender_bucket.tokens -= 1
+            key = (operation_type, sender)
+            limiter.usage[key] = limiter.usage.get(key, 0) + 1
+        if bucket is not None:
+            bucket.tokens -= 1
+        return None
+
+    def strike(self):
+        """Count a refusal; returns True once the socket has been refused too often and should be closed"""
+        return not self.strikes.take(time.monotonic())
+
+
+class RateLimiter:
+    """Token-bucket rate limits per connection and per sender, for each operation type.
+
+    Decisions are made in memory on the event loop: a dict lookup and a
+    little float arithmetic per bucket. Connection buckets belong to the
+    socket. Sender buckets are shared by every socket of this process, and
+    kept in step across worker processes: every ``sync_interval`` seconds
+    each process publishes what each sender used to ``RATE_LIMIT_GROUP``,
+    and the others take the same tokens from their copy of the bucket
+    (which may leave it below zero). A sender spread over several processes
+    can exceed the limit by what they send within one interval, no more.
+    """
+
+    def __init__(self, connection_limits, sender_limits, strikes=20, strike_window=10.0, sync_interval=0.25):
+        self.connection_limits = connection_limits
+        self.sender_limits = sender_limits
+        self.limited = set(connection_limits) | set(sender_limits)
+        self.strikes = strikes
+        self.strike_window = strike_window
+        self.sync_interval = sync_interval
+        self.senders = {}  # (type, sender) -> TokenBucket
+        self.usage = {}  # (type, sender) -> tokens taken here since the last publish
+        self.channel_layer = None
+        self.channel = None
+        self.tasks = []
+        self.start_lock = asyncio.Lock()
+        # Counters
+        self.refused = 0
+        self.closed = 0
+        self.published = 0
+        self.applied = 0
+
+    def connection(self):
+        return ConnectionLimits(self, time.monotonic())
+
+    def sender_bucket(self, operation_type, sender, now):
+        key = (operation_type, sender)
+        bucket = self.senders.get(key)
+        if bucket is None:
+            limit = self.sender_limits.get(operation_type)
+            if limit is None:
+                return None
+            bucket = self.senders[key] = TokenBucket(limit[0], limit[1], now)
+        return bucket
+
+    def stats(self):
+        return {
+            'sender_buckets': len(self.senders),
+            'refused': self.refused,
+            'closed': self.closed,
+            'usage_published': self.published,
+            'usage_applied': self.applied,
+        }
+
+    async def start(self, channel_layer):
+        if not self.sender_limits:
+            return
+        async with self.start_lock:
+            if self.channel is not None:
+                return
+            self.channel_layer = channel_layer
+            self.channel = await channel_layer.new_channel('ratelimit.')
+            await channel_layer.group_add(RATE_LIMIT_GROUP, self.channel)
+            self.tasks = [asyncio.create_task(self.listen()), asyncio.create_task(self.publish())]
+
+    async def publish(self):
+        swept = time.monotonic()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            if self.usage:
+                usage, self.usage = self.usage, {}
+                try:
+                    await self.channel_layer.group_send(RATE_LIMIT_GROUP, {
+                        'type': 'ratelimit.usage',
+                        'origin': PROCESS_ORIGIN,
+                        'usage': [[operation_type, sender, amount] for (operation_type, sender), amount in usage.items()],
+                    })
+                    self.published += 1
+                except ChannelFull:
+                    logger.warning('Rate limit usage dropped: a worker process is not reading')
+            now = time.monotonic()
+            if now - swept > SWEEP_INTERVAL:
+                swept = now
+                self.senders = {key: bucket for key, bucket in self.senders.items() if bucket.refill(now) < bucket.burst}
+
+    async def listen(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel)
+            if message.get('type') != 'ratelimit.usage' or message['origin'] == PROCESS_ORIGIN:
+                continue
+            now = time.monotonic()
+            for operation_type, sender, amount in message['usage']:
+                bucket = self.sender_bucket(operation_type, sender, now)
+                if bucket is not None:
+                    bucket.refill(now)
+                    bucket.tokens -= amount
+            self.applied += 1
+
+
+rate_limiter = RateLimiter(
+    connection_limits=parse_limits(settings.CHAT_RATE_LIMITS_CONNECTION),
+    sender_limits=parse_limits(settings.CHAT_RATE_LIMITS_SENDER),
+    strikes=settings.CHAT_RATE_LIMIT_STRIKES,
+    strike_window=settings.CHAT_RATE_LIMIT_STRIKE_WINDOW,
+    sync_interval=settings.CHAT_RATE_LIMIT_SYNC_INTERVAL,
+)
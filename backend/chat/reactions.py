@@ -0,0 +1,123 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
+
+from .models import Message, Reaction, ReactionCount
+
+
+def apply_toggles(toggles, room_id):
+    """Toggle ``(message_id, sender, emoji)`` reactions in room ``room_id`` and update the per-message counts.
+
+    Everything happens in one transaction, and the counts are changed with
+    relative UPDATEs so concurrent toggles cannot lose increments. Returns one
+    delta per (message, sender) that changed, ``{'message_id', 'sender',
+    'added', 'removed', 'counts'}``, where ``counts`` holds the new count of
+    every emoji the toggles touched. Toggles for messages that are missing or
+    belong to another room are skipped.
+    """
+    try:
+        return toggle_reactions(toggles, room_id)
+    except IntegrityError:
+        # The same reaction was added concurrently; toggle against the new state
+        return toggle_reactions(toggles, room_id)
+
+
+def toggle_reactions(toggles, room_id):
+    with transaction.atomic():
+        found = set(Message.objects.filter(id__in={toggle[0] for toggle in toggles}, room_id=room_id)
+                    .values_list('id', flat=True))
+        toggles = [toggle for toggle in toggles if toggle[0] in found]
+        if not toggles:
+            return []
+        before = set(Reaction.objects.filter(
+            message_id__in={toggle[0] for toggle in toggles},
+            sender__in={toggle[1] for toggle in toggles},
+        ).values_list('message_id', 'sender', 'emoji'))
+        after = set(before)
+        for toggle in toggles:
+            if toggle in after:
+                after.discard(toggle)
+            else:
+                after.add(toggle)
+        added = after - before
+        removed = before - after
+
+        if removed:
+            condition = Q()
+            for message_id, sender, emoji in removed:
+                condition |= Q(message_id=message_id, sender=sender, emoji=emoji)
+            Reaction.objects.filter(condition).delete()
+        Reaction.objects.bulk_create([
+            Reaction(message_id=message_id, sender=sender, emoji=emoji) for message_id, sender, emoji in added
+        ])
+
+        changes = {}
+        for message_id, _, emoji in added:
+            changes[message_id, emoji] = changes.get((message_id, emoji), 0) + 1
+        for message_id, _, emoji in removed:
+            changes[message_id, emoji] = changes.get((message_id, emoji), 0) - 1
+        counts = {key: change_count(key, change) for key, change in changes.items()}
+
+    deltas = {}
+    for action, keys in (('added', added), ('removed', removed)):
+        for message_id, sender, emoji in sorted(keys):
+            delta = deltas.setdefault((message_id, sender), {
+                'message_id': message_id, 'sender': sender, 'added': [], 'removed': [], 'counts': {},
+            })
+            delta[action].append(emoji)
+            delta['counts'][emoji] = counts[message_id, emoji]
+    return list(deltas.values())
+
+
+def change_count(key, change):
+    """Add ``change`` to a (message_id, emoji) count; returns the new count"""
+    message_id, emoji = key
+    counts = ReactionCount.objects.filter(message_id=message_id, emoji=emoji)
+    if not change:
+        # One sender's add cancelled another's remove
+        return counts.values_list('count', flat=True).first() or 0
+    if not counts.update(count=F('count') + change):
+        if change < 0:
+            # Nothing counted to take away from; rows only exist for counts above zero
+            return 0
+        try:
+            with transaction.atomic():
+                ReactionCount.objects.create(message_id=message_id, emoji=emoji, count=change)
+            return change
+        except IntegrityError:
+            # Created concurrently; fall back to the relative update
+            counts.update(count=F('count') + change)
+    count = counts.values_list('count', flat=True).first() or 0
+    if count <= 0:
+        counts.filter(count__lte=0).delete()
+    return max(count, 0)
+
+
+def rebuild_counts(dry_run=False):
+    """Make ReactionCount match the Reaction table; returns how many counts were wrong"""
+    actual = {
+        (row['message_id'], row['emoji']): row['n']
+        for row in Reaction.objects.values('message_id', 'emoji').annotate(n=Count('id'))
+    }
+    stored = {
+        (row.message_id, row.emoji): row
+        for row in ReactionCount.objects.all()
+    }
+    wrong = 0
+    with transaction.atomic():
+        for key, row in stored.items():
+            if actual.get(key) != row.count:
+                wrong += 1
+                if dry_run:
+                    continue
+                if key in actual:
+                    ReactionCount.objects.filter(pk=row.pk).update(count=actual[key])
+                else:
+                    row.delete()
+        missing = [key for key in actual if key not in stored]
+        wrong += len(missing)
+        if not dry_run:
+            ReactionCount.objects.bulk_create([
+                ReactionCount(message_id=message_id, emoji=emoji, count=actual[message_id, emoji])
+                for message_id, emoji in missing
+            ])
+    return wrong
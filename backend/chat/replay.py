@@ -0,0 +1,193 @@
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class RoomBuffer:
+    """The most recent chat_message payloads of one room, keyed by message id"""
+
+    def __init__(self):
+        self.entries = OrderedDict()  # message id -> [payload, encoded size]
+        self.size = 0
+        self.members = 0
+        self.frame = None  # cached message_history frame
+        self.applied = {}  # origin process -> last event number applied from it
+
+    def sized(self, payload):
+        return len(json.dumps(payload))
+
+    def append(self, payload, size):
+        # A message is sent again when it changes (e.g. its thumbnail is ready)
+        previous = self.entries.get(payload['id'])
+        if previous is not None:
+            self.size -= previous[1]
+        self.entries[payload['id']] = [payload, size]
+        self.size += size
+
+    def prepend(self, payloads):
+        older = [payload for payload in payloads if not self.entries or payload['id'] < next(iter(self.entries))]
+        entries = OrderedDict((payload['id'], [payload, self.sized(payload)]) for payload in older)
+        entries.update(self.entries)
+        self.entries = entries
+        self.size = sum(size for _, size in self.entries.values())
+
+    def update(self, message_id, change):
+        entry = self.entries.get(message_id)
+        if entry is None:
+            return False
+        # Payloads may be shared with in-flight events, so copy before changing
+        payload = dict(entry[0])
+        change(payload)
+        size = self.sized(payload)
+        self.size += size - entry[1]
+        entry[0], entry[1] = payload, size
+        return True
+
+    def remove(self, message_id):
+        entry = self.entries.pop(message_id, None)
+        if entry is None:
+            return False
+        self.size -= entry[1]
+        return True
+
+    def trim(self, max_messages, max_bytes):
+        while self.entries and (len(self.entries) > max_messages or self.size > max_bytes):
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+
+class ReplayBuffers:
+    """Per-room ring buffers of recent messages, replayed to sockets as they join.
+
+    A process only keeps a buffer while it has sockets in the room: the first
+    join seeds it from the database, broadcasts keep it current, and the last
+    leave drops it. Each buffer holds at most ``max_messages`` messages and
+    ``max_bytes`` of encoded payload, oldest evicted first.
+    """
+
+    def __init__(self, max_messages=50, max_bytes=256 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def join(self, room_name):
+        """Register a socket; returns True if the room's buffer needs seeding"""
+        with self.lock:
+            buffer = self.rooms.get(room_name)
+            if buffer is None:
+                buffer = self.rooms[room_name] = RoomBuffer()
+                buffer.members = 1
+                return True
+            buffer.members += 1
+            return False
+
+    def leave(self, room_name):
+        with self.lock:
+            buffer = self.rooms.get(room_name)
+            if buffer is None:
+                return
+            buffer.members -= 1
+            if buffer.members <= 0:
+                # Nobody here to receive the room's events, so the buffer
+                # would go stale; the next join seeds a fresh one
+                del self.rooms[room_name]
+
+    def seed(self, room_name, payloads):
+        """Fill a new buffer with history older than anything broadcast since the join"""
+        with self.lock:
+            buffer = self.rooms.get(room_name)
+            if buffer is None:
+                return
+            buffer.prepend(payloads)
+            buffer.trim(self.max_messages, self.max_bytes)
+            buffer.frame = None
+
+    def replay_frame(self, room_name):
+        """Return the encoded message_history frame for a room, or None if it is empty"""
+        with self.lock:
+            buffer = self.rooms.get(room_name)
+            if buffer is None or not buffer.entries:
+                return None
+            if buffer.frame is None:
+                buffer.frame = json.dumps({
+                    'type': 'message_history',
+                    'messages': [payload for payload, _ in buffer.entries.values()],
+                })
+            return buffer.frame
+
+    def apply(self, room_name, event_type, payload, size=None):
+        """Apply a broadcast event to the room's buffer, if this process keeps one"""
+        with self.lock:
+            buffer = self.rooms.get(room_name)
+            if buffer is None:
+                return
+            self.apply_to(buffer, event_type, payload, size)
+
+    def apply_remote(self, room_name, event):
+        """Apply an event broadcast by another worker process.
+
+        Every local socket in the room receives the same event, so events
+        are applied once per origin and event number.
+        """
+        with self.lock:
+            buffer = self.rooms.get(room_name)
+            if buffer is None:
+                return
+            origin, number = event['origin']
+            if number <= buffer.applied.get(origin, 0):
+                return
+            buffer.applied[origin] = number
+            payload = json.loads(event['frame'])
+            self.apply_to(buffer, payload.pop('type'), payload, len(event['frame']))
+
+    def apply_to(self, buffer, event_type, payload, size):
+        if event_type == 'chat_message' and payload.get('thumbnail_url') and payload['id'] not in buffer.entries:
+            # Thumbnail update for a message that has already left the buffer
+            changed = False
+        elif event_type == 'chat_message':
+            if payload['id'] not in buffer.entries and payload.get('parent_id'):
+                buffer.update(payload['parent_id'], lambda entry: count_reply(entry, 1))
+            buffer.append(payload, size or buffer.sized(payload))
+            buffer.trim(self.max_messages, self.max_bytes)
+            changed = True
+        elif event_type == 'message_edit':
+            changed = buffer.update(payload['message_id'], lambda entry: entry.update(
+                message=payload['content'], is_edited=True))
+        elif event_type == 'message_delete':
+            entry = buffer.entries.get(payload['message_id'])
+            if entry is not None and entry[0].get('parent_id'):
+                buffer.update(entry[0]['parent_id'], lambda parent: count_reply(parent, -1))
+            changed = buffer.remove(payload['message_id'])
+        elif event_type == 'reaction_delta':
+            changed = buffer.update(payload['message_id'], lambda entry: apply_counts(entry, payload['counts']))
+        elif event_type == 'room_deleted':
+            buffer.entries.clear()
+            buffer.size = 0
+            changed = True
+        else:
+            changed = False
+        if changed:
+            buffer.frame = None
+
+
+def count_reply(entry, change):
+    entry['reply_count'] = entry.get('reply_count', 0) + change
+
+
+def apply_counts(entry, counts):
+    reaction_counts = dict(entry['reaction_counts'])
+    for emoji, count in counts.items():
+        if count:
+            reaction_counts[emoji] = count
+        else:
+            reaction_counts.pop(emoji, None)
+    entry['reaction_counts'] = reaction_counts
+
+
+replay_buffers = ReplayBuffers(
+    max_messages=settings.CHAT_REPLAY_MESSAGES,
+    max_bytes=settings.CHAT_REPLAY_MAX_BYTES,
+)
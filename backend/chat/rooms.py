@@ -0,0 +1,167 @@
+import asyncio
+import threading
+from collections import OrderedDict, namedtuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .directory import room_directory
+from .models import Room
+
+CachedRoom = namedtuple('CachedRoom', ['id', 'created_by'])
+
+# Every worker process listens on one channel in this group for rooms to drop
+# from its cache
+ROOM_CACHE_GROUP = 'rooms'
+
+
+class RoomCache:
+    """Process-wide LRU cache of room name -> (id, created_by).
+
+    Rooms are looked up on every message but almost never change, so the
+    hot path only queries the Room table on a miss. Deleted rooms are not
+    found. views.delete_room drops the entry in every process through
+    ``invalidate_everywhere``. A write against an id that went stale
+    anyway fails once the room row is gone, and ``write_to_room`` then
+    resolves the room again.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.channel_layer = None
+        self.channel = None
+        self.task = None
+        self.start_lock = asyncio.Lock()
+
+    def get(self, name):
+        with self.lock:
+            room = self.entries.get(name)
+            if room is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(name)
+            self.hits += 1
+            return room
+
+    def put(self, name, room):
+        with self.lock:
+            self.entries[name] = room
+            self.entries.move_to_end(name)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def lookup(self, name):
+        """Return the cached room, or None if no such room exists"""
+        room = self.get(name)
+        if room is None:
+            row = Room.objects.filter(name=name, deleted_at__isnull=True).values_list('id', 'created_by').first()
+            if row is None:
+                return None
+            room = CachedRoom(*row)
+            self.put(name, room)
+        return room
+
+    def resolve(self, name, created_by=None):
+        """Return ``(room, created)``, creating the room if it does not exist"""
+        room = self.get(name)
+        if room is not None:
+            return room, False
+        db_room, created = Room.objects.get_or_create(name=name, deleted_at__isnull=True, defaults={'created_by': created_by})
+        if created:
+            transaction.on_commit(room_directory.changed)
+        room = CachedRoom(db_room.id, db_room.created_by)
+        self.put(name, room)
+        return room, created
+
+    async def start(self, channel_layer):
+        """Start listening for invalidations from other processes, once per process"""
+        if self.channel is not None:
+            return
+        async with self.start_lock:
+            if self.channel is not None:
+                return
+            self.channel_layer = channel_layer
+            self.channel = await channel_layer.new_channel('rooms.')
+            await channel_layer.group_add(ROOM_CACHE_GROUP, self.channel)
+            self.task = asyncio.create_task(self.listen())
+
+    async def listen(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel)
+            if message.get('type') == 'rooms.invalidate':
+                self.invalidate(message['name'])
+
+    async def invalidate_everywhere(self, channel_layer, name):
+        self.invalidate(name)
+        await channel_layer.group_send(ROOM_CACHE_GROUP, {'type': 'rooms.invalidate', 'name': name})
+
+    def stats(self):
+        with self.lock:
+            size = len(self.entries)
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+room_cache = RoomCache(max_size=settings.CHAT_ROOM_CACHE_SIZE)
+
+
+class RoomCacheMiddleware:
+    """Starts the room cache's listener on the first request a process serves under ASGI.
+
+    Processes that only serve HTTP cache rooms too (e.g. for uploads), so
+    they must hear about deletions as well. WebSocket consumers start it
+    on connect.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.acall(request)
+        # No event loop to listen on under WSGI
+        return self.get_response(request)
+
+    async def acall(self, request):
+        await room_cache.start(get_channel_layer())
+        return await self.get_response(request)
+
+
+def write_to_room(name, write, room_id=None):
+    """Call ``write(room_id)`` for room ``name``, creating the room if needed.
+
+    A stale ``room_id`` (the room was deleted, possibly by another process)
+    fails the foreign key check; the room is then resolved again and the
+    write retried once. Returns ``(result, room_id)``.
+    """
+    if room_id is None:
+        room_id = room_cache.resolve(name)[0].id
+    try:
+        return write(room_id), room_id
+    except IntegrityError:
+        room_cache.invalidate(name)
+        room_id = room_cache.resolve(name)[0].id
+        return write(room_id), room_id
@@ -0,0 +1,114 @@
+import html
+import re
+
+from django.db import connection
+
+from .models import Message
+from .serializers import serialize_message
+
+# External-content FTS5 index over chat_message.content. Triggers keep it in
+# step with every insert, edit and delete, including bulk inserts from the
+# write-behind queue and cascades from deleted rooms.
+INDEX_SQL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5(
+        content, content='chat_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF content ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_insert',
+    'DROP TRIGGER IF EXISTS chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_message_fts_update',
+    'DROP TABLE IF EXISTS chat_message_fts',
+]
+
+# Private-use markers around matches, swapped for <mark> after escaping
+MATCH_START = '\ue000'
+MATCH_END = '\ue001'
+SNIPPET_TOKENS = 16
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def supported(using=None):
+    return (using or connection).vendor == 'sqlite'
+
+
+def install(using=None):
+    """Create the index and its triggers if they are missing.
+
+    Runs after every migrate: SQLite migrations that rebuild chat_message
+    drop its triggers with the old table, and this puts them back.
+    """
+    using = using or connection
+    if not supported(using):
+        return
+    with using.cursor() as cursor:
+        for statement in INDEX_SQL:
+            cursor.execute(statement)
+
+
+def rebuild(using=None):
+    """Drop and recreate the index, then fill it from chat_message"""
+    using = using or connection
+    if not supported(using):
+        return
+    with using.cursor() as cursor:
+        for statement in DROP_SQL:
+            cursor.execute(statement)
+    install(using)
+    with using.cursor() as cursor:
+        cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+
+
+def build_query(text):
+    """Turn user input into an FTS5 query: every word must match, the last one as a prefix"""
+    terms = TERM_PATTERN.findall(text)
+    if not terms:
+        return None
+    quoted = ['"%s"' % term for term in terms]
+    quoted[-1] += '*'  # search as you type
+    return ' '.join(quoted)
+
+
+def search_room(room_id, text, limit, offset=0):
+    """Return ``(messages, next_offset)`` for messages in a room matching ``text``, best match first.
+
+    Each message is the usual chat_message payload plus ``snippet``, an
+    HTML-escaped excerpt with the matches wrapped in ``<mark>``.
+    """
+    query = build_query(text)
+    if query is None:
+        return [], None
+    with connection.cursor() as cursor:
+        # Fetch one extra row to know whether another page exists
+        cursor.execute(
+            """SELECT chat_message.id, snippet(chat_message_fts, 0, %s, %s, '…', %s)
+               FROM chat_message_fts JOIN chat_message ON chat_message.id = chat_message_fts.rowid
+               WHERE chat_message_fts MATCH %s AND chat_message.room_id = %s
+               ORDER BY chat_message_fts.rank
+               LIMIT %s OFFSET %s""",
+            [MATCH_START, MATCH_END, SNIPPET_TOKENS, query, room_id, limit + 1, offset],
+        )
+        rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    snippets = dict(rows)
+    ids = [message_id for message_id, _ in rows]
+
+    found = Message.objects.select_related('parent').prefetch_related('reaction_counts').in_bulk(ids)
+    messages = []
+    for message_id in ids:
+        if message_id in found:
+            payload = serialize_message(found[message_id])
+            payload['snippet'] = html.escape(snippets.get(message_id, '')).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+            messages.append(payload)
+    return messages, offset + limit if has_more else None
@@ -0,0 +1,44 @@
+from django.conf import settings
+
+
+def serialize_message(message, reaction_counts=None):
+    """Build the chat_message payload for a Message.
+
+    Expects ``parent`` to be loaded via select_related and
+    ``reaction_counts`` via prefetch_related so no extra queries are made.
+    Pass ``reaction_counts`` for freshly created messages to skip the lookup.
+    """
+    if reaction_counts is None:
+        reaction_counts = {count.emoji: count.count for count in message.reaction_counts.all()}
+    return {
+        'id': message.id,
+        'message': message.content,
+        'sender': message.sender,
+        'timestamp': message.timestamp.isoformat(),
+        'reaction_counts': reaction_counts,
+        **parent_fields(message.parent),
+        'reply_count': message.reply_count,
+        'is_edited': message.is_edited,
+        'file_url': settings.MEDIA_URL + str(message.file) if message.file else None,
+        'file_type': message.file_type,
+        'file_name': message.file_name,
+        'thumbnail_url': settings.MEDIA_URL + message.thumbnail if message.thumbnail else None,
+    }
+
+
+def parent_fields(parent):
+    """The fields that quote a reply's parent.
+
+    With ``CHAT_REPLY_PREVIEW_LENGTH`` set, only that many characters of
+    the parent's text are sent, and ``parent_truncated`` says if that cut
+    it short; clients show the full text from their copy of the parent.
+    """
+    if parent is None:
+        return {'parent_id': None, 'parent_content': None, 'parent_sender': None}
+    fields = {'parent_id': parent.id, 'parent_content': parent.content, 'parent_sender': parent.sender}
+    preview = settings.CHAT_REPLY_PREVIEW_LENGTH
+    if preview:
+        fields['parent_truncated'] = len(parent.content) > preview
+        if fields['parent_truncated']:
+            fields['parent_content'] = parent.content[:preview]
+    return fields
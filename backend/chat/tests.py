@@ -1,3 +1,573 @@
-from django.test import TestCase
+import asyncio
+import json
+import logging
+import os
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from chat.archive import archive_chunk, is_archived, rooms_to_archive, segment_store
+from chat.events import log_events
+from chat.media import MediaFile, parse_range
+from chat.models import ArchiveSegment, Message, Reaction, ReactionCount, Room, RoomDeletion, RoomEvent
+from chat.purge import mark_deleted, purge_chunk
+from chat.ratelimit import RATE_LIMIT_GROUP, RateLimiter, TokenBucket, parse_limits, rate_limiter
+from chat.reactions import apply_toggles
+from chat.rooms import room_cache
+from chat.writebehind import MAX_FAILURES, MessageWriter, message_ids
+from chat_project.asgi import application
+
+
+async def receive_events(communicator, timeout=0.3):
+    """Every event a socket is sent until it goes quiet, with batched frames flattened"""
+    events = []
+    while not await communicator.receive_nothing(timeout):
+        frame = json.loads(await communicator.receive_from())
+        events.extend(frame if isinstance(frame, list) else [frame])
+    return events
+
+
+def create_messages(room, count, **fields):
+    return [Message.objects.create(room=room, sender='a', content='m%d' % n, **fields).id for n in range(count)]
+
+
+class LoadTestCommandTests(TransactionTestCase):
+    # The server's writer and read threads need committed rows, so no TestCase transaction
+
+    def run_loadtest(self, rate=4):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.json')
+            call_command('loadtest', clients=4, rooms=2, duration=1, rate=rate, query_samples=2, seed=1,
+                         mix='chat=60,reaction=15,typing=15,edit=5,delete=5', output=path,
+                         stdout=StringIO(), stderr=StringIO())
+            with open(path) as results:
+                return json.load(results)['results']
+
+    def test_short_run(self):
+        results = self.run_loadtest()
+        self.assertEqual(results['clients'], 4)
+        self.assertGreater(results['chat_sent'], 0)
+        self.assertEqual(results['errors'], 0)
+        self.assertEqual(results['unanswered'], 0)
+        self.assertIsNotNone(results['chat_queries'])
+
+    def test_refusals_are_errors(self):
+        with mock.patch.object(rate_limiter, 'connection_limits', {'chat_message': (1.0, 1.0)}), \
+                mock.patch.object(rate_limiter, 'limited', {'chat_message'}):
+            results = self.run_loadtest(rate=8)
+            # Query counting sends far more than the limit and still finishes
+            self.assertIsNotNone(results['chat_queries'])
+        self.assertGreater(results['errors'], 0)
+        self.assertEqual(results['unanswered'], 0)
+
+
+class HistoryPaginationTests(TransactionTestCase):
+
+    def test_pages_walk_backwards(self):
+        room = Room.objects.create(name='pages')
+        ids = create_messages(room, 5)
+        other = Room.objects.create(name='pages-other')
+        create_messages(other, 2)
+
+        page = self.client.get('/api/rooms/pages/messages/', {'limit': 2}).json()
+        self.assertEqual([message['id'] for message in page['messages']], ids[3:])
+        self.assertEqual(page['next_before'], ids[3])
+        page = self.client.get('/api/rooms/pages/messages/', {'limit': 2, 'before': page['next_before']}).json()
+        self.assertEqual([message['id'] for message in page['messages']], ids[1:3])
+        page = self.client.get('/api/rooms/pages/messages/', {'limit': 2, 'before': page['next_before']}).json()
+        self.assertEqual([message['id'] for message in page['messages']], ids[:1])
+        self.assertIsNone(page['next_before'])
+
+    def test_exact_last_page(self):
+        room = Room.objects.create(name='pages-exact')
+        ids = create_messages(room, 4)
+        page = self.client.get('/api/rooms/pages-exact/messages/', {'limit': 2, 'before': ids[2]}).json()
+        self.assertEqual([message['id'] for message in page['messages']], ids[:2])
+        self.assertIsNone(page['next_before'])
+
+    def test_bad_cursor(self):
+        response = self.client.get('/api/rooms/pages/messages/', {'before': 'newest'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_room(self):
+        page = self.client.get('/api/rooms/nowhere/messages/').json()
+        self.assertEqual(page, {'messages': [], 'next_before': None})
+
+
+class WriteBehindTests(TransactionTestCase):
+
+    def setUp(self):
+        # Dropped rows are logged with a traceback each
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    async def submit(self, writer, room, senders):
+        ids = []
+        for sender in senders:
+            message_id = await message_ids.allocate_async()
+            # A NULL sender fails the NOT NULL constraint however often it is retried
+            await writer.submit(room.name, Message(id=message_id, sender=sender, content='x', timestamp=timezone.now()))
+            await sync_to_async(log_events)(room.id, [('chat_message', {'id': message_id})])
+            ids.append(message_id)
+        return ids
+
+    async def wait_until_empty(self, writer):
+        for _ in range(200):
+            if not writer.pending and not writer.in_flight:
+                return
+            await asyncio.sleep(0.01)
+        self.fail('write-behind queue never emptied')
+
+    async def test_batch_is_written(self):
+        room = await sync_to_async(Room.objects.create)(name='writebehind')
+        writer = MessageWriter(batch_size=10, max_delay=0.01)
+        ids = await self.submit(writer, room, ['a', 'b', 'c'])
+        await self.wait_until_empty(writer)
+        saved = await sync_to_async(list)(Message.objects.filter(room=room).order_by('id').values_list('id', flat=True))
+        self.assertEqual(saved, ids)
+        stats = writer.stats()
+        self.assertEqual((stats['flushed'], stats['batches'], stats['dropped']), (3, 1, 0))
+        self.assertEqual(writer.pending_by_id, {})
+
+    async def test_bad_row_is_retried_then_dropped(self):
+        room = await sync_to_async(Room.objects.create)(name='writebehind-drop')
+        writer = MessageWriter(batch_size=10, max_delay=0.01)
+        ids = await self.submit(writer, room, ['a', None, 'c'])
+        await self.wait_until_empty(writer)
+
+        # The good rows are written row by row once the batch has failed MAX_FAILURES times
+        saved = await sync_to_async(list)(Message.objects.filter(room=room).order_by('id').values_list('id', flat=True))
+        self.assertEqual(saved, [ids[0], ids[2]])
+        stats = writer.stats()
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['flushed'], 2)
+        self.assertGreaterEqual(stats['failures'], MAX_FAILURES)
+        self.assertGreater(stats['avg_flush_ms'], 0)
+        self.assertIsNone(writer.get_pending(ids[1], room.name))
+
+        # Clients resuming with ?since= are told the dropped message is gone
+        frames = await sync_to_async(list)(RoomEvent.objects.filter(room=room).order_by('seq').values_list('frame', flat=True))
+        self.assertEqual(json.loads(frames[-1]), {'type': 'message_delete', 'message_id': ids[1], 'seq': 4})
+
+
+class ReactionCountTests(TransactionTestCase):
+
+    def setUp(self):
+        self.room = Room.objects.create(name='reactions')
+        # The cached id would outlive the table flush between tests
+        self.addCleanup(room_cache.invalidate, 'reactions')
+        self.message_id = create_messages(self.room, 1)[0]
+
+    def counts(self):
+        return dict(ReactionCount.objects.filter(message_id=self.message_id).values_list('emoji', 'count'))
+
+    def test_toggles_change_counts(self):
+        deltas = apply_toggles([(self.message_id, 'a', 'x'), (self.message_id, 'b', 'x')], self.room.id)
+        self.assertEqual(
+            [(delta['sender'], delta['added'], delta['removed'], delta['counts']) for delta in deltas],
+            [('a', ['x'], [], {'x': 2}), ('b', ['x'], [], {'x': 2})],
+        )
+        self.assertEqual(self.counts(), {'x': 2})
+
+        [delta] = apply_toggles([(self.message_id, 'a', 'x')], self.room.id)
+        self.assertEqual((delta['removed'], delta['counts']), (['x'], {'x': 1}))
+        apply_toggles([(self.message_id, 'b', 'x')], self.room.id)
+        # Counts that reach zero are deleted rather than kept at zero
+        self.assertEqual(self.counts(), {})
+
+    def test_cancelling_toggles(self):
+        apply_toggles([(self.message_id, 'a', 'x')], self.room.id)
+        # One sender's add and another's remove of the same emoji leave the count as it was
+        deltas = apply_toggles([(self.message_id, 'a', 'x'), (self.message_id, 'b', 'x')], self.room.id)
+        self.assertEqual([delta['counts'] for delta in deltas], [{'x': 1}, {'x': 1}])
+        self.assertEqual(self.counts(), {'x': 1})
+
+    def test_removal_without_a_count(self):
+        Reaction.objects.create(message_id=self.message_id, sender='a', emoji='x')
+        [delta] = apply_toggles([(self.message_id, 'a', 'x')], self.room.id)
+        self.assertEqual(delta['counts'], {'x': 0})
+        self.assertFalse(ReactionCount.objects.exists())
+
+    def test_other_rooms_messages_are_skipped(self):
+        other = Room.objects.create(name='reactions-other')
+        self.assertEqual(apply_toggles([(self.message_id, 'a', 'x')], other.id), [])
+        self.assertFalse(Reaction.objects.exists())
+
+    async def test_malformed_reactions_are_refused(self):
+        communicator = WebsocketCommunicator(application, '/ws/chat/reactions/')
+        await communicator.connect()
+        await receive_events(communicator)
+        await communicator.send_json_to([
+            {'type': 'reaction', 'message_id': 'first', 'emoji': 'x', 'sender': 'a'},
+            {'type': 'reaction', 'message_id': self.message_id, 'emoji': '', 'sender': 'a'},
+            {'type': 'reaction', 'message_id': self.message_id, 'emoji': 'x', 'sender': 'a'},
+        ])
+        events = await receive_events(communicator)
+        await communicator.disconnect()
+        self.assertEqual([event['type'] for event in events], ['error', 'error', 'reaction_delta'])
+        self.assertEqual({event.get('code') for event in events[:2]}, {'invalid'})
+        self.assertEqual(events[2]['counts'], {'x': 1})
+
+
+class ResumeTests(TransactionTestCase):
+
+    async def connect(self, query=''):
+        communicator = WebsocketCommunicator(application, '/ws/chat/resume/' + query)
+        await communicator.connect()
+        return communicator, await receive_events(communicator)
+
+    @override_settings(CHAT_EVENT_LOG_SIZE=10)
+    async def test_since(self):
+        sender, events = await self.connect()
+        self.assertEqual(events[0], {'type': 'sync', 'seq': 0, 'resync': False})
+        for n in range(3):
+            await sender.send_json_to({'type': 'chat_message', 'message': 'm%d' % n, 'sender': 'a'})
+        events = await receive_events(sender)
+        ids = [event['id'] for event in events]
+        self.assertEqual([event['seq'] for event in events], [1, 2, 3])
+        await sender.send_json_to({'type': 'edit_message', 'message_id': ids[0], 'content': 'e', 'sender': 'a'})
+        await sender.send_json_to({'type': 'delete_message', 'message_id': ids[1], 'sender': 'a'})
+        self.assertEqual([event['seq'] for event in await receive_events(sender)], [4, 5])
+
+        # Only the events after since, in order
+        resumed, events = await self.connect('?since=2')
+        await resumed.disconnect()
+        self.assertEqual(events[0]['type'], 'resume')
+        self.assertEqual(events[0]['seq'], 5)
+        self.assertEqual([(event['type'], event['seq']) for event in events[0]['events']],
+                         [('chat_message', 3), ('message_edit', 4), ('message_delete', 5)])
+
+        # Up to date: an empty resume
+        resumed, events = await self.connect('?since=5')
+        await resumed.disconnect()
+        self.assertEqual((events[0]['type'], events[0]['events']), ('resume', []))
+
+        # Ahead of the room (a deleted room of the same name): a full reload
+        resumed, events = await self.connect('?since=99')
+        await resumed.disconnect()
+        self.assertEqual(events[0]['type'], 'message_history')
+        self.assertIn({'type': 'sync', 'seq': 5, 'resync': True}, events)
+
+        # Trimmed from the log: a full reload too
+        for n in range(15):
+            await sender.send_json_to({'type': 'chat_message', 'message': 'n%d' % n, 'sender': 'a'})
+        await receive_events(sender)
+        await sender.disconnect()
+        resumed, events = await self.connect('?since=2')
+        await resumed.disconnect()
+        self.assertIn({'type': 'sync', 'seq': 20, 'resync': True}, events)
+        self.assertEqual(await sync_to_async(RoomEvent.objects.count)(), 10)
+
+
+class MediaTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(MEDIA_ROOT=directory.name, CHAT_MEDIA_ACCEL_REDIRECT='')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        for name in ('thumbnails/ab/file.jpg', 'uploads/secret.jpg', 'blobs/incoming/secret'):
+            os.makedirs(os.path.join(directory.name, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(directory.name, name), 'wb') as file:
+                file.write(b'0123456789')
+
+    async def get(self, path, **headers):
+        response = await self.async_client.get(path, headers=headers)
+        body = b''
+        if response.streaming:
+            body = b''.join([chunk async for chunk in response.streaming_content])
+        return response, body
+
+    def test_parse_range(self):
+        self.assertIsNone(parse_range('', 10))
+        self.assertEqual(parse_range('bytes=2-4', 10), (2, 4))
+        self.assertEqual(parse_range('bytes=5-', 10), (5, 9))
+        self.assertEqual(parse_range('bytes=5-100', 10), (5, 9))
+        self.assertEqual(parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(parse_range('bytes=-30', 10), (0, 9))
+        self.assertIs(parse_range('bytes=10-', 10), False)
+        self.assertIs(parse_range('bytes=-0', 10), False)
+        # Ignored: the whole file is sent
+        self.assertIsNone(parse_range('bytes=4-2', 10))
+        self.assertIsNone(parse_range('bytes=0-1,3-4', 10))
+        self.assertIsNone(parse_range('lines=0-1', 10))
+
+    async def test_whole_file(self):
+        response, body = await self.get('/media/thumbnails/ab/file.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, b'0123456789')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    async def test_range(self):
+        response, body = await self.get('/media/thumbnails/ab/file.jpg', range='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, b'234')
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+
+        response, _ = await self.get('/media/thumbnails/ab/file.jpg', range='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    async def test_conditional_requests(self):
+        response, _ = await self.get('/media/thumbnails/ab/file.jpg')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        response, _ = await self.get('/media/thumbnails/ab/file.jpg', if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        response, _ = await self.get('/media/thumbnails/ab/file.jpg', if_modified_since=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # A partial copy of another version gets the whole file
+        response, body = await self.get('/media/thumbnails/ab/file.jpg', range='bytes=2-4', if_range='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, b'0123456789')
+        response, body = await self.get('/media/thumbnails/ab/file.jpg', range='bytes=2-4', if_range=etag)
+        self.assertEqual((response.status_code, body), (206, b'234'))
+
+    async def test_private_files(self):
+        for path in ('/media/uploads/secret.jpg', '/media/blobs/incoming/secret', '/media/thumbnails/missing.jpg'):
+            response, _ = await self.get(path)
+            self.assertEqual(response.status_code, 404, path)
+        for name in ('thumbnails/../uploads/secret.jpg', 'blobs//incoming/secret', './uploads/secret.jpg',
+                     '../secret', '/etc/passwd'):
+            self.assertIsNone(MediaFile.open(name), name)
+        self.assertIsNotNone(MediaFile.open('thumbnails/ab/../ab/file.jpg'))
+
+
+class RateLimitTests(TransactionTestCase):
+
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits('chat_message=5/20, typing=3,'), {'chat_message': (5.0, 20.0), 'typing': (3.0, 3.0)})
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(2.0, 3.0, now=0.0)
+        self.assertEqual([bucket.take(0.0) for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(bucket.retry_after(), 0.5)
+        self.assertTrue(bucket.take(0.5))
+        self.assertFalse(bucket.take(0.5))
+        # Refills never go past the burst
+        self.assertEqual(bucket.refill(100.0), 3.0)
+
+    def test_refusal_takes_no_tokens(self):
+        limiter = RateLimiter({'chat_message': (0.001, 5.0)}, {'chat_message': (0.001, 1.0)})
+        limits = limiter.connection()
+        self.assertIsNone(limits.check('chat_message', 'a'))
+        self.assertEqual(limits.check('chat_message', 'a')[0], 'sender')
+        # The sender refusal left the connection's tokens alone
+        self.assertIsNone(limits.check('chat_message', 'b'))
+        self.assertAlmostEqual(limits.buckets['chat_message'].tokens, 3.0, places=3)
+        self.assertIsNone(limits.check('typing', 'a'))
+        self.assertEqual(limiter.usage, {('chat_message', 'a'): 1, ('chat_message', 'b'): 1})
+
+    async def test_usage_is_shared_between_processes(self):
+        layer = get_channel_layer()
+        limiter = RateLimiter({}, {'reaction': (0.001, 10.0)}, sync_interval=0.05)
+        await limiter.start(layer)
+        observer = await layer.new_channel('test.')
+        await layer.group_add(RATE_LIMIT_GROUP, observer)
+        try:
+            # What this process used is published...
+            self.assertIsNone(limiter.connection().check('reaction', 'local'))
+            message = await asyncio.wait_for(layer.receive(observer), 1)
+            self.assertEqual(message['usage'], [['reaction', 'local', 1]])
+
+            # ...and what other processes used is taken from our copy of their buckets
+            await layer.group_send(RATE_LIMIT_GROUP, {
+                'type': 'ratelimit.usage', 'origin': 'other-process', 'usage': [['reaction', 'remote', 12]],
+            })
+            for _ in range(100):
+                if limiter.applied:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertLess(limiter.senders['reaction', 'remote'].tokens, 0)
+            self.assertEqual(limiter.connection().check('reaction', 'remote')[0], 'sender')
+        finally:
+            for task in limiter.tasks:
+                task.cancel()
+            await layer.group_discard(RATE_LIMIT_GROUP, observer)
+            await layer.group_discard(RATE_LIMIT_GROUP, limiter.channel)
+
+    async def flood(self, sender):
+        """Send far more unlimited-type operations than the limits allow; returns the refusals and the close code"""
+        communicator = WebsocketCommunicator(application, '/ws/chat/flood/')
+        await communicator.connect()
+        await receive_events(communicator)
+        await communicator.send_json_to([{'type': 'ping', 'sender': sender}] * 30)
+        errors, code = [], None
+        while not await communicator.receive_nothing(0.3):
+            output = await communicator.receive_output()
+            if output['type'] == 'websocket.close':
+                code = output['code']
+                break
+            frame = json.loads(output['text'])
+            errors.extend(event for event in (frame if isinstance(frame, list) else [frame]) if event['type'] == 'error')
+        if code is None:
+            await communicator.disconnect()
+        return errors, code
+
+    async def test_connection_refusals_close_the_socket(self):
+        with mock.patch.object(rate_limiter, 'connection_limits', {'other': (0.001, 1.0)}), \
+                mock.patch.object(rate_limiter, 'limited', {'other'}), \
+                mock.patch.object(rate_limiter, 'strikes', 5):
+            closed = rate_limiter.closed
+            _, code = await self.flood('flood-connection')
+        # Error frames still queued when the socket is closed are not sent
+        self.assertEqual(code, 4029)
+        self.assertEqual(rate_limiter.closed, closed + 1)
+
+    async def test_sender_refusals_do_not_close_the_socket(self):
+        with mock.patch.object(rate_limiter, 'connection_limits', {}), \
+                mock.patch.object(rate_limiter, 'sender_limits', {'other': (0.001, 1.0)}), \
+                mock.patch.object(rate_limiter, 'limited', {'other'}), \
+                mock.patch.object(rate_limiter, 'strikes', 5):
+            errors, code = await self.flood('flood-sender')
+        self.assertIsNone(code)
+        self.assertEqual(len(errors), 29)
+        self.assertEqual({error['scope'] for error in errors}, {'sender'})
+
+
+class ArchiveTests(TransactionTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(CHAT_ARCHIVE_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        root = mock.patch.object(segment_store, 'root', directory.name)
+        root.start()
+        self.addCleanup(root.stop)
+
+        self.room = Room.objects.create(name='archive')
+        self.addCleanup(room_cache.invalidate, 'archive')
+        old = timezone.now() - timedelta(days=200)
+        self.ids = [
+            Message.objects.create(room=self.room, sender='a', content='m%d' % n,
+                                   timestamp=old + timedelta(seconds=n)).id
+            for n in range(6)
+        ]
+        self.recent = create_messages(self.room, 2)
+        self.cutoff = timezone.now() - timedelta(days=90)
+
+    def archive(self, size=100):
+        archived, after = 0, 0
+        while after is not None:
+            count, after = archive_chunk(self.room.id, self.cutoff, size, after)
+            archived += count
+        return archived
+
+    def test_history_reads_through_the_archive(self):
+        self.assertEqual(rooms_to_archive(self.cutoff), [self.room.id])
+        self.assertEqual(self.archive(size=4), 6)
+        self.assertEqual(rooms_to_archive(self.cutoff), [])
+        self.assertEqual(ArchiveSegment.objects.filter(room=self.room).count(), 2)
+        self.assertEqual(list(Message.objects.filter(room=self.room).values_list('id', flat=True)), self.recent)
+
+        # Pages cross from the table into the archive and across segments
+        page = self.client.get('/api/rooms/archive/messages/', {'limit': 3}).json()
+        self.assertEqual([message['id'] for message in page['messages']], self.ids[5:] + self.recent)
+        page = self.client.get('/api/rooms/archive/messages/', {'limit': 3, 'before': page['next_before']}).json()
+        self.assertEqual([message['id'] for message in page['messages']], self.ids[2:5])
+        self.assertEqual(page['messages'][0]['message'], 'm2')
+        page = self.client.get('/api/rooms/archive/messages/', {'limit': 3, 'before': page['next_before']}).json()
+        self.assertEqual([message['id'] for message in page['messages']], self.ids[:2])
+        self.assertIsNone(page['next_before'])
+
+    def test_threads_stay_together(self):
+        reply = Message.objects.create(room=self.room, sender='a', content='reply', parent_id=self.ids[1])
+        self.archive()
+        # The parent of a recent reply stays in the table, so the reply keeps it
+        self.assertTrue(Message.objects.filter(id=self.ids[1]).exists())
+        self.assertEqual(Message.objects.get(id=reply.id).parent_id, self.ids[1])
+
+    async def test_archived_messages_are_read_only(self):
+        gone = self.ids[0]
+        await sync_to_async(Message.objects.filter(id=gone).delete)()
+        await sync_to_async(self.archive)()
+        self.assertTrue(await sync_to_async(is_archived)(self.room.id, self.ids[1]))
+        self.assertFalse(await sync_to_async(is_archived)(self.room.id, gone))
+
+        communicator = WebsocketCommunicator(application, '/ws/chat/archive/')
+        await communicator.connect()
+        await receive_events(communicator)
+        await communicator.send_json_to([
+            {'type': 'edit_message', 'message_id': self.ids[1], 'content': 'e', 'sender': 'a'},
+            {'type': 'delete_message', 'message_id': self.ids[2], 'sender': 'a'},
+            {'type': 'reaction', 'message_id': self.ids[3], 'emoji': 'x', 'sender': 'a'},
+            # Deleted before archiving: nothing to refuse
+            {'type': 'edit_message', 'message_id': gone, 'content': 'e', 'sender': 'a'},
+        ])
+        events = await receive_events(communicator)
+        await communicator.disconnect()
+        self.assertEqual(
+            [(event['code'], event['operation'], event['message_id']) for event in events],
+            [('archived', 'edit_message', self.ids[1]), ('archived', 'delete_message', self.ids[2]),
+             ('archived', 'reaction', self.ids[3])],
+        )
+
+    def test_purge_removes_segments(self):
+        self.archive()
+        paths = list(ArchiveSegment.objects.values_list('path', flat=True))
+        deletion = mark_deleted(self.room)
+        while purge_chunk(deletion.id, self.room.id, 100):
+            pass
+        self.assertFalse(ArchiveSegment.objects.exists())
+        for path in paths:
+            self.assertFalse(os.path.exists(os.path.join(segment_store.root, path)))
+
+
+class RoomDeletionTests(TransactionTestCase):
+
+    def create_room(self, name, user_id='owner'):
+        return self.client.post('/api/rooms/create/', {'name': name, 'user_id': user_id},
+                                content_type='application/json').json()
+
+    def test_delete_and_recreate(self):
+        room = self.create_room('doomed')
+        with mock.patch('chat.views.room_purger.submit') as submit:
+            self.assertEqual(self.client.delete('/api/rooms/doomed/delete/?user_id=intruder').status_code, 403)
+            response = self.client.delete('/api/rooms/doomed/delete/?user_id=owner')
+        self.assertEqual(response.status_code, 202)
+        deletion = response.json()
+        submit.assert_called_once_with(deletion['deletion_id'], room['id'])
+        self.assertEqual(deletion['room_name'], 'doomed')
+        self.assertFalse(deletion['done'])
+
+        # The name is free straight away, even for a name a deleted room's old placeholder would have used
+        self.assertIsNone(Room.objects.get(id=room['id']).name)
+        self.assertEqual(self.client.get('/api/rooms/doomed/messages/').json()['messages'], [])
+        self.assertTrue(self.create_room('doomed/deleted/%d' % room['id'])['created'])
+        recreated = self.create_room('doomed', user_id='someone-else')
+        self.assertTrue(recreated['created'])
+        self.assertNotEqual(recreated['id'], room['id'])
+
+        # Several deleted rooms can be waiting to be purged at once
+        with mock.patch('chat.views.room_purger.submit'):
+            self.assertEqual(self.client.delete('/api/rooms/doomed/delete/?user_id=someone-else').status_code, 202)
+        self.assertEqual(Room.objects.filter(name__isnull=True).count(), 2)
+        self.assertEqual(self.client.delete('/api/rooms/doomed/delete/').status_code, 404)
+
+    def test_purge(self):
+        room = Room.objects.create(name='purged')
+        ids = create_messages(room, 5)
+        apply_toggles([(ids[0], 'a', 'x')], room.id)
+        log_events(room.id, [('chat_message', {'id': ids[-1]})])
+        deletion = mark_deleted(room)
+        self.assertEqual(deletion.total_messages, 5)
+
+        self.assertEqual([purge_chunk(deletion.id, room.id, 2) for _ in range(4)], [2, 2, 1, 0])
+        self.assertFalse(Room.objects.filter(id=room.id).exists())
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(Reaction.objects.exists() or ReactionCount.objects.exists() or RoomEvent.objects.exists())
+        state = self.client.get('/api/room-deletions/%d/' % deletion.id).json()
+        self.assertEqual((state['purged_messages'], state['done']), (5, True))
+        self.assertTrue(RoomDeletion.objects.get(id=deletion.id).finished_at)
@@ -0,0 +1,54 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, F
+
+from .models import Message
+from .serializers import serialize_message
+
+
+def record_replies(parent_ids):
+    """Count new replies, one entry in ``parent_ids`` per reply saved (None for non-replies)"""
+    for parent_id, count in Counter(parent_id for parent_id in parent_ids if parent_id).items():
+        Message.objects.filter(id=parent_id).update(reply_count=F('reply_count') + count)
+
+
+def record_reply_deleted(parent_id):
+    if parent_id:
+        Message.objects.filter(id=parent_id).update(reply_count=F('reply_count') - 1)
+
+
+def fetch_replies(parent_id, limit, after=None):
+    """Return ``(parent, replies, next_after)`` for one page of a thread, or None if there is no such message.
+
+    Replies are oldest first and paged forward with keyset pagination on
+    (parent_id, id); ``next_after`` is None on the last page. Messages of
+    deleted rooms are not found.
+    """
+    parent = (
+        Message.objects.filter(id=parent_id, room__deleted_at__isnull=True)
+        .select_related('parent')
+        .prefetch_related('reaction_counts')
+        .first()
+    )
+    if parent is None:
+        return None
+    queryset = Message.objects.filter(parent_id=parent_id)
+    if after is not None:
+        queryset = queryset.filter(id__gt=after)
+    # Fetch one extra row to know whether another page exists
+    page = list(queryset.order_by('id').select_related('parent').prefetch_related('reaction_counts')[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    replies = [serialize_message(message) for message in page]
+    return serialize_message(parent), replies, page[-1].id if has_more else None
+
+
+def rebuild_reply_counts(dry_run=False):
+    """Recount every message's replies; returns how many counts were wrong"""
+    with transaction.atomic():
+        wrong = list(Message.objects.annotate(n=Count('replies')).exclude(reply_count=F('n')).values_list('id', 'n'))
+        if not dry_run:
+            for message_id, count in wrong:
+                Message.objects.filter(id=message_id).update(reply_count=count)
+    return len(wrong)
@@ -0,0 +1,173 @@
+import asyncio
+import contextvars
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from .broadcast import broadcast
+from .dbwriter import db_writer
+from .events import log_events
+from .models import Message
+from .serializers import serialize_message
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIR = 'thumbnails'
+FFMPEG_TIMEOUT = 60
+# Poster frames need the ffmpeg binary; without it videos are shown without one
+FFMPEG = shutil.which('ffmpeg')
+
+
+def supported_types():
+    return ['image', 'video'] if FFMPEG else ['image']
+
+
+def thumbnail_name(file_name):
+    """Storage name of the thumbnail for the file stored at ``file_name``.
+
+    Derived from the source's storage name, so messages sharing a blob
+    share one thumbnail and it is only ever generated once.
+    """
+    key = hashlib.sha1(file_name.encode()).hexdigest()
+    return f'{THUMBNAIL_DIR}/{key[:2]}/{key}.jpg'
+
+
+def make_image_thumbnail(source, target, size):
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)  # first frame for animated images
+        image.thumbnail((size, size))
+        image.convert('RGB').save(target, 'JPEG', quality=80, optimize=True)
+
+
+def make_video_poster(source, target, size):
+    scale = f"scale='min({size},iw)':'min({size},ih)':force_original_aspect_ratio=decrease"
+    # One second in skips black lead-in frames; clips shorter than that use their first frame
+    for seek in ('1', '0'):
+        subprocess.run(
+            [FFMPEG, '-v', 'error', '-y', '-ss', seek, '-i', source, '-frames:v', '1', '-vf', scale, target],
+            check=True, capture_output=True, timeout=FFMPEG_TIMEOUT,
+        )
+        if os.path.getsize(target):
+            return
+
+
+def generate(file_name, file_type, size):
+    """Make the thumbnail (images) or poster frame (videos) for a stored file; returns its storage name"""
+    name = thumbnail_name(file_name)
+    target = default_storage.path(name)
+    if os.path.exists(target):
+        return name
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Write under a temporary name so a crash never leaves a half-written thumbnail in place
+    partial = f'{target}.{os.getpid()}.part'
+    try:
+        if file_type == 'image':
+            make_image_thumbnail(default_storage.path(file_name), partial, size)
+        else:
+            make_video_poster(default_storage.path(file_name), partial, size)
+        os.replace(partial, target)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return name
+
+
+def attach(file_name, thumbnail):
+    """Set ``thumbnail`` on the messages showing ``file_name``; returns ``(room, payload)`` for each"""
+    ids = list(Message.objects.filter(file=file_name, thumbnail__isnull=True).values_list('id', flat=True))
+    with transaction.atomic():
+        Message.objects.filter(id__in=ids).update(thumbnail=thumbnail)
+        updated = (
+            Message.objects.filter(id__in=ids)
+            .select_related('parent', 'room')
+            .prefetch_related('reaction_counts')
+        )
+        # Rooms being purged get no events
+        events = [(message.room, serialize_message(message)) for message in updated
+                  if message.room and message.room.deleted_at is None]
+        for room, payload in events:
+            log_events(room.id, [('chat_message', payload)])
+    return [(room.name, payload) for room, payload in events]
+
+
+class ThumbnailPool:
+    """Background workers that make thumbnails and poster frames for uploaded media.
+
+    Uploads queue the stored file name; ``workers`` tasks each convert one
+    file at a time in a worker thread, attach the result to every message
+    showing that file and re-broadcast those messages as ``chat_message``
+    events with a ``thumbnail_url``. The queue holds at most ``queue_size``
+    files; when it is full the file is skipped and left for
+    ``manage.py backfill_thumbnails``.
+    """
+
+    def __init__(self, workers=2, queue_size=100, size=320):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.size = size
+        self.queue = None
+        self.tasks = []
+        # Counters
+        self.generated = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'generated': self.generated,
+            'failures': self.failures,
+            'dropped': self.dropped,
+        }
+
+    async def submit(self, file_name, file_type):
+        """Queue a stored file; returns False if it is skipped"""
+        if file_type not in supported_types():
+            return False
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.queue_size)
+        self.tasks = [task for task in self.tasks if not task.done()]
+        while len(self.tasks) < self.workers:
+            # Fresh context: workers outlive the request that started them and
+            # must not inherit its sync_to_async thread
+            self.tasks.append(asyncio.create_task(self.run(), context=contextvars.Context()))
+        try:
+            self.queue.put_nowait((file_name, file_type))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        return True
+
+    async def run(self):
+        while True:
+            file_name, file_type = await self.queue.get()
+            try:
+                await self.process(file_name, file_type)
+            except Exception:
+                self.failures += 1
+                logger.exception('Thumbnail for %s failed', file_name)
+            finally:
+                self.queue.task_done()
+
+    async def process(self, file_name, file_type):
+        thumbnail = await sync_to_async(generate, thread_sensitive=False)(file_name, file_type, self.size)
+        self.generated += 1
+        channel_layer = get_channel_layer()
+        for room_name, payload in await db_writer.run(attach, file_name, thumbnail):
+            await broadcast(channel_layer, room_name, 'chat_message', payload)
+
+
+thumbnail_pool = ThumbnailPool(
+    workers=settings.CHAT_THUMBNAIL_WORKERS,
+    queue_size=settings.CHAT_THUMBNAIL_QUEUE_SIZE,
+    size=settings.CHAT_THUMBNAIL_SIZE,
+)
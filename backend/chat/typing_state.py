@@ -0,0 +1,121 @@
+import asyncio
+import json
+import time
+
+from django.conf import settings
+
+from .broadcast import broadcast
+
+
+class TypingTracker:
+    """Typing state of the senders connected to this process, per room.
+
+    Keystroke events only update state here. Once per ``tick`` the tracker
+    broadcasts a snapshot of who is typing in each room whose list changed,
+    so toggles in between are coalesced away. Entries expire ``ttl`` seconds
+    after the sender's last keystroke, and a room with typists re-sends its
+    snapshot every ``ttl / 2`` seconds so other processes can expire it too.
+    """
+
+    def __init__(self, tick=0.5, ttl=6.0):
+        self.tick = tick
+        self.ttl = ttl
+        self.rooms = {}  # room -> {sender: [expires at, channel name]}
+        self.sent = {}  # room -> (names, sent at) of the last snapshot
+        self.task = None
+
+    def set_typing(self, room_name, channel_name, sender, is_typing, now):
+        if is_typing:
+            self.rooms.setdefault(room_name, {})[sender] = [now + self.ttl, channel_name]
+        else:
+            typists = self.rooms.get(room_name)
+            if typists:
+                typists.pop(sender, None)
+
+    def drop_channel(self, room_name, channel_name):
+        """Forget what a closed connection was typing, whether or not it said it stopped"""
+        typists = self.rooms.get(room_name)
+        if typists:
+            for sender, (_, channel) in list(typists.items()):
+                if channel == channel_name:
+                    del typists[sender]
+
+    def collect(self, now):
+        """Return the ``(room, names)`` snapshots due at ``now``"""
+        due = []
+        for room_name in set(self.rooms) | set(self.sent):
+            typists = self.rooms.get(room_name, {})
+            for sender, (expires_at, _) in list(typists.items()):
+                if expires_at <= now:
+                    del typists[sender]
+            names = sorted(typists)
+            last_names, sent_at = self.sent.get(room_name, ([], None))
+            if names != last_names or (names and now - sent_at >= self.ttl / 2):
+                due.append((room_name, names))
+                self.sent[room_name] = (names, now)
+            if not typists:
+                self.rooms.pop(room_name, None)
+                if not names:
+                    self.sent.pop(room_name, None)
+        return due
+
+    def start(self, channel_layer):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run(channel_layer))
+
+    async def run(self, channel_layer):
+        while self.rooms or self.sent:
+            await asyncio.sleep(self.tick)
+            for room_name, names in self.collect(time.monotonic()):
+                await broadcast(channel_layer, room_name, 'typing_snapshot', {'typing': names})
+
+
+class TypingViews:
+    """Who is typing in each room, merged across the processes that sent snapshots.
+
+    Every local socket in a room receives each snapshot, so a snapshot is
+    merged once per origin and event number and the merged frame is encoded
+    once and shared by all sockets. Rooms nobody has typed in for ``ttl``
+    seconds are dropped by a sweep at most once per ``ttl``.
+    """
+
+    def __init__(self, ttl=6.0):
+        self.ttl = ttl
+        self.rooms = {}  # room -> {'origins': {origin: [names, expires at]}, 'applied': {...}, 'frame': str, 'updated': float}
+        self.swept = 0.0
+
+    def merge(self, room_name, event, now):
+        view = self.rooms.setdefault(room_name, {'origins': {}, 'applied': {}, 'frame': None, 'updated': now})
+        origin, number = event['origin']
+        if number > view['applied'].get(origin, 0):
+            view['applied'][origin] = number
+            view['updated'] = now
+            names = json.loads(event['frame'])['typing']
+            if names:
+                view['origins'][origin] = [names, now + self.ttl]
+            else:
+                view['origins'].pop(origin, None)
+            self.expire(view, now)
+            typing = sorted({name for names, _ in view['origins'].values() for name in names})
+            view['frame'] = json.dumps({'type': 'typing_snapshot', 'typing': typing})
+        if now - self.swept >= self.ttl:
+            self.sweep(now)
+        return view['frame']
+
+    def expire(self, view, now):
+        # Drop processes that stopped sending snapshots (e.g. crashed)
+        for origin, (_, expires_at) in list(view['origins'].items()):
+            if expires_at <= now:
+                del view['origins'][origin]
+
+    def sweep(self, now):
+        """Forget rooms with nobody typing, once every local socket has had their last snapshot"""
+        self.swept = now
+        for room_name, view in list(self.rooms.items()):
+            self.expire(view, now)
+            if not view['origins'] and now - view['updated'] >= self.ttl:
+                del self.rooms[room_name]
+
+
+typing_tracker = TypingTracker(tick=settings.CHAT_TYPING_TICK, ttl=settings.CHAT_TYPING_TTL)
+typing_views = TypingViews(ttl=settings.CHAT_TYPING_TTL)
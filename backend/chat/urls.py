@@ -1,9 +1,20 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 urlpatterns = [
     path('api/rooms/', views.get_rooms, name='get_rooms'),
     path('api/rooms/create/', views.create_room, name='create_room'),
+    path('api/rooms/<str:room_name>/messages/', views.get_messages, name='get_messages'),
+    path('api/rooms/<str:room_name>/search/', views.search_messages, name='search_messages'),
+    path('api/messages/<int:message_id>/replies/', views.get_replies, name='get_replies'),
     path('api/rooms/<str:room_name>/delete/', views.delete_room, name='delete_room'),
+    path('api/room-deletions/<int:deletion_id>/', views.room_deletion, name='room_deletion'),
     path('api/upload-file/', views.upload_file, name='upload_file'),
+    path('api/uploads/', views.start_upload, name='start_upload'),
+    path('api/uploads/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('api/uploads/<uuid:upload_id>/complete/', views.complete_upload, name='complete_upload'),
+    path('api/stats/', views.stats, name='stats'),
+    path('metrics', views.metrics, name='metrics'),
+    path(settings.MEDIA_URL.lstrip('/') + '<path:name>', views.serve_media, name='media'),
 ]
@@ -1,14 +1,164 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-from .models import Room
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from .models import Room, Message, Reaction, RoomDeletion, Upload
+from .archive import archiver, segment_store
+from .broadcast import broadcast
+from .dbwriter import db_writer
+from .directory import record_messages, room_directory
+from .events import log_events
+from .history import fetch_page
+from .media import MediaFile, acquire, hash_file, parse_range, store, store_uploaded, stream_file
+from .metrics import StatsCollector, registry, upload_bytes
+from .outbound import outbound_stats
+from .presence import presence_registry
+from .purge import mark_deleted, room_purger
+from .ratelimit import rate_limiter
+from .rooms import room_cache, write_to_room
+from .search import search_room, supported as search_supported
+from .serializers import serialize_message
+from .threads import fetch_replies, record_replies
+from .thumbnails import thumbnail_pool
+from .writebehind import message_ids, message_writer
 import json
+import re
+from urllib.parse import quote
+
+DIRECTORY_DEFAULT_LIMIT = 50
+DIRECTORY_MAX_LIMIT = 200
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 200
+THREAD_DEFAULT_LIMIT = 50
+THREAD_MAX_LIMIT = 200
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
 
 @require_http_methods(["GET"])
 def get_rooms(request):
-    rooms = Room.objects.all().values('id', 'name', 'created_by')
-    return JsonResponse(list(rooms), safe=False)
+    """One page of the room directory, in name order, optionally only names starting with ?prefix="""
+    try:
+        limit = min(max(int(request.GET.get('limit', DIRECTORY_DEFAULT_LIMIT)), 1), DIRECTORY_MAX_LIMIT)
+    except ValueError:
+        return JsonResponse({'error': 'limit must be an integer'}, status=400)
+    etag, body = room_directory.page(request.GET.get('prefix', ''), request.GET.get('after'), limit)
+
+    # Clients poll the directory; an unchanged page costs neither a query nor a body
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+@require_http_methods(["GET"])
+def get_messages(request, room_name):
+    """Return a page of room history using keyset pagination on (room_id, id).
+
+    Pages walk backwards from ``before``; messages within a page are oldest first.
+
+    With ``?sender=``, each message also lists the emojis that sender reacted with.
+    """
+    try:
+        limit = int(request.GET.get('limit', HISTORY_DEFAULT_LIMIT))
+        before = request.GET.get('before')
+        before = int(before) if before else None
+    except ValueError:
+        return JsonResponse({'error': 'before and limit must be integers'}, status=400)
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+
+    room = room_cache.lookup(room_name)
+    if room is None:
+        return JsonResponse({'messages': [], 'next_before': None})
+
+    messages, next_before = fetch_page(room.id, limit, before)
+    sender = request.GET.get('sender')
+    if sender:
+        mine = {}
+        for message_id, emoji in Reaction.objects.filter(
+            message_id__in=[message['id'] for message in messages], sender=sender
+        ).values_list('message_id', 'emoji'):
+            mine.setdefault(message_id, []).append(emoji)
+        for message in messages:
+            message['my_reactions'] = mine.get(message['id'], [])
+    return JsonResponse({'messages': messages, 'next_before': next_before})
+
+@require_http_methods(["GET"])
+def get_replies(request, message_id):
+    """Return a page of a message's replies, oldest first, using keyset pagination on (parent_id, id)"""
+    try:
+        limit = int(request.GET.get('limit', THREAD_DEFAULT_LIMIT))
+        after = request.GET.get('after')
+        after = int(after) if after else None
+    except ValueError:
+        return JsonResponse({'error': 'after and limit must be integers'}, status=400)
+    limit = max(1, min(limit, THREAD_MAX_LIMIT))
+
+    thread = fetch_replies(message_id, limit, after)
+    if thread is None:
+        return JsonResponse({'error': 'Message not found'}, status=404)
+    parent, replies, next_after = thread
+    return JsonResponse({'parent': parent, 'replies': replies, 'next_after': next_after})
+
+@require_http_methods(["GET"])
+def search_messages(request, room_name):
+    """Full-text search within a room, best match first, paginated with ``offset``"""
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'error': 'q is required'}, status=400)
+    try:
+        limit = int(request.GET.get('limit', SEARCH_DEFAULT_LIMIT))
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        return JsonResponse({'error': 'offset and limit must be integers'}, status=400)
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    offset = max(0, offset)
+    if not search_supported():
+        return JsonResponse({'error': 'Search needs the SQLite database'}, status=501)
+
+    room = room_cache.lookup(room_name)
+    if room is None:
+        return JsonResponse({'messages': [], 'next_offset': None})
+
+    messages, next_offset = search_room(room.id, query, limit, offset)
+    return JsonResponse({'messages': messages, 'next_offset': next_offset})
+
+# Counters for this worker process's caches, queues and database writer,
+# served as JSON by /api/stats/ and as gauges by /metrics
+STATS = {
+    'room_cache': room_cache.stats,
+    'write_behind': lambda: {'enabled': settings.CHAT_WRITE_BEHIND, **message_writer.stats()},
+    'thumbnails': thumbnail_pool.stats,
+    'outbound': lambda: outbound_stats,
+    'directory': room_directory.stats,
+    'presence': presence_registry.stats,
+    'rate_limit': rate_limiter.stats,
+    'purge': room_purger.stats,
+    'archive': segment_store.stats,
+    'archiver': archiver.stats,
+    'db_writer': db_writer.stats,
+}
+for component, function in STATS.items():
+    StatsCollector(registry, 'chat_%s' % component, function)
+
+@require_http_methods(["GET"])
+def stats(request):
+    """Counters for this worker process's caches, queues and database writer"""
+    return JsonResponse({component: function() for component, function in STATS.items()})
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """This worker process's metrics in the Prometheus text format"""
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -21,11 +171,8 @@ def create_room(request):
             return JsonResponse({'error': 'Room name is required'}, status=400)
         
         # If room exists, return it. created_by is only set on creation.
-        room, created = Room.objects.get_or_create(
-            name=room_name,
-            defaults={'created_by': user_id}
-        )
-        return JsonResponse({'id': room.id, 'name': room.name, 'created_by': room.created_by, 'created': created})
+        room, created = db_writer.call(room_cache.resolve, room_name, created_by=user_id)
+        return JsonResponse({'id': room.id, 'name': room_name, 'created_by': room.created_by, 'created': created})
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
 
@@ -55,11 +202,105 @@ def delete_room(request, room_name):
         if room.created_by and room.created_by != user_id:
              return JsonResponse({'error': 'Unauthorized. Only the room creator can delete this room.'}, status=403)
 
-        room.delete()
-        return JsonResponse({'message': 'Room deleted successfully'})
+        # The room disappears now; its messages, reactions and files are
+        # purged in the background in small chunks (chat.purge)
+        deletion = db_writer.call(mark_deleted, room)
+        # Every process drops the room, so none keeps writing to it under the old id
+        async_to_sync(room_cache.invalidate_everywhere)(get_channel_layer(), room_name)
+        room_directory.changed()
+        async_to_sync(broadcast)(get_channel_layer(), room_name, 'room_deleted', {'room': room_name})
+        async_to_sync(room_purger.submit)(deletion.id, room.id)
+        return JsonResponse({
+            'message': 'Room deleted successfully',
+            **deletion_state(deletion),
+        }, status=202)
     except Room.DoesNotExist:
         return JsonResponse({'error': 'Room not found'}, status=404)
 
+def deletion_state(deletion):
+    return {
+        'deletion_id': deletion.id,
+        'room_name': deletion.room_name,
+        'total_messages': deletion.total_messages,
+        'purged_messages': deletion.purged_messages,
+        'purged_files': deletion.purged_files,
+        'done': deletion.finished_at is not None,
+    }
+
+@require_http_methods(["GET"])
+def room_deletion(request, deletion_id):
+    """Progress of purging a deleted room"""
+    deletion = RoomDeletion.objects.filter(id=deletion_id).first()
+    if deletion is None:
+        return JsonResponse({'error': 'Deletion not found'}, status=404)
+    return JsonResponse(deletion_state(deletion))
+
+ALLOWED_IMAGE_TYPES = ['image/jpeg', 'image/png', 'image/gif', 'image/webp']
+ALLOWED_VIDEO_TYPES = ['video/mp4', 'video/webm', 'video/quicktime']
+MAX_IMAGE_SIZE = 10 * 1024 * 1024  # 10MB
+MAX_VIDEO_SIZE = 50 * 1024 * 1024  # 50MB
+
+def validate_upload(content_type, size):
+    """Return (file_type, error) for an upload's content type and size"""
+    if content_type in ALLOWED_IMAGE_TYPES:
+        file_type, max_size = 'image', MAX_IMAGE_SIZE
+    elif content_type in ALLOWED_VIDEO_TYPES:
+        file_type, max_size = 'video', MAX_VIDEO_SIZE
+    else:
+        return None, 'Invalid file type. Only images (jpg, png, gif, webp) and videos (mp4, webm, mov) are allowed.'
+    if size > max_size:
+        return None, f'File too large. Maximum size is {max_size // (1024 * 1024)}MB for {file_type}s.'
+    return file_type, None
+
+def create_file_message(room_name, sender, content, parent_id, file, file_type, file_name, blob=None):
+    """Save a file message; ``file`` is the storage name of the blob whose digest is ``blob``.
+
+    Returns the numbered chat_message payload to broadcast and the response for the uploader.
+    """
+    # Save message with file. Write-behind ids come from a shared
+    # allocator, so file messages must take theirs from it too.
+    def create(room_id):
+        with transaction.atomic():
+            # Only a message in the same room can be the parent
+            parent = Message.objects.filter(id=parent_id, room_id=room_id).first() if parent_id else None
+            message = Message.objects.create(
+                id=message_ids.allocate() if settings.CHAT_WRITE_BEHIND else None,
+                room_id=room_id,
+                sender=sender,
+                content=content,
+                file=file,
+                file_type=file_type,
+                file_name=file_name,
+                blob_id=blob,
+                parent=parent
+            )
+            record_messages(room_id, 1, message.timestamp)
+            record_replies([message.parent_id])
+            payload = serialize_message(message, reaction_counts={})
+            log_events(room_id, [('chat_message', payload)])
+        return message, payload
+
+    (message, payload), _ = write_to_room(room_name, create)
+    
+    # Return message data including file URL
+    file_url = settings.MEDIA_URL + str(message.file) if message.file else None
+    
+    response_data = {
+        'id': message.id,
+        'sender': message.sender,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+        'file_url': file_url,
+        'file_type': file_type,
+        'file_name': message.file_name,
+        'thumbnail_url': None,
+        'parent_id': message.parent_id,
+        'parent_sender': message.parent.sender if message.parent else None,
+        'parent_content': message.parent.content if message.parent else None,
+        'is_edited': False
+    }
+    return payload, response_data
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def upload_file(request):
@@ -75,79 +316,238 @@ def upload_file(request):
         if not file or not sender or not room_name:
             return JsonResponse({'error': 'Missing required fields'}, status=400)
         
-        # Validate file type
-        allowed_image_types = ['image/jpeg', 'image/png', 'image/gif', 'image/webp']
-        allowed_video_types = ['video/mp4', 'video/webm', 'video/quicktime']
-        
-        file_type = None
-        if file.content_type in allowed_image_types:
-            file_type = 'image'
-            max_size = 10 * 1024 * 1024  # 10MB
-        elif file.content_type in allowed_video_types:
-            file_type = 'video'
-            max_size = 50 * 1024 * 1024  # 50MB
-        else:
-            return JsonResponse({'error': 'Invalid file type. Only images (jpg, png, gif, webp) and videos (mp4, webm, mov) are allowed.'}, status=400)
-        
-        # Validate file size
-        if file.size > max_size:
-            return JsonResponse({'error': f'File too large. Maximum size is {max_size // (1024 * 1024)}MB for {file_type}s.'}, status=400)
-        
-        # Get or create room
-        from .models import Room, Message
-        room, _ = Room.objects.get_or_create(name=room_name)
-        
-        # Get parent message if specified
-        parent = None
-        if parent_id:
-            try:
-                parent = Message.objects.get(id=parent_id)
-            except Message.DoesNotExist:
-                pass
+        # Validate file type and size
+        file_type, error = validate_upload(file.content_type, file.size)
+        if error:
+            return JsonResponse({'error': error}, status=400)
         
-        # Save message with file
-        message = Message.objects.create(
-            room=room,
-            sender=sender,
-            content=content,
-            file=file,
-            file_type=file_type,
-            file_name=file.name,
-            parent=parent
+        # Hash while saving; identical bytes already stored are shared instead of kept twice
+        digest, name = store_uploaded(file)
+        upload_bytes.inc(('file',), file.size)
+        payload, response_data = db_writer.call(
+            create_file_message, room_name, sender, content, parent_id, name, file_type, file.name, digest
         )
         
-        # Return message data including file URL
-        from django.conf import settings
-        file_url = settings.MEDIA_URL + str(message.file) if message.file else None
-        
-        response_data = {
-            'id': message.id,
-            'sender': message.sender,
-            'content': message.content,
-            'timestamp': message.timestamp.isoformat(),
-            'file_url': file_url,
-            'file_type': file_type,
-            'file_name': message.file_name,
-            'parent_id': parent.id if parent else None,
-            'parent_sender': parent.sender if parent else None,
-            'parent_content': parent.content if parent else None,
-            'is_edited': False
-        }
-        
         # Broadcast the new message via WebSocket
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"chat_{room_name}",
-            {
-                'type': 'chat_message',
-                'message': response_data
-            }
+        async_to_sync(broadcast)(
+            get_channel_layer(),
+            room_name,
+            'chat_message',
+            payload
         )
+        # The thumbnail follows as a second chat_message once it is ready
+        async_to_sync(thumbnail_pool.submit)(name, file_type)
         
         return JsonResponse(response_data)
         
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
+
+# Chunked, resumable uploads. The file is created in storage up front and
+# each chunk is written into it in place, so nothing buffers the whole file
+# and slow clients only hold the event loop between chunks. On completion the
+# file moves into the content-addressed blob store (see chat.media).
+
+UPLOAD_COPY_BUFFER = 64 * 1024
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+def write_chunk(path, offset, stream, length):
+    """Copy up to ``length`` bytes from ``stream`` into the file at ``offset``"""
+    written = 0
+    with open(path, 'r+b') as destination:
+        destination.seek(offset)
+        while written < length:
+            data = stream.read(min(UPLOAD_COPY_BUFFER, length - written))
+            if not data:
+                break
+            destination.write(data)
+            written += len(data)
+    return written
+
+def finish_upload(upload, digest):
+    """Store a fully received upload as a blob and save its message.
+
+    Returns ``(storage name, payload, response)``, or None if the upload was
+    completed meanwhile. The Upload row is deleted in the same transaction
+    as the message is created, so if anything fails it can be completed again.
+    """
+    with transaction.atomic():
+        if not Upload.objects.filter(id=upload.id).exists():
+            return None
+        name = store(upload.path, digest, upload.size, upload.file_name)
+        payload, response_data = create_file_message(
+            upload.room_name, upload.sender, upload.content, upload.parent_id,
+            name, upload.file_type, upload.file_name, digest
+        )
+        Upload.objects.filter(id=upload.id).delete()
+    return name, payload, response_data
+
+def upload_state(upload):
+    return {'upload_id': str(upload.id), 'offset': upload.received, 'size': upload.size}
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def start_upload(request):
+    """Start a chunked upload and reserve its file in storage.
+
+    If the client sends the file's ``sha256`` and those bytes are already
+    stored, the message is posted straight away and nothing is uploaded.
+    """
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    sender = data.get('sender')
+    room_name = data.get('room_name')
+    file_name = data.get('file_name')
+    size = data.get('size')
+    if not sender or not room_name or not file_name or not isinstance(size, int) or size <= 0:
+        return JsonResponse({'error': 'Missing required fields'}, status=400)
+
+    file_type, error = validate_upload(data.get('content_type'), size)
+    if error:
+        return JsonResponse({'error': error}, status=400)
+    parent_id = data.get('parent_id')
+    if parent_id is not None and (not isinstance(parent_id, int) or isinstance(parent_id, bool)):
+        return JsonResponse({'error': 'parent_id must be an integer'}, status=400)
+
+    sha256 = str(data.get('sha256') or '').lower()
+    if SHA256_PATTERN.match(sha256):
+        name = await db_writer.run(acquire, sha256, size)
+        if name is not None:
+            payload, response_data = await db_writer.run(
+                create_file_message, room_name, sender, data.get('content') or '', parent_id,
+                name, file_type, file_name, sha256
+            )
+            await broadcast(get_channel_layer(), room_name, 'chat_message', payload)
+            await thumbnail_pool.submit(name, file_type)
+            return JsonResponse({**response_data, 'deduplicated': True})
+
+    path = await sync_to_async(default_storage.save)('uploads/' + file_name, ContentFile(b''))
+    upload = await db_writer.run(
+        Upload.objects.create,
+        sender=sender,
+        room_name=room_name,
+        content=data.get('content') or '',
+        parent_id=parent_id,
+        path=path,
+        file_name=file_name,
+        file_type=file_type,
+        size=size,
+    )
+    return JsonResponse(upload_state(upload), status=201)
+
+@csrf_exempt
+@require_http_methods(["GET", "PUT"])
+async def upload_chunk(request, upload_id):
+    """GET returns the offset to resume from; PUT writes the body at ?offset=<bytes received>"""
+    upload = await Upload.objects.filter(id=upload_id).afirst()
+    if upload is None:
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+    if request.method == 'GET':
+        return JsonResponse(upload_state(upload))
+
+    try:
+        offset = int(request.GET['offset'])
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'offset must be an integer'}, status=400)
+    if offset != upload.received:
+        # Already received or out of order: tell the client where to resume
+        return JsonResponse({**upload_state(upload), 'error': 'Offset mismatch'}, status=409)
+    if length <= 0 or length > settings.CHAT_UPLOAD_MAX_CHUNK_SIZE or offset + length > upload.size:
+        return JsonResponse({'error': 'Invalid chunk length'}, status=400)
+
+    written = await sync_to_async(write_chunk, thread_sensitive=False)(
+        default_storage.path(upload.path), offset, request, length
+    )
+    upload_bytes.inc(('chunk',), written)
+    # Only advance if a concurrent request for the same offset did not win
+    updated = await db_writer.run(Upload.objects.filter(id=upload.id, received=offset).update, received=offset + written)
+    if not updated:
+        await upload.arefresh_from_db()
+        return JsonResponse({**upload_state(upload), 'error': 'Offset mismatch'}, status=409)
+    upload.received = offset + written
+    return JsonResponse(upload_state(upload))
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def complete_upload(request, upload_id):
+    """Turn a fully received upload into a file message and broadcast it"""
+    upload = await Upload.objects.filter(id=upload_id).afirst()
+    if upload is None:
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+    if upload.received != upload.size:
+        return JsonResponse({**upload_state(upload), 'error': 'Upload incomplete'}, status=409)
+    # Chunks may have reached other worker processes, so hash the whole file here
+    try:
+        digest = await sync_to_async(hash_file, thread_sensitive=False)(default_storage.path(upload.path))
+    except FileNotFoundError:
+        # Completed by a concurrent request meanwhile
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+    finished = await db_writer.run(finish_upload, upload, digest)
+    if finished is None:
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+    name, payload, response_data = finished
+    await broadcast(get_channel_layer(), upload.room_name, 'chat_message', payload)
+    await thumbnail_pool.submit(name, upload.file_type)
+    return JsonResponse(response_data)
+
+@require_http_methods(["GET", "HEAD"])
+async def serve_media(request, name):
+    """Serve an uploaded file or thumbnail, with byte ranges and conditional requests.
+
+    Blobs and thumbnails never change once written, so browsers may cache
+    them for a year. With ``CHAT_MEDIA_ACCEL_REDIRECT`` set, the body is
+    left to the reverse proxy (which sends it with sendfile and handles
+    ranges itself); otherwise it is streamed from here.
+    """
+    media = await sync_to_async(MediaFile.open, thread_sensitive=False)(name)
+    if media is None:
+        return JsonResponse({'error': 'File not found'}, status=404)
+    headers = {
+        'ETag': media.etag,
+        'Last-Modified': http_date(media.mtime),
+        'Cache-Control': 'public, max-age=31536000, immutable' if media.immutable else 'no-cache',
+    }
+
+    # A cached copy that is still current costs neither a read nor a body
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        etags = parse_etags(if_none_match)
+        not_modified = media.etag in etags or '*' in etags
+    else:
+        since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        not_modified = since is not None and int(media.mtime) <= since
+    if not_modified:
+        return HttpResponseNotModified(headers=headers)
+
+    if settings.CHAT_MEDIA_ACCEL_REDIRECT:
+        headers['X-Accel-Redirect'] = settings.CHAT_MEDIA_ACCEL_REDIRECT + quote(media.name)
+        return HttpResponse(content_type=media.content_type, headers=headers)
+
+    # Only resume from a range if the client's partial copy is of this version
+    byte_range = parse_range(request.headers.get('Range', ''), media.size)
+    if_range = request.headers.get('If-Range')
+    if byte_range is not None and if_range is not None:
+        if if_range.startswith(('"', 'W/')):
+            current = if_range == media.etag
+        else:
+            current = parse_http_date_safe(if_range) == int(media.mtime)
+        if not current:
+            byte_range = None
+    if byte_range is False:
+        return HttpResponse(status=416, headers={**headers, 'Content-Range': 'bytes */%d' % media.size})
+
+    status = 200
+    start, end = 0, media.size - 1
+    if byte_range is not None:
+        status = 206
+        start, end = byte_range
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, media.size)
+    headers['Accept-Ranges'] = 'bytes'
+    headers['Content-Length'] = str(end - start + 1)
+    if request.method == 'HEAD' or end < start:
+        return HttpResponse(status=status, content_type=media.content_type, headers=headers)
+    return StreamingHttpResponse(stream_file(media.path, start, end), status=status,
+                                 content_type=media.content_type, headers=headers)
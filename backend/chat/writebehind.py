@@ -0,0 +1,313 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max
+
+from .broadcast import broadcast
+from .dbwriter import db_writer
+from .directory import record_messages
+from .events import log_events
+from .models import Message, MessageIdBlock
+from .rooms import room_cache
+from .threads import record_replies
+
+logger = logging.getLogger(__name__)
+
+# A batch that failed this often is written one row at a time, and a row that
+# failed on its own this often is dropped, so one bad row cannot hold up the queue
+MAX_FAILURES = 3
+
+
+class IdAllocator:
+    """Hands out message ids from blocks reserved in MessageIdBlock.
+
+    Reserving a block is one UPDATE, so processes sharing the database never
+    hand out the same id, and most allocations need no query at all.
+    """
+
+    def __init__(self, block_size=1000):
+        self.block_size = block_size
+        self.next_id = 0
+        self.end = 0
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            if self.next_id >= self.end:
+                self.next_id, self.end = self.reserve_block()
+            allocated = self.next_id
+            self.next_id += 1
+            return allocated
+
+    async def allocate_async(self):
+        # Only hop to a database thread when the current block is used up
+        with self.lock:
+            if self.next_id < self.end:
+                allocated = self.next_id
+                self.next_id += 1
+                return allocated
+        return await db_writer.run(self.allocate)
+
+    def reserve_block(self):
+        with transaction.atomic():
+            MessageIdBlock.objects.get_or_create(pk=1)
+            # The UPDATE comes first so the write lock is held while reading
+            MessageIdBlock.objects.filter(pk=1).update(next_id=F('next_id') + self.block_size)
+            end = MessageIdBlock.objects.get(pk=1).next_id
+            start = end - self.block_size
+            # Rows saved without the allocator (e.g. before write-behind was
+            # enabled) push the block past the current maximum id
+            max_id = Message.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+            if start <= max_id:
+                start = max_id + 1
+                end = start + self.block_size
+                MessageIdBlock.objects.filter(pk=1).update(next_id=end)
+        return start, end
+
+
+def write_batch(batch):
+    """Insert queued (room name, Message) pairs with one bulk_create"""
+    room_names = {room_name for room_name, _ in batch}
+    try:
+        insert_batch(batch, room_names)
+    except IntegrityError:
+        # A cached room id went stale because the room was deleted; resolve
+        # the rooms again (recreating them) and retry once
+        for name in room_names:
+            room_cache.invalidate(name)
+        insert_batch(batch, room_names)
+
+
+def write_rows(batch):
+    """Insert queued messages one at a time; returns the ones that failed"""
+    failed = []
+    for item in batch:
+        try:
+            write_batch([item])
+        except Exception:
+            logger.exception('Write-behind insert of message %s failed', item[1].id)
+            failed.append(item)
+    return failed
+
+
+def log_dropped(dropped):
+    """Log a message_delete for each dropped (room name, Message); returns the (room name, payload) to broadcast.
+
+    The message was logged and broadcast when it was queued, so without
+    this, clients resuming with ``?since=`` would be replayed a message
+    that never existed.
+    """
+    deletes = []
+    for room_name, message in dropped:
+        room = room_cache.lookup(room_name)
+        if room is None:
+            continue  # the room was deleted, and its event log with it
+        payload = {'message_id': message.id}
+        try:
+            log_events(room.id, [('message_delete', payload)])
+        except IntegrityError:
+            room_cache.invalidate(room_name)
+            continue
+        deletes.append((room_name, payload))
+    return deletes
+
+
+def insert_batch(batch, room_names):
+    room_ids = {name: room_cache.resolve(name)[0].id for name in room_names}
+    batch_ids = {message.id for _, message in batch}
+    parent_ids = {message.parent_id for _, message in batch if message.parent_id} - batch_ids
+    existing = set(Message.objects.filter(id__in=parent_ids).values_list('id', flat=True))
+
+    messages = []
+    for room_name, message in batch:
+        message.room_id = room_ids[room_name]
+        # The parent may have been deleted while the reply was queued
+        if message.parent_id and message.parent_id not in batch_ids | existing:
+            message.parent_id = None
+        messages.append(message)
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        rooms = {}
+        for message in messages:
+            count, last = rooms.get(message.room_id, (0, message.timestamp))
+            rooms[message.room_id] = (count + 1, max(last, message.timestamp))
+        for room_id, (count, last) in rooms.items():
+            record_messages(room_id, count, last)
+        record_replies([message.parent_id for message in messages])
+
+
+class MessageWriter:
+    """Write-behind queue for chat messages.
+
+    Messages get their id and timestamp up front so they can be broadcast
+    straight away, then are inserted in batches of up to ``batch_size`` or
+    after ``max_delay`` seconds, whichever comes first. A batch that keeps
+    failing is written row by row, and rows that still fail are logged and
+    dropped. Anything still queued is written at interpreter exit.
+    """
+
+    def __init__(self, batch_size=200, max_delay=0.05):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pending = []
+        self.pending_by_id = {}
+        self.in_flight = []
+        self.batch_failures = 0
+        self.row_failures = {}  # message id -> failed row-by-row writes
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.exit_hook_registered = False
+        # Counters
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.pending),
+            'flushed': self.flushed,
+            'batches': self.batches,
+            'failures': self.failures,
+            'dropped': self.dropped,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'max_flush_ms': round(self.max_flush_ms, 3),
+            'avg_flush_ms': round(self.total_flush_ms / self.batches, 3) if self.batches else 0.0,
+        }
+
+    def get_pending(self, message_id, room_name):
+        """Return the queued message ``message_id`` if it was sent to ``room_name``"""
+        queued_room, message = self.pending_by_id.get(message_id, (None, None))
+        return message if queued_room == room_name else None
+
+    async def submit(self, room_name, message):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        if not self.exit_hook_registered:
+            atexit.register(self.flush_at_exit)
+            self.exit_hook_registered = True
+        self.pending.append((room_name, message))
+        self.pending_by_id[message.id] = (room_name, message)
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    async def wait_for(self, message_id):
+        """Make sure ``message_id`` is in the database before it is edited, deleted or reacted to"""
+        while message_id in self.pending_by_id:
+            if not await self.flush():
+                break
+
+    async def run(self):
+        while self.pending:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write the oldest batch; returns False if the write failed"""
+        async with self.lock:
+            batch = self.pending[:self.batch_size]
+            if not batch:
+                return True
+            del self.pending[:len(batch)]
+            self.in_flight = batch
+            started = time.perf_counter()
+            try:
+                if self.batch_failures >= MAX_FAILURES:
+                    return await self.flush_rows(batch)
+                try:
+                    await db_writer.run(write_batch, batch)
+                except Exception:
+                    # Put the batch back in front and retry on the next tick
+                    self.pending[:0] = batch
+                    self.batch_failures += 1
+                    self.failures += 1
+                    logger.exception('Write-behind flush of %d messages failed', len(batch))
+                    return False
+            finally:
+                self.in_flight = []
+            self.batch_failures = 0
+            self.written(batch, (time.perf_counter() - started) * 1000)
+            return True
+
+    async def flush_rows(self, batch):
+        started = time.perf_counter()
+        failed = await db_writer.run(write_rows, batch)
+        elapsed = (time.perf_counter() - started) * 1000
+        retry = []
+        dropped = []
+        for room_name, message in failed:
+            self.row_failures[message.id] = self.row_failures.get(message.id, 0) + 1
+            if self.row_failures[message.id] >= MAX_FAILURES:
+                logger.error('Dropping message %s for room %s after %d failed writes', message.id, room_name, MAX_FAILURES)
+                self.row_failures.pop(message.id)
+                self.pending_by_id.pop(message.id, None)
+                self.dropped += 1
+                dropped.append((room_name, message))
+            else:
+                retry.append((room_name, message))
+        self.pending[:0] = retry
+        if dropped:
+            channel_layer = get_channel_layer()
+            for room_name, payload in await db_writer.run(log_dropped, dropped):
+                await broadcast(channel_layer, room_name, 'message_delete', payload)
+        self.failures += bool(failed)
+        if not failed:
+            self.batch_failures = 0
+        ids = {message.id for _, message in failed}
+        done = [item for item in batch if item[1].id not in ids]
+        if done:
+            self.written(done, elapsed)
+        return not failed
+
+    def written(self, batch, elapsed):
+        for _, message in batch:
+            self.pending_by_id.pop(message.id, None)
+            self.row_failures.pop(message.id, None)
+        self.flushed += len(batch)
+        self.batches += 1
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        self.total_flush_ms += elapsed
+
+    def flush_at_exit(self):
+        # The event loop is gone by now, so write synchronously. A batch a
+        # flush had taken may or may not have been written before it stopped.
+        if self.in_flight:
+            saved = set(Message.objects.filter(id__in=[message.id for _, message in self.in_flight]).values_list('id', flat=True))
+            self.pending[:0] = [item for item in self.in_flight if item[1].id not in saved]
+            self.in_flight = []
+        while self.pending:
+            batch = self.pending[:self.batch_size]
+            del self.pending[:len(batch)]
+            dropped = []
+            try:
+                write_batch(batch)
+            except Exception:
+                logger.exception('Write-behind flush of %d messages failed at exit', len(batch))
+                dropped = write_rows(batch)
+                # Nobody is listening anymore, but clients resuming later read the log
+                self.dropped += len(dropped)
+                log_dropped(dropped)
+            self.flushed += len(batch) - len(dropped)
+            self.batches += 1
+        self.pending_by_id.clear()
+
+message_ids = IdAllocator()
+message_writer = MessageWriter(
+    batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+    max_delay=settings.CHAT_WRITE_BEHIND_MAX_DELAY,
+)
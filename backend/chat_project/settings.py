@@ -30,6 +30,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
+    'chat.rooms.RoomCacheMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -65,13 +67,45 @@ ASGI_APPLICATION = 'chat_project.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLite is tuned for many concurrent sockets: WAL lets reads run alongside
+# the single writer, IMMEDIATE transactions take the write lock up front so a
+# second writer waits up to DB_TIMEOUT seconds instead of failing with
+# "database is locked", and connections are kept for DB_CONN_MAX_AGE seconds
+# so the pragmas run once per thread rather than once per query.
+DB_TIMEOUT = float(os.environ.get('DB_TIMEOUT', '20'))
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE', '600'))
+DB_SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')  # NORMAL is durable up to a power loss in WAL mode
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', str(64 * 1024)))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': DB_TIMEOUT,
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': ';'.join([
+                'PRAGMA journal_mode=WAL',
+                f'PRAGMA synchronous={DB_SYNCHRONOUS}',
+                f'PRAGMA mmap_size={DB_MMAP_SIZE}',
+                f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}',
+                'PRAGMA temp_store=MEMORY',
+            ]),
+        },
     }
 }
 
+# Metrics (chat.metrics) served at /metrics in the Prometheus text format;
+# turning them off leaves only the gauges
+CHAT_METRICS = os.environ.get('CHAT_METRICS', 'True') == 'True'
+
+# Writes go through one dedicated thread per process (chat.dbwriter) so they
+# never queue on SQLite's lock behind each other; reads run in parallel
+CHAT_DB_WRITER = os.environ.get('CHAT_DB_WRITER', 'True') == 'True'
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -115,11 +149,120 @@ MEDIA_ROOT = BASE_DIR / 'media'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Channels
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# Set CHANNEL_BROKER_SOCKET to run several worker processes against a local
+# broker (manage.py run_channel_broker) instead of a single in-memory process.
+CHANNEL_BROKER_SOCKET = os.environ.get('CHANNEL_BROKER_SOCKET')
+
+if CHANNEL_BROKER_SOCKET:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chat.layers.BrokerChannelLayer",
+            "CONFIG": {
+                "path": CHANNEL_BROKER_SOCKET,
+            },
+        }
     }
-}
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer"
+        }
+    }
+
+# Room name -> id entries kept by each process's room cache (chat.rooms)
+CHAT_ROOM_CACHE_SIZE = int(os.environ.get('CHAT_ROOM_CACHE_SIZE', '10000'))
+
+# Room directory pages (GET /api/rooms/) cached by each process, and how many
+# seconds a cached page may miss room changes made by other processes
+CHAT_DIRECTORY_CACHE_PAGES = int(os.environ.get('CHAT_DIRECTORY_CACHE_PAGES', '1000'))
+CHAT_DIRECTORY_CACHE_MAX_AGE = float(os.environ.get('CHAT_DIRECTORY_CACHE_MAX_AGE', '5'))
+
+# Every room keeps its latest EVENT_LOG_SIZE events, numbered, so reconnecting
+# clients can fetch just what they missed (chat.events)
+CHAT_EVENT_LOG_SIZE = int(os.environ.get('CHAT_EVENT_LOG_SIZE', '1000'))
+
+# Replies quote at most this many characters of their parent's text; 0 sends
+# all of it (chat.serializers.parent_fields)
+CHAT_REPLY_PREVIEW_LENGTH = int(os.environ.get('CHAT_REPLY_PREVIEW_LENGTH', '0'))
+
+# Recent messages replayed to sockets as they join a room (chat.replay)
+CHAT_REPLAY_MESSAGES = int(os.environ.get('CHAT_REPLAY_MESSAGES', '50'))
+CHAT_REPLAY_MAX_BYTES = int(os.environ.get('CHAT_REPLAY_MAX_BYTES', str(256 * 1024)))
+
+# Typing indicators are sent as one snapshot per room every TICK seconds;
+# a typist is dropped TTL seconds after their last keystroke (chat.typing_state)
+CHAT_TYPING_TICK = float(os.environ.get('CHAT_TYPING_TICK', '0.5'))
+CHAT_TYPING_TTL = float(os.environ.get('CHAT_TYPING_TTL', '6'))
+
+# Presence (chat.presence): each worker process sends a heartbeat every
+# HEARTBEAT seconds, and the members of a process silent for TTL seconds are dropped
+CHAT_PRESENCE_HEARTBEAT = float(os.environ.get('CHAT_PRESENCE_HEARTBEAT', '10'))
+CHAT_PRESENCE_TTL = float(os.environ.get('CHAT_PRESENCE_TTL', '30'))
+
+# Deleted rooms are purged in the background (chat.purge), CHUNK_SIZE messages
+# per transaction with PAUSE seconds in between so other rooms keep writing
+CHAT_PURGE_CHUNK_SIZE = int(os.environ.get('CHAT_PURGE_CHUNK_SIZE', '500'))
+CHAT_PURGE_PAUSE = float(os.environ.get('CHAT_PURGE_PAUSE', '0.05'))
+
+# Largest chunk accepted by the chunked upload API (PUT /api/uploads/<id>/)
+CHAT_UPLOAD_MAX_CHUNK_SIZE = int(os.environ.get('CHAT_UPLOAD_MAX_CHUNK_SIZE', str(8 * 1024 * 1024)))
+
+# Serving MEDIA_URL (chat.views.serve_media): files are streamed in reads of
+# CHUNK_SIZE bytes. Behind nginx, set ACCEL_REDIRECT to an internal location
+# that aliases MEDIA_ROOT (e.g. /protected-media/) and nginx sends the bytes
+# with sendfile instead, after this app has checked the request.
+CHAT_MEDIA_CHUNK_SIZE = int(os.environ.get('CHAT_MEDIA_CHUNK_SIZE', str(256 * 1024)))
+CHAT_MEDIA_ACCEL_REDIRECT = os.environ.get('CHAT_MEDIA_ACCEL_REDIRECT', '')
+
+# Thumbnails and video poster frames (chat.thumbnails): WORKERS files are
+# converted at a time, at most QUEUE_SIZE wait, and images fit in SIZE x SIZE
+CHAT_THUMBNAIL_WORKERS = int(os.environ.get('CHAT_THUMBNAIL_WORKERS', '2'))
+CHAT_THUMBNAIL_QUEUE_SIZE = int(os.environ.get('CHAT_THUMBNAIL_QUEUE_SIZE', '100'))
+CHAT_THUMBNAIL_SIZE = int(os.environ.get('CHAT_THUMBNAIL_SIZE', '320'))
+
+# Rate limits per operation type (chat.ratelimit), as type=rate/burst: rate
+# operations a second, in bursts of up to burst. CONNECTION limits each
+# socket, SENDER each sender name across all worker processes, which share
+# what senders used every SYNC_INTERVAL seconds. Types not listed are not
+# limited. A socket refused STRIKES times within STRIKE_WINDOW seconds by its
+# CONNECTION limits is closed.
+CHAT_RATE_LIMITS_CONNECTION = os.environ.get(
+    'CHAT_RATE_LIMITS_CONNECTION',
+    'chat_message=5/20,reaction=10/30,typing=20/40,edit_message=2/10,delete_message=2/10,other=5/10',
+)
+CHAT_RATE_LIMITS_SENDER = os.environ.get(
+    'CHAT_RATE_LIMITS_SENDER',
+    'chat_message=10/40,reaction=20/60,edit_message=4/20,delete_message=4/20',
+)
+CHAT_RATE_LIMIT_STRIKES = int(os.environ.get('CHAT_RATE_LIMIT_STRIKES', '20'))
+CHAT_RATE_LIMIT_STRIKE_WINDOW = float(os.environ.get('CHAT_RATE_LIMIT_STRIKE_WINDOW', '10'))
+CHAT_RATE_LIMIT_SYNC_INTERVAL = float(os.environ.get('CHAT_RATE_LIMIT_SYNC_INTERVAL', '0.25'))
+
+# Cold storage (chat.archive): messages older than AFTER_DAYS move out of the
+# Message table into read-only segment files under DIR, SEGMENT_MESSAGES per
+# file in zlib blocks of BLOCK_MESSAGES. Run `manage.py archive_messages` from
+# cron, or set INTERVAL (seconds) to archive from the server process. Readers
+# keep up to OPEN_SEGMENTS files mapped and CACHE_BLOCKS blocks decoded.
+CHAT_ARCHIVE_DIR = os.environ.get('CHAT_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+CHAT_ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', '90'))
+CHAT_ARCHIVE_SEGMENT_MESSAGES = int(os.environ.get('CHAT_ARCHIVE_SEGMENT_MESSAGES', '5000'))
+CHAT_ARCHIVE_BLOCK_MESSAGES = int(os.environ.get('CHAT_ARCHIVE_BLOCK_MESSAGES', '200'))
+CHAT_ARCHIVE_INTERVAL = float(os.environ.get('CHAT_ARCHIVE_INTERVAL', '0'))
+CHAT_ARCHIVE_OPEN_SEGMENTS = int(os.environ.get('CHAT_ARCHIVE_OPEN_SEGMENTS', '64'))
+CHAT_ARCHIVE_CACHE_BLOCKS = int(os.environ.get('CHAT_ARCHIVE_CACHE_BLOCKS', '256'))
+
+# WebSocket frames: at most MAX_BATCH_OPERATIONS operations per client frame;
+# server events within COALESCE_WINDOW seconds are merged into one frame, and a
+# client with more than MAX_PENDING_BYTES waiting is disconnected (chat.outbound)
+CHAT_MAX_BATCH_OPERATIONS = int(os.environ.get('CHAT_MAX_BATCH_OPERATIONS', '100'))
+CHAT_SEND_COALESCE_WINDOW = float(os.environ.get('CHAT_SEND_COALESCE_WINDOW', '0.02'))
+CHAT_SEND_MAX_PENDING_BYTES = int(os.environ.get('CHAT_SEND_MAX_PENDING_BYTES', str(1024 * 1024)))
+
+# Write-behind message persistence (chat.writebehind): broadcast first, then
+# insert messages in batches of up to BATCH_SIZE or every MAX_DELAY seconds
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', 'False') == 'True'
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BEHIND_BATCH_SIZE', '200'))
+CHAT_WRITE_BEHIND_MAX_DELAY = float(os.environ.get('CHAT_WRITE_BEHIND_MAX_DELAY', '0.05'))
 
 # CORS
 CORS_ALLOW_ALL_ORIGINS = True
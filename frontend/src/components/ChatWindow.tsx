@@ -9,7 +9,8 @@ interface DisplayMessage {
     content: string;
     time: string;
     isMe: boolean;
-    reactions: { emoji: string; sender: string }[];
+    reaction_counts: Record<string, number>;
+    reactors?: Record<string, string[]>;
     parent_id?: number | null;
     parent_content?: string | null;
     parent_sender?: string | null;
@@ -17,8 +18,12 @@ interface DisplayMessage {
     file_url?: string | null;
     file_type?: 'image' | 'video' | null;
     file_name?: string | null;
+    thumbnail_url?: string | null;
 }
 
+// Media URLs from the server are relative to the API host
+const mediaUrl = (url: string) => url.startsWith('http') ? url : `${import.meta.env.VITE_API_URL || 'http://localhost:8000'}${url}`;
+
 interface ChatWindowProps {
     roomName: string;
     username: string;
@@ -42,8 +47,9 @@ const ChatWindow = ({ roomName, username, isJoined, onJoin }: ChatWindowProps) =
     // Connect to Django WebSocket backend
     // Use environment variable for production, fallback to localhost for development
     const baseUrl = import.meta.env.VITE_WS_URL || 'ws://localhost:8000/ws/chat/';
-    const wsUrl = `${baseUrl}${roomName}/`;
-    const { messages, sendMessage, sendReaction, sendTyping, editMessage, deleteMessage, uploadFile, isConnected, typingUsers } = useWebSocket(wsUrl);
+    // Naming the user lists us as online in the room
+    const wsUrl = `${baseUrl}${roomName}/${username ? `?user=${encodeURIComponent(username)}` : ''}`;
+    const { messages, sendMessage, sendReaction, sendTyping, editMessage, deleteMessage, uploadFile, isConnected, typingUsers, onlineUsers } = useWebSocket(wsUrl);
     const typingTimeoutRef = useRef<ReturnType<typeof setTimeout> | null>(null);
 
     // File upload state and refs
@@ -77,6 +83,8 @@ const ChatWindow = ({ roomName, username, isJoined, onJoin }: ChatWindowProps) =
 
     // Convert WebSocket messages to display format
     useEffect(() => {
+        // Replies may quote only the start of their parent; show our own copy of it when we have one
+        const byId = new Map(messages.map(msg => [msg.id, msg]));
         const newDisplayMessages = messages.map((msg, index) => ({
             id: msg.id || Date.now() + index,
             sender: msg.sender,
@@ -85,14 +93,16 @@ const ChatWindow = ({ roomName, username, isJoined, onJoin }: ChatWindowProps) =
                 ? new Date(msg.timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })
                 : new Date().toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' }),
             isMe: msg.sender === username,
-            reactions: msg.reactions || [],
+            reaction_counts: msg.reaction_counts || {},
+            reactors: msg.reactors,
             parent_id: msg.parent_id,
-            parent_content: msg.parent_content,
+            parent_content: (msg.parent_id && byId.get(msg.parent_id)?.message) || msg.parent_content,
             parent_sender: msg.parent_sender,
             is_edited: msg.is_edited,
             file_url: msg.file_url,
             file_type: msg.file_type,
-            file_name: msg.file_name
+            file_name: msg.file_name,
+            thumbnail_url: msg.thumbnail_url
         }));
         setDisplayMessages(newDisplayMessages);
     }, [messages, username]);
@@ -256,20 +266,6 @@ const ChatWindow = ({ roomName, username, isJoined, onJoin }: ChatWindowProps) =
         }
     };
 
-    // Helper to aggregate reactions for display
-    const getAggregatedReactions = (reactions: { emoji: string; sender: string }[]) => {
-        const aggregated: Record<string, string[]> = {};
-        reactions.forEach(r => {
-            if (!aggregated[r.emoji]) {
-                aggregated[r.emoji] = [];
-            }
-            if (!aggregated[r.emoji].includes(r.sender)) {
-                aggregated[r.emoji].push(r.sender);
-            }
-        });
-        return aggregated;
-    };
-
     // Username setup screen
     if (!isJoined) {
         return (
@@ -334,6 +330,11 @@ const ChatWindow = ({ roomName, username, isJoined, onJoin }: ChatWindowProps) =
                     <span className="text-[10px] md:text-xs text-slate-500 font-medium">
                         {isConnected ? 'Live' : 'Offline'}
                     </span>
+                    {isConnected && onlineUsers.length > 0 && (
+                        <span className="text-[10px] md:text-xs text-slate-400" title={onlineUsers.join(', ')}>
+                            · {onlineUsers.length} online
+                        </span>
+                    )}
                 </div>
             </div>
 
@@ -354,7 +355,7 @@ const ChatWindow = ({ roomName, username, isJoined, onJoin }: ChatWindowProps) =
                     const isLastInGroup = index === displayMessages.length - 1 ||
                         displayMessages[index + 1].sender !== msg.sender;
 
-                    const aggregatedReactions = getAggregatedReactions(msg.reactions);
+                    const reactionCounts = msg.reaction_counts;
 
                     return (
                         <div
@@ -389,14 +390,16 @@ const ChatWindow = ({ roomName, username, isJoined, onJoin }: ChatWindowProps) =
                                             <div className="mb-1 rounded-xl overflow-hidden bg-slate-100/10">
                                                 {msg.file_type === 'image' ? (
                                                     <img
-                                                        src={msg.file_url.startsWith('http') ? msg.file_url : `${import.meta.env.VITE_API_URL || 'http://localhost:8000'}${msg.file_url}`}
+                                                        src={mediaUrl(msg.thumbnail_url || msg.file_url)}
                                                         alt={msg.file_name || 'Image'}
                                                         className="w-full max-h-[300px] md:max-h-[400px] object-cover cursor-pointer hover:opacity-95 transition-opacity"
-                                                        onClick={() => window.open(msg.file_url?.startsWith('http') ? msg.file_url : `${import.meta.env.VITE_API_URL || 'http://localhost:8000'}${msg.file_url}`, '_blank')}
+                                                        onClick={() => window.open(mediaUrl(msg.file_url!), '_blank')}
                                                     />
                                                 ) : msg.file_type === 'video' ? (
                                                     <video
-                                                        src={msg.file_url.startsWith('http') ? msg.file_url : `${import.meta.env.VITE_API_URL || 'http://localhost:8000'}${msg.file_url}`}
+                                                        src={mediaUrl(msg.file_url)}
+                                                        poster={msg.thumbnail_url ? mediaUrl(msg.thumbnail_url) : undefined}
+                                                        preload={msg.thumbnail_url ? 'none' : 'metadata'}
                                                         controls
                                                         className="w-full max-h-[300px] md:max-h-[400px]"
                                                     />
@@ -460,20 +463,20 @@ const ChatWindow = ({ roomName, username, isJoined, onJoin }: ChatWindowProps) =
                                 </div>
 
                                 {/* Reactions Display */}
-                                {Object.keys(aggregatedReactions).length > 0 && (
+                                {Object.keys(reactionCounts).length > 0 && (
                                     <div className={`flex flex-wrap gap-1 mt-1 ${msg.isMe ? 'justify-end' : 'justify-start'}`}>
-                                        {Object.entries(aggregatedReactions).map(([emoji, senders]) => (
+                                        {Object.entries(reactionCounts).map(([emoji, count]) => (
                                             <button
                                                 key={emoji}
                                                 onClick={() => sendReaction(msg.id, emoji, username)}
-                                                className={`px-1.5 py-0.5 rounded-full text-xs border flex items-center gap-1 hover:bg-slate-50 transition-colors ${senders.includes(username)
+                                                className={`px-1.5 py-0.5 rounded-full text-xs border flex items-center gap-1 hover:bg-slate-50 transition-colors ${msg.reactors?.[emoji]?.includes(username)
                                                     ? 'bg-primary/5 border-primary/20 text-primary'
                                                     : 'bg-white border-slate-200 text-slate-500'
                                                     }`}
-                                                title={senders.join(', ')}
+                                                title={msg.reactors?.[emoji]?.join(', ')}
                                             >
                                                 <span>{emoji}</span>
-                                                <span className="text-[10px] font-medium">{senders.length}</span>
+                                                <span className="text-[10px] font-medium">{count}</span>
                                             </button>
                                         ))}
                                     </div>
@@ -5,7 +5,9 @@ interface Message {
     sender: string;
     message: string;
     timestamp: string;
-    reactions: { emoji: string; sender: string }[];
+    reaction_counts: Record<string, number>;
+    // Who we have seen reacting with each emoji since connecting; the server only sends counts
+    reactors?: Record<string, string[]>;
     parent_id?: number | null;
     parent_content?: string | null;
     parent_sender?: string | null;
@@ -13,6 +15,7 @@ interface Message {
     file_url?: string | null;
     file_type?: 'image' | 'video' | null;
     file_name?: string | null;
+    thumbnail_url?: string | null;
 }
 
 interface UseWebSocketReturn {
@@ -24,67 +27,106 @@ interface UseWebSocketReturn {
     uploadFile: (file: File, sender: string, roomName: string, parentId?: number | null, content?: string) => Promise<void>;
     isConnected: boolean;
     typingUsers: string[];
+    onlineUsers: string[];
     sendTyping: (isTyping: boolean, sender: string) => void;
 }
 
+const toMessage = (data: any): Message => ({
+    id: data.id,
+    sender: data.sender,
+    message: data.message,
+    reaction_counts: data.reaction_counts || {},
+    timestamp: data.timestamp,
+    parent_id: data.parent_id,
+    parent_content: data.parent_content,
+    parent_sender: data.parent_sender,
+    is_edited: data.is_edited || false,
+    file_url: data.file_url,
+    file_type: data.file_type,
+    file_name: data.file_name,
+    thumbnail_url: data.thumbnail_url
+});
+
+const UPLOAD_CHUNK_SIZE = 1024 * 1024;
+const UPLOAD_MAX_RETRIES = 5;
+
+// Hex SHA-256 of a file, so the server can skip uploading bytes it already has
+const hashFile = async (file: File): Promise<string | null> => {
+    if (!window.crypto?.subtle) return null;  // only available on https and localhost
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+};
+
 const useWebSocket = (url: string): UseWebSocketReturn => {
     const [messages, setMessages] = useState<Message[]>([]);
     const [isConnected, setIsConnected] = useState(false);
     const [typingUsers, setTypingUsers] = useState<string[]>([]);
+    const [onlineUsers, setOnlineUsers] = useState<string[]>([]);
     const ws = useRef<WebSocket | null>(null);
 
     useEffect(() => {
-        // Create WebSocket connection
-        ws.current = new WebSocket(url);
+        // Highest seq up to which we have every room event, and events seen past a gap;
+        // a reconnect asks for what came after lastSeq (?since=) and skips events already seen
+        let lastSeq: number | null = null;
+        let ahead = new Set<number>();
+        let retries = 0;
+        let closing = false;
+        let reconnectTimer: ReturnType<typeof setTimeout> | undefined;
 
-        ws.current.onopen = () => {
-            console.log('WebSocket connected');
-            setIsConnected(true);
+        const seen = (seq: number) => {
+            if (lastSeq === null) return false;
+            if (seq <= lastSeq || ahead.has(seq)) return true;
+            ahead.add(seq);
+            while (ahead.delete(lastSeq + 1)) lastSeq++;
+            return false;
         };
 
-        ws.current.onmessage = (event) => {
-            const data = JSON.parse(event.data);
-
-            if (data.type === 'chat_message') {
-                setMessages((prev) => [...prev, {
-                    id: data.id,
-                    sender: data.sender,
-                    message: data.message,
-                    reactions: data.reactions || [],
-                    timestamp: data.timestamp,
-                    parent_id: data.parent_id,
-                    parent_content: data.parent_content,
-                    parent_sender: data.parent_sender,
-                    is_edited: data.is_edited || false,
-                    file_url: data.file_url,
-                    file_type: data.file_type,
-                    file_name: data.file_name
-                }]);
-            } else if (data.type === 'reaction_update') {
+        const handleEvent = (data: any) => {
+            if (typeof data.seq === 'number' && data.type !== 'sync' && data.type !== 'resume' && seen(data.seq)) {
+                return;
+            }
+            if (data.type === 'sync') {
+                // Where the room's events stand; a resync follows a full reload of the history
+                lastSeq = data.seq;
+                ahead = new Set();
+            } else if (data.type === 'resume') {
+                // What we missed while disconnected, in order
+                data.events.forEach(handleEvent);
+            } else if (data.type === 'message_history') {
+                // Recent messages replayed by the server when we join a room
+                setMessages(data.messages.map(toMessage));
+            } else if (data.type === 'chat_message') {
+                // A message we already have is sent again when it changes (its thumbnail is ready),
+                // and one broadcast while we joined can also be in the replay
+                setMessages((prev) => prev.some(msg => msg.id === data.id)
+                    ? prev.map(msg => msg.id === data.id ? { ...toMessage(data), reactors: msg.reactors } : msg)
+                    : [...prev, toMessage(data)]);
+            } else if (data.type === 'reaction_delta') {
+                // New counts for the emojis one sender just added or removed
                 setMessages((prev) => prev.map(msg => {
                     if (msg.id === data.message_id) {
-                        const currentReactions = msg.reactions || [];
-                        let newReactions = [...currentReactions];
-
-                        if (data.action === 'added') {
-                            newReactions.push({ emoji: data.emoji, sender: data.sender });
-                        } else if (data.action === 'removed') {
-                            newReactions = newReactions.filter(r =>
-                                !(r.emoji === data.emoji && r.sender === data.sender)
-                            );
-                        }
-                        return { ...msg, reactions: newReactions };
+                        const counts = { ...msg.reaction_counts, ...data.counts };
+                        Object.keys(counts).forEach(emoji => { if (!counts[emoji]) delete counts[emoji]; });
+
+                        const reactors = { ...(msg.reactors || {}) };
+                        data.added.forEach((emoji: string) => {
+                            reactors[emoji] = [...(reactors[emoji] || []).filter(s => s !== data.sender), data.sender];
+                        });
+                        data.removed.forEach((emoji: string) => {
+                            reactors[emoji] = (reactors[emoji] || []).filter(s => s !== data.sender);
+                        });
+                        return { ...msg, reaction_counts: counts, reactors };
                     }
                     return msg;
                 }));
-            } else if (data.type === 'user_typing') {
-                setTypingUsers((prev) => {
-                    if (data.is_typing) {
-                        return prev.includes(data.sender) ? prev : [...prev, data.sender];
-                    } else {
-                        return prev.filter(user => user !== data.sender);
-                    }
-                });
+            } else if (data.type === 'presence') {
+                // Who is in the room when we join, followed by presence_delta changes
+                setOnlineUsers(data.online);
+            } else if (data.type === 'presence_delta') {
+                setOnlineUsers((prev) => [...prev.filter(u => !data.left.includes(u) && !data.joined.includes(u)), ...data.joined].sort());
+            } else if (data.type === 'typing_snapshot') {
+                // The server sends the full list of who is typing a few times a second
+                setTypingUsers(data.typing);
             } else if (data.type === 'message_edit') {
                 setMessages((prev) => prev.map(msg => {
                     if (msg.id === data.message_id) {
@@ -94,20 +136,46 @@ const useWebSocket = (url: string): UseWebSocketReturn => {
                 }));
             } else if (data.type === 'message_delete') {
                 setMessages((prev) => prev.filter(msg => msg.id !== data.message_id));
+            } else if (data.type === 'error') {
+                // e.g. rate_limited: the operation was dropped; retry_after says when to try again
+                console.warn(`Server refused ${data.operation}: ${data.code}`, data);
             }
         };
 
-        ws.current.onerror = (error) => {
-            console.error('WebSocket error:', error);
-        };
+        const connect = () => {
+            const socket = new WebSocket(lastSeq === null ? url : `${url}${url.includes('?') ? '&' : '?'}since=${lastSeq}`);
+            ws.current = socket;
+
+            socket.onopen = () => {
+                console.log('WebSocket connected');
+                retries = 0;
+                setIsConnected(true);
+            };
 
-        ws.current.onclose = () => {
-            console.log('WebSocket disconnected');
-            setIsConnected(false);
+            socket.onmessage = (event) => {
+                const data = JSON.parse(event.data);
+                // Events sent close together arrive merged into one array frame
+                (Array.isArray(data) ? data : [data]).forEach(handleEvent);
+            };
+
+            socket.onerror = (error) => {
+                console.error('WebSocket error:', error);
+            };
+
+            socket.onclose = (event) => {
+                console.log('WebSocket disconnected');
+                setIsConnected(false);
+                // 4004: the room was deleted, so there is nothing to come back to
+                if (closing || event.code === 4004) return;
+                reconnectTimer = setTimeout(connect, Math.min(10000, 500 * 2 ** retries++));
+            };
         };
+        connect();
 
         // Cleanup on unmount
         return () => {
+            closing = true;
+            clearTimeout(reconnectTimer);
             ws.current?.close();
         };
     }, [url]);
@@ -166,34 +234,70 @@ const useWebSocket = (url: string): UseWebSocketReturn => {
     }, []);
 
     const uploadFile = useCallback(async (file: File, sender: string, roomName: string, parentId?: number | null, content?: string) => {
-        const formData = new FormData();
-        formData.append('file', file);
-        formData.append('sender', sender);
-        formData.append('room_name', roomName);
-        if (parentId) formData.append('parent_id', parentId.toString());
-        if (content) formData.append('content', content);
-
         const baseUrl = import.meta.env.VITE_API_URL || 'http://localhost:8000';
         try {
-            const response = await fetch(`${baseUrl}/api/upload-file/`, {
+            // Chunked upload: start, PUT chunks at the server's offset, then complete.
+            // A failed chunk is retried from whatever offset the server reports.
+            const startResponse = await fetch(`${baseUrl}/api/uploads/`, {
                 method: 'POST',
-                body: formData,
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    sender,
+                    room_name: roomName,
+                    file_name: file.name,
+                    content_type: file.type,
+                    size: file.size,
+                    parent_id: parentId || null,
+                    content: content || '',
+                    sha256: await hashFile(file),
+                }),
             });
+            if (!startResponse.ok) {
+                const errorData = await startResponse.json();
+                throw new Error(errorData.error || 'Failed to upload file');
+            }
+            const started = await startResponse.json();
+            if (started.deduplicated) return;  // server already had the file and posted the message
+            const uploadId = started.upload_id;
+            const uploadUrl = `${baseUrl}/api/uploads/${uploadId}/`;
+
+            let offset = 0;
+            let retries = 0;
+            while (offset < file.size) {
+                try {
+                    const chunkResponse = await fetch(`${uploadUrl}?offset=${offset}`, {
+                        method: 'PUT',
+                        body: file.slice(offset, offset + UPLOAD_CHUNK_SIZE),
+                    });
+                    const state = await chunkResponse.json();
+                    if (!chunkResponse.ok && chunkResponse.status !== 409) {
+                        throw new Error(state.error || 'Failed to upload file');
+                    }
+                    offset = state.offset;
+                    retries = 0;
+                } catch (error) {
+                    if (++retries > UPLOAD_MAX_RETRIES) throw error;
+                    // Connection dropped: ask the server how much arrived and resume from there
+                    await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+                    const state = await (await fetch(uploadUrl)).json();
+                    offset = state.offset;
+                }
+            }
 
-            if (!response.ok) {
-                const errorData = await response.json();
+            const completeResponse = await fetch(`${uploadUrl}complete/`, { method: 'POST' });
+            if (!completeResponse.ok) {
+                const errorData = await completeResponse.json();
                 throw new Error(errorData.error || 'Failed to upload file');
             }
 
-            // The file upload view broadcasts the message, so we don't need to manually update local state.
-            // But we could if we wanted immediate feedback.
+            // The complete endpoint broadcasts the message, so we don't need to manually update local state.
         } catch (error) {
             console.error('Error uploading file:', error);
             throw error;
         }
     }, []);
 
-    return { messages, sendMessage, sendReaction, sendTyping, editMessage, deleteMessage, uploadFile, isConnected, typingUsers };
+    return { messages, sendMessage, sendReaction, sendTyping, editMessage, deleteMessage, uploadFile, isConnected, typingUsers, onlineUsers };
 };
 
 export default useWebSocket;